@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the hot paths of panopticon.
+
+Run them with ``python -m benchmarks`` (or ``make benchmark``). Everything
+runs offline: metrics go to a recording or null client, an in-process
+aggregator without a reporter or a local UDP socket.
+"""
+
+from __future__ import unicode_literals, absolute_import
+import gc
+import time
+import statistics
+
+BENCHMARKS = []
+
+
+class Benchmark(object):
+    """
+    A benchmark that times `number` calls of the function returned by
+    `setup`, repeated `repeat` times.
+
+    `setup` is called once per repetition and returns the function to call
+    and, optionally, a function that cleans up afterwards. Results are
+    reported in nanoseconds per call.
+    """
+
+    def __init__(self, name, setup, number=10000, repeat=5, group=None):
+        self.name = name
+        self.setup = setup
+        self.number = number
+        self.repeat = repeat
+        self.group = group or name.split(".")[0]
+
+    def run(self, scale=1.0):
+        number = max(1, int(self.number * scale))
+        timings = []
+
+        for _ in range(self.repeat):
+            prepared = self.setup()
+            func, teardown = (
+                prepared if isinstance(prepared, tuple) else (prepared, None)
+            )
+
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                timings.append(_time_calls(func, number))
+            finally:
+                if gc_enabled:
+                    gc.enable()
+                if teardown is not None:
+                    teardown()
+
+        per_call = [timing / number * 1e9 for timing in timings]
+        return {
+            "group": self.group,
+            "number": number,
+            "repeat": self.repeat,
+            "min_ns": min(per_call),
+            "median_ns": statistics.median(per_call),
+        }
+
+
+def benchmark(name, number=10000, repeat=5):
+    """
+    Register the decorated setup function as a `Benchmark` called `name`.
+    """
+
+    def register(setup):
+        BENCHMARKS.append(Benchmark(name, setup, number=number, repeat=repeat))
+        return setup
+
+    return register
+
+
+def _time_calls(func, number):
+    iterations = range(number)
+    start = time.perf_counter()
+    for _ in iterations:
+        func()
+    return time.perf_counter() - start
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Run the benchmarks and print or store the results::
+
+    python -m benchmarks --output before.json
+    python -m benchmarks --compare before.json
+
+Results are stored as JSON with the commit they were taken at. When
+comparing, the fastest repetition of each benchmark is compared and the
+command exits with status 1 if any benchmark got slower by more than
+`--threshold` percent.
+"""
+
+from __future__ import unicode_literals, absolute_import, print_function
+import sys
+import json
+import platform
+import argparse
+import subprocess
+
+from . import BENCHMARKS
+from . import bench_datadog, bench_django, bench_health, bench_startup  # noqa: F401
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("-k", "--filter", help="only run benchmarks containing this")
+    parser.add_argument("-o", "--output", help="write the results to this file")
+    parser.add_argument("-c", "--compare", help="compare with results in this file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10,
+        help="slowdown in percent reported as a regression (default: 10)",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="scale the number of calls, e.g. 0.1 for a quick run",
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    for bench in BENCHMARKS:
+        if args.filter and args.filter not in bench.name:
+            continue
+
+        results[bench.name] = result = bench.run(scale=args.scale)
+        print("{:<50} {:>12.0f} ns".format(bench.name, result["min_ns"]))
+
+    report = {
+        "commit": _get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), report, args.threshold)
+        return 1 if regressions else 0
+
+    return 0
+
+
+def compare(baseline, report, threshold):
+    """
+    Print the change of each benchmark and return the names of those that
+    got slower by more than `threshold` percent.
+    """
+    print()
+    print(
+        "Compared with {} (Python {})".format(
+            baseline.get("commit") or "unknown commit", baseline.get("python")
+        )
+    )
+
+    regressions = []
+    for name, result in sorted(report["results"].items()):
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+
+        change = (result["min_ns"] / previous["min_ns"] - 1) * 100
+        marker = ""
+        if change > threshold:
+            marker = "  REGRESSION"
+            regressions.append(name)
+
+        print(
+            "{:<50} {:>12.0f} -> {:>12.0f} ns {:>+8.1f}%{}".format(
+                name, previous["min_ns"], result["min_ns"], change, marker
+            )
+        )
+
+    return regressions
+
+
+def _get_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode("ascii")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import socket
+import threading
+
+from panopticon.aggregator import Aggregator
+from panopticon.datadog import DataDog
+
+from . import benchmark
+
+DICT_TAGS = {"app": "web", "region": "eu-west-1", "path": "/orders/"}
+LIST_TAGS = ["app:web", "path:/orders/", "region:eu-west-1"]
+
+THREADS = 8
+
+
+class NullReporter(object):
+    def flush_metrics(self, metrics):
+        pass
+
+    def flush_events(self, events):
+        pass
+
+
+class OfflineAggregator(Aggregator):
+    """
+    The in-process aggregator with a reporter that drops everything, so
+    benchmarks don't need an API key or a network connection.
+    """
+
+    requires_api_key = False
+
+    def __init__(self, **kwargs):
+        kwargs["reporter"] = NullReporter()
+        super(OfflineAggregator, self).__init__(**kwargs)
+
+
+class UDPSink(object):
+    """
+    A local UDP socket that reads and drops everything sent to it, standing
+    in for a DogStatsD agent.
+    """
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.settimeout(0.1)
+        self.port = self.socket.getsockname()[1]
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._drain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stop_event.set()
+        self._thread.join()
+        self.socket.close()
+
+    def _drain(self):
+        while not self._stop_event.is_set():
+            try:
+                self.socket.recv(65535)
+            except socket.timeout:
+                pass
+
+
+def configure(backend="recording", **settings):
+    DataDog.stop()
+    DataDog.configure_settings(
+        dict(
+            {
+                "DATADOG_STATS_ENABLED": backend is not None,
+                "DATADOG_STATS_BACKEND": backend or "recording",
+                "DATADOG_STATS_PREFIX": "benchmark",
+            },
+            **settings
+        )
+    )
+    return DataDog.stats()
+
+
+def configure_udp_sink():
+    sink = UDPSink()
+    configure(
+        "dogstatsd",
+        DATADOG_STATSD_HOST="127.0.0.1",
+        DATADOG_STATSD_PORT=sink.port,
+    )
+
+    def teardown():
+        DataDog.stop()
+        sink.close()
+
+    return teardown
+
+
+def _register_metric_benchmarks(backend, label):
+    @benchmark("datadog.increment.dict_tags.{}".format(label), number=20000)
+    def increment_dict_tags():
+        configure(backend)
+        return lambda: DataDog.increment("requests", tags=DICT_TAGS)
+
+    @benchmark("datadog.increment.list_tags.{}".format(label), number=20000)
+    def increment_list_tags():
+        configure(backend)
+        return lambda: DataDog.increment("requests", tags=LIST_TAGS)
+
+    @benchmark("datadog.histogram.dict_tags.{}".format(label), number=20000)
+    def histogram_dict_tags():
+        configure(backend)
+        return lambda: DataDog.histogram("latency", 12.5, tags=DICT_TAGS)
+
+    @benchmark("datadog.counter_handle.{}".format(label), number=20000)
+    def counter_handle():
+        configure(backend)
+        counter = DataDog.counter("requests", tags=DICT_TAGS)
+        return counter.increment
+
+
+_register_metric_benchmarks(None, "null")
+_register_metric_benchmarks("recording", "recording")
+_register_metric_benchmarks("benchmarks.bench_datadog.OfflineAggregator", "aggregator")
+_register_metric_benchmarks("prometheus", "prometheus")
+
+
+def _register_scrape_benchmark(label, updated_share):
+    # 1000 series of which `updated_share` changed since the last scrape.
+    @benchmark("prometheus.render.{}".format(label), number=200)
+    def render():
+        configure("prometheus")
+        counters = [
+            DataDog.counter("requests", tags={"path": "/{}/".format(index)})
+            for index in range(1000)
+        ]
+        for counter in counters:
+            counter.increment()
+
+        exporter = DataDog.stats()
+        exporter.render()
+        updated = counters[: int(len(counters) * updated_share)]
+
+        def scrape():
+            for counter in updated:
+                counter.increment()
+            exporter.render()
+
+        return scrape
+
+
+_register_scrape_benchmark("unchanged", 0)
+_register_scrape_benchmark("changed_10_percent", 0.1)
+_register_scrape_benchmark("changed_all", 1)
+
+
+@benchmark("datadog.counter_handle.cardinality_limit", number=20000)
+def counter_handle_cardinality_limit():
+    configure("recording", DATADOG_MAX_CONTEXTS_PER_METRIC=100)
+    counter = DataDog.counter("requests", tags=DICT_TAGS)
+    return counter.increment
+
+
+@benchmark("datadog.increment.dict_tags.udp", number=20000)
+def increment_udp():
+    teardown = configure_udp_sink()
+    return (lambda: DataDog.increment("requests", tags=DICT_TAGS)), teardown
+
+
+@benchmark("datadog.histogram.dict_tags.udp", number=20000)
+def histogram_udp():
+    teardown = configure_udp_sink()
+    return (lambda: DataDog.histogram("latency", 12.5, tags=DICT_TAGS)), teardown
+
+
+BATCH_SIZE = 10
+
+
+def _emit_separately():
+    for index in range(BATCH_SIZE // 2):
+        DataDog.increment("jobs.finished", tags=DICT_TAGS)
+        DataDog.histogram("jobs.duration", index, tags=DICT_TAGS)
+
+
+def _emit_batch():
+    with DataDog.batch(tags=DICT_TAGS) as batch:
+        for index in range(BATCH_SIZE // 2):
+            batch.increment("jobs.finished")
+            batch.histogram("jobs.duration", index)
+
+
+def _register_batch_benchmarks(backend, label):
+    # Each call emits `BATCH_SIZE` points, separately or as a batch.
+    @benchmark("datadog.batch.separate.{}".format(label), number=2000)
+    def separate():
+        if backend == "udp":
+            return _emit_separately, configure_udp_sink()
+        configure(backend)
+        return _emit_separately
+
+    @benchmark("datadog.batch.batch.{}".format(label), number=2000)
+    def batch():
+        if backend == "udp":
+            return _emit_batch, configure_udp_sink()
+        configure(backend)
+        return _emit_batch
+
+
+_register_batch_benchmarks("recording", "recording")
+_register_batch_benchmarks("benchmarks.bench_datadog.OfflineAggregator", "aggregator")
+_register_batch_benchmarks("udp", "udp")
+
+
+@benchmark("datadog.tag_scope.enter_exit", number=20000)
+def tag_scope_enter_exit():
+    configure("recording")
+    scope = DataDog.tag_scope(DICT_TAGS)
+
+    def enter_exit():
+        with scope:
+            pass
+
+    return enter_exit
+
+
+def _in_tag_scope(emit):
+    # Emits within a scope that stays open for the whole repetition.
+    scope = DataDog.tag_scope({"tenant": "acme", "job": "reindex"})
+    scope.__enter__()
+    return emit, lambda: scope.__exit__(None, None, None)
+
+
+@benchmark("datadog.tag_scope.increment.dict_tags", number=20000)
+def tag_scope_increment():
+    configure("recording")
+    return _in_tag_scope(lambda: DataDog.increment("requests", tags=DICT_TAGS))
+
+
+@benchmark("datadog.tag_scope.counter_handle", number=20000)
+def tag_scope_counter_handle():
+    configure("recording")
+    return _in_tag_scope(DataDog.counter("requests", tags=DICT_TAGS).increment)
+
+
+def _register_convert_tags_benchmarks(default_tag_count):
+    @benchmark("datadog.convert_tags.defaults_{}".format(default_tag_count))
+    def convert_tags():
+        configure(
+            "recording",
+            DATADOG_DEFAULT_TAGS={
+                "default_{}".format(index): index for index in range(default_tag_count)
+            },
+        )
+        return lambda: DataDog._convert_tags(DICT_TAGS)
+
+
+for _count in (0, 4, 16, 64):
+    _register_convert_tags_benchmarks(_count)
+
+
+def _noop():
+    pass
+
+
+@benchmark("datadog.track_time.baseline", number=20000)
+def track_time_baseline():
+    configure("recording")
+    return _noop
+
+
+@benchmark("datadog.track_time.decorator", number=20000)
+def track_time_decorator():
+    configure("recording")
+    return DataDog.track_time("noop")(_noop)
+
+
+@benchmark("datadog.track_time.outcome", number=20000)
+def track_time_outcome():
+    configure("recording")
+    return DataDog.track_time("noop", outcome=True)(_noop)
+
+
+@benchmark("datadog.track_time.block", number=20000)
+def track_time_block():
+    configure("recording")
+    tracker = DataDog.track_time("noop")
+
+    def timed_block():
+        with tracker:
+            pass
+
+    return timed_block
+
+
+def _register_threaded_benchmark(backend, label, number=20000):
+    # Each call emits `THREADS * 1000` increments from `THREADS` threads at
+    # once, so the result is the time for all of them including starting
+    # the threads.
+    @benchmark("threads.increment.{}".format(label), number=max(1, number // 1000))
+    def threaded_increments():
+        configure(backend)
+        counter = DataDog.counter("requests", tags=DICT_TAGS)
+
+        def emit():
+            for _ in range(1000):
+                counter.increment()
+
+        def run_threads():
+            threads = [threading.Thread(target=emit) for _ in range(THREADS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        return run_threads
+
+    return threaded_increments
+
+
+_register_threaded_benchmark("recording", "recording")
+_register_threaded_benchmark("benchmarks.bench_datadog.OfflineAggregator", "aggregator")
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from django.http import HttpResponse  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from django.urls import ResolverMatch  # noqa: E402
+
+from panopticon.django.middleware import (  # noqa: E402
+    DataDogMiddleware,
+    RequestMetricsMiddleware,
+)
+
+from . import benchmark  # noqa: E402
+from .bench_datadog import configure  # noqa: E402
+
+
+def view(request):
+    return HttpResponse()
+
+
+def get_request():
+    request = RequestFactory().get("/orders/123/")
+    request.resolver_match = ResolverMatch(view, (), {"pk": 123}, url_name="order")
+    return request
+
+
+@benchmark("django.middleware.baseline", number=20000)
+def baseline():
+    response = HttpResponse()
+    return lambda: response
+
+
+@benchmark("django.middleware.datadog", number=20000)
+def datadog_middleware():
+    configure("recording")
+    middleware = DataDogMiddleware()
+    request, response = get_request(), HttpResponse()
+
+    def handle_request():
+        middleware.process_request(request)
+        return middleware.process_response(request, response)
+
+    return handle_request
+
+
+@benchmark("django.middleware.request_metrics", number=20000)
+def request_metrics_middleware():
+    configure("recording")
+    request, response = get_request(), HttpResponse()
+    middleware = RequestMetricsMiddleware(lambda request: response)
+
+    return lambda: middleware(request)
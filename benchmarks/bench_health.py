@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import time
+
+from panopticon.datadog import DataDog
+from panopticon.health import HealthCheck
+from panopticon.web import HealthCheckApp
+
+from . import benchmark
+
+
+def get_health_check_class(count, **attributes):
+    health_check_class = type(
+        str("BenchmarkHealthCheck"),
+        (HealthCheck,),
+        dict({"health_checks": {}}, **attributes),
+    )
+
+    for index in range(count):
+
+        def check(data):
+            data[HealthCheck.HEALTHY] = True
+            data[HealthCheck.STATUS_MESSAGE] = "ok"
+            return data
+
+        check.__name__ = str("check_{}".format(index))
+        health_check_class.register_healthcheck(check)
+
+    return health_check_class
+
+
+def _register_run_benchmarks(count):
+    @benchmark("health.run.sequential.{}_checks".format(count), number=200)
+    def run_sequential():
+        DataDog.stop()
+        DataDog.configure_settings({})
+        return get_health_check_class(count)(concurrent=False).run
+
+    @benchmark("health.run.concurrent.{}_checks".format(count), number=200)
+    def run_concurrent():
+        DataDog.stop()
+        DataDog.configure_settings({})
+        return get_health_check_class(count)(concurrent=True).run
+
+
+for _count in (1, 10, 50):
+    _register_run_benchmarks(_count)
+
+
+def _register_failing_check_benchmark(label, **options):
+    # A dependency that is down and takes 5ms to fail, e.g. a URL check
+    # running into a connection timeout.
+    @benchmark("health.run.failing_dependency.{}".format(label), number=200)
+    def run_failing():
+        DataDog.stop()
+        DataDog.configure_settings({})
+        health_check_class = get_health_check_class(0)
+
+        @health_check_class.register_healthcheck(**options)
+        def upstream(data):
+            time.sleep(0.005)
+            data[HealthCheck.STATUS_MESSAGE] = "connection timed out"
+            return data
+
+        return health_check_class(concurrent=False).run
+
+
+_register_failing_check_benchmark("no_circuit_breaker")
+_register_failing_check_benchmark(
+    "circuit_breaker", failure_threshold=3, reset_timeout=30
+)
+
+
+def _start_response(status, headers):
+    pass
+
+
+@benchmark("health.wsgi.cached", number=20000)
+def wsgi_cached():
+    health_check_class = get_health_check_class(10, CACHE_TTL=60)
+    app = HealthCheckApp(health_check_class=health_check_class)
+
+    def teardown():
+        health_check_class.get_cache().stop()
+
+    return (lambda: app({}, _start_response)), teardown
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmarks: the time for a new interpreter to import a module, as
+paid by every CLI invocation or cold start of a serverless function.
+`startup.python` is the interpreter on its own, to subtract from the rest.
+"""
+
+from __future__ import unicode_literals, absolute_import
+import sys
+import subprocess
+
+from . import benchmark
+
+MODULES = ("panopticon.datadog", "panopticon.health", "panopticon.web")
+
+
+def _register_import_benchmark(name, code):
+    @benchmark("startup.{}".format(name), number=5, repeat=5)
+    def import_module():
+        command = [sys.executable, "-c", code]
+        return lambda: subprocess.check_call(command)
+
+    return import_module
+
+
+_register_import_benchmark("python", "pass")
+
+for _module in MODULES:
+    _register_import_benchmark(_module, "import {}".format(_module))
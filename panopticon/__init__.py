@@ -5,3 +5,16 @@ class PanopticonSettings(dict):
     """
     Settings object that behaves similar to common practises in Django or Flask.
     """
+
+
+def get_setting(settings, key, default=None):
+    """
+    Look up `key` in `settings`, which can either be a dict-like object or an
+    object exposing settings as attributes (e.g. `django.conf.settings`).
+    """
+    try:
+        value = settings.get(key, default)
+    except AttributeError:
+        value = getattr(settings, key, default)
+
+    return value
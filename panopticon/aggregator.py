@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import math
+import time
+import logging
+import threading
+
+log = logging.getLogger("panopticon.aggregator")
+
+
+class QuantileSketch(object):
+    """
+    A bounded-size, mergeable sketch that estimates quantiles of a stream of
+    values.
+
+    Values are counted in logarithmically sized buckets so that quantiles
+    are estimated within `relative_accuracy` of the actual value. At most
+    `max_bins` buckets are kept: when there are more, the lowest buckets are
+    collapsed, which only affects the accuracy of the lowest quantiles.
+    Values at or below zero are counted separately. The exact count, sum,
+    minimum and maximum are tracked as well and estimates are always clamped
+    to the observed range.
+
+    The memory used doesn't depend on the number of values added, and
+    sketches with the same `relative_accuracy` can be merged.
+    """
+
+    def __init__(self, relative_accuracy=0.02, max_bins=512):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+
+        self.bins = {}
+        self.zero_count = 0
+
+        self.count = 0
+        self.sum = 0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, value, weight=1):
+        """
+        Add `value`, which stands for `weight` values, e.g. `1 / sample_rate`
+        for a sampled value.
+        """
+        self.count += weight
+        self.sum += value * weight
+
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+        if value <= 0:
+            self.zero_count += weight
+            return
+
+        index = math.ceil(math.log(value) / self._log_gamma)
+        bins = self.bins
+        bins[index] = bins.get(index, 0) + weight
+
+        if len(bins) > self.max_bins:
+            self._collapse()
+
+    def merge(self, other):
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+        while len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+
+        if rank < seen:
+            return self.min
+
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                break
+
+        # A bucket covers (gamma ** (index - 1), gamma ** index], this value
+        # is within `relative_accuracy` of both bounds.
+        value = 2 * math.exp(index * self._log_gamma) / (self._gamma + 1)
+
+        return min(max(value, self.min), self.max)
+
+    @property
+    def average(self):
+        return self.sum / self.count if self.count else None
+
+    def _collapse(self):
+        lowest = min(self.bins)
+        count = self.bins.pop(lowest)
+
+        second_lowest = min(self.bins)
+        self.bins[second_lowest] += count
+
+
+class Aggregator(object):
+    """
+    An in-process replacement for `datadog.ThreadStats` that aggregates
+    counters, gauges and histograms with constant memory per metric context.
+
+    Points are added to one of `stripes` buffers, picked by the metric
+    context, each guarded by its own lock. Threads emitting different
+    metrics rarely contend for the same lock and a context always ends up in
+    the same buffer, so nothing needs to be merged across buffers on flush.
+
+    Histograms are summarised with a `QuantileSketch` rather than keeping
+    every value until the next flush. They are reported with the same series
+    as `ThreadStats` (`.min`, `.max`, `.avg`, `.count` and percentiles), so
+    existing dashboards keep working. Sampled values are weighted by
+    `1 / sample_rate`, so the count isn't lowered by sampling.
+
+    At most `max_contexts` metric contexts are buffered between flushes,
+    split evenly between the buffers. Points for new contexts are dropped
+    while a buffer is full, points for contexts already buffered are still
+    aggregated.
+
+    `get_stats` returns counters for the points added and dropped, the
+    series flushed, failed flushes and the latency of the last flush.
+    """
+
+    PERCENTILES = (0.75, 0.85, 0.95, 0.99)
+    SKETCH_RELATIVE_ACCURACY = 0.02
+
+    MAX_CONTEXTS = 100000
+
+    supports_sample_rate = True
+
+    def __init__(self, stripes=16, reporter=None, max_contexts=MAX_CONTEXTS):
+        self._stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+        self._max_stripe_contexts = max(1, max_contexts // stripes)
+
+        self._events = []
+        self._events_lock = threading.Lock()
+
+        self._reporter = reporter
+        self._roll_up_interval = 10
+        self._flush_interval = 10
+
+        self._stop_event = threading.Event()
+        self._flush_thread = None
+        self._flush_lock = threading.Lock()
+
+        # Only updated while flushing, except `points` which is incremented
+        # without a lock and may lose an update under contention.
+        self.points = 0
+        self.dropped_points = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.flushed_series = 0
+        self.flushed_events = 0
+        self.dropped_series = 0
+        self.last_flush_duration = None
+        self.last_flush_failed = False
+
+    @classmethod
+    def from_settings(cls, settings):
+        from .datadog import DataDog
+
+        return cls(
+            max_contexts=int(
+                settings.get(DataDog.KEY_DATADOG_MAX_BUFFERED_CONTEXTS)
+                or cls.MAX_CONTEXTS
+            )
+        )
+
+    def start(self, roll_up_interval=10, flush_interval=10, **kwargs):
+        self._roll_up_interval = roll_up_interval
+        self._flush_interval = flush_interval
+
+        if self._reporter is None:
+            from datadog.threadstats.reporters import HttpReporter
+
+            self._reporter = HttpReporter()
+
+        if self._flush_thread and self._flush_thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._flush_thread = threading.Thread(
+            target=self._flush_periodically, name="panopticon-aggregator"
+        )
+        self._flush_thread.daemon = True
+        self._flush_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+        if self._flush_thread:
+            self._flush_thread.join()
+            self._flush_thread = None
+
+    def gauge(self, metric_name, value, timestamp=None, tags=None, host=None, **kwargs):
+        self._add_point(_GAUGE, metric_name, value, timestamp, tags, host)
+
+    def increment(
+        self, metric_name, value=1, timestamp=None, tags=None, host=None, **kwargs
+    ):
+        self._add_point(_COUNTER, metric_name, value, timestamp, tags, host)
+
+    def decrement(
+        self, metric_name, value=1, timestamp=None, tags=None, host=None, **kwargs
+    ):
+        self._add_point(_COUNTER, metric_name, -value, timestamp, tags, host)
+
+    def histogram(
+        self,
+        metric_name,
+        value,
+        timestamp=None,
+        tags=None,
+        host=None,
+        sample_rate=1,
+        **kwargs
+    ):
+        self._add_point(
+            _HISTOGRAM,
+            metric_name,
+            value,
+            timestamp,
+            tags,
+            host,
+            _get_weight(sample_rate),
+        )
+
+    timing = histogram
+
+    def event(self, title, text, tags=None, **kwargs):
+        event = dict(kwargs, title=title, text=text, tags=tags)
+
+        with self._events_lock:
+            self._events.append(event)
+
+    def submit_many(self, points):
+        """
+        Add several `MetricPoint`s at once. The points are grouped by buffer
+        first, so each buffer's lock is only taken once for the batch.
+        """
+        timestamp = time.time()
+        interval = timestamp - timestamp % self._roll_up_interval
+        stripe_count = len(self._stripes)
+
+        by_stripe = {}
+        # Points of a batch usually share the same tags list.
+        last_tags = context_tags = None
+        for method, metric_name, value, tags, sample_rate in points:
+            metric_type = _METHOD_TYPES[method]
+            if method == "decrement":
+                value = -value
+
+            if tags is not last_tags:
+                last_tags = tags
+                context_tags = tuple(tags) if tags else None
+
+            context = (metric_type, metric_name, None, context_tags)
+            stripe_points = by_stripe.setdefault(hash(context) % stripe_count, [])
+            stripe_points.append(
+                (metric_type, (interval, context), value, _get_weight(sample_rate))
+            )
+            self.points += 1
+
+        for index, stripe_points in by_stripe.items():
+            lock, buffer = self._stripes[index]
+            with lock:
+                for metric_type, key, value, weight in stripe_points:
+                    self._add_to_buffer(buffer, metric_type, key, value, weight)
+
+    def _add_point(
+        self, metric_type, metric_name, value, timestamp, tags, host, weight=1
+    ):
+        timestamp = timestamp or time.time()
+        interval = timestamp - timestamp % self._roll_up_interval
+
+        # Tags are expected to be sorted already, `DataDog` always does that.
+        context = (metric_type, metric_name, host, tuple(tags) if tags else None)
+        lock, buffer = self._stripes[hash(context) % len(self._stripes)]
+        self.points += 1
+
+        with lock:
+            self._add_to_buffer(buffer, metric_type, (interval, context), value, weight)
+
+    def _add_to_buffer(self, buffer, metric_type, key, value, weight=1):
+        # Called while holding the lock of `buffer`.
+        if key not in buffer and len(buffer) >= self._max_stripe_contexts:
+            self.dropped_points += 1
+            return
+
+        if metric_type is _COUNTER:
+            buffer[key] = buffer.get(key, 0) + value
+        elif metric_type is _GAUGE:
+            buffer[key] = value
+        else:
+            sketch = buffer.get(key)
+            if sketch is None:
+                sketch = buffer[key] = QuantileSketch(self.SKETCH_RELATIVE_ACCURACY)
+            sketch.add(value, weight)
+
+    def flush(self, timestamp=None):
+        """
+        Send all metrics from intervals that ended before `timestamp` and all
+        queued events.
+        """
+        with self._flush_lock:
+            timestamp = timestamp or time.time()
+            metrics = self._format_metrics(
+                self._drain(timestamp - timestamp % self._roll_up_interval)
+            )
+
+            with self._events_lock:
+                events, self._events = self._events, []
+
+            self._report(metrics, events)
+
+    def get_stats(self):
+        """
+        Get a snapshot of the aggregator's own counters.
+        """
+        buffer_size = 0
+        for lock, buffer in self._stripes:
+            buffer_size += len(buffer)
+
+        return {
+            "points": self.points,
+            "dropped_points": self.dropped_points,
+            "buffer_size": buffer_size,
+            "queued_events": len(self._events),
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "flushed_series": self.flushed_series,
+            "flushed_events": self.flushed_events,
+            "dropped_series": self.dropped_series,
+            "last_flush_duration": self.last_flush_duration,
+            "last_flush_failed": self.last_flush_failed,
+        }
+
+    def _report(self, metrics, events):
+        start = time.monotonic()
+        try:
+            if metrics:
+                self._reporter.flush_metrics(metrics)
+            if events:
+                self._reporter.flush_events(events)
+        except Exception:  # noqa
+            log.exception("flushing metrics and events failed")
+            self.flush_errors += 1
+            self.dropped_series += len(metrics)
+            self.last_flush_failed = True
+        else:
+            self.flushed_series += len(metrics)
+            self.flushed_events += len(events)
+            self.last_flush_failed = False
+
+        self.flushes += 1
+        self.last_flush_duration = time.monotonic() - start
+
+    def _drain(self, before):
+        """
+        Remove and return the aggregated values of all intervals that started
+        before `before` as `((interval, context), value)` pairs.
+        """
+        rolled_up = []
+
+        for lock, buffer in self._stripes:
+            with lock:
+                keys = [key for key in buffer if key[0] < before]
+                rolled_up.extend((key, buffer.pop(key)) for key in keys)
+
+        return rolled_up
+
+    def _format_metrics(self, rolled_up):
+        metrics = []
+        for (interval, (metric_type, name, host, tags)), value in rolled_up:
+            tags = list(tags) if tags else None
+
+            def add(metric_name, metric_value, series_type=_GAUGE):
+                metrics.append(
+                    {
+                        "metric": metric_name,
+                        "points": [[interval, metric_value]],
+                        "type": series_type,
+                        "host": host,
+                        "device": None,
+                        "tags": tags,
+                        "interval": self._roll_up_interval,
+                    }
+                )
+
+            if metric_type is _COUNTER:
+                add(name, value / float(self._roll_up_interval), _RATE)
+            elif metric_type is _GAUGE:
+                add(name, value)
+            else:
+                add(name + ".min", value.min)
+                add(name + ".max", value.max)
+                add(name + ".count", value.count / float(self._roll_up_interval), _RATE)
+                add(name + ".avg", value.average)
+
+                for percentile in self.PERCENTILES:
+                    add(
+                        "{}.{}percentile".format(name, int(percentile * 100)),
+                        value.quantile(percentile),
+                    )
+
+        return metrics
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(self._flush_interval):
+            self.flush()
+
+
+_GAUGE = "gauge"
+_RATE = "rate"
+_COUNTER = "count"
+_HISTOGRAM = "histogram"
+
+# The metric type of each method of `MetricPoint`s passed to `submit_many`.
+_METHOD_TYPES = {
+    "gauge": _GAUGE,
+    "increment": _COUNTER,
+    "decrement": _COUNTER,
+    "histogram": _HISTOGRAM,
+}
+
+
+def _get_weight(sample_rate):
+    # Keeps counts integers unless values are sampled.
+    return 1 / sample_rate if sample_rate != 1 else 1
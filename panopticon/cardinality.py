@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import logging
+import threading
+
+from collections import OrderedDict
+
+log = logging.getLogger("panopticon.cardinality")
+
+
+class CardinalityLimiter(object):
+    """
+    Limits the number of distinct tag sets (contexts) tracked for each
+    metric to `max_contexts`.
+
+    Once a metric reached its limit, the `policy` decides what happens to
+    points with a new context:
+
+    * `drop`: the point is dropped.
+    * `other`: the values of all tags except the default tags are replaced
+      with `other`, so the point is still counted, e.g. `path:other`.
+    * `drop_oldest`: the oldest context of the metric is forgotten to make
+      room for the new one.
+
+    Points with a known context only cost a dict lookup without taking a
+    lock. The number of dropped, folded and evicted contexts is counted and
+    a warning is logged the first time a metric hits its limit.
+    """
+
+    DROP = "drop"
+    OTHER = "other"
+    DROP_OLDEST = "drop_oldest"
+
+    POLICIES = (DROP, OTHER, DROP_OLDEST)
+
+    OTHER_VALUE = "other"
+
+    def __init__(self, max_contexts, policy=DROP, default_tags=()):
+        if policy not in self.POLICIES:
+            raise ValueError(
+                "unknown cardinality policy {!r}, use one of {}".format(
+                    policy, ", ".join(self.POLICIES)
+                )
+            )
+
+        self.max_contexts = max_contexts
+        self.policy = policy
+        self.default_tags = frozenset(default_tags)
+
+        self.dropped = 0
+        self.folded = 0
+        self.evicted = 0
+
+        self._contexts = {}
+        self._limited = set()
+        self._lock = threading.Lock()
+
+    def check(self, metric_name, tags):
+        """
+        Return the tags to emit a point of `metric_name` with, or `None` if
+        the point should be dropped.
+        """
+        contexts = self._contexts.get(metric_name)
+        if contexts is None:
+            with self._lock:
+                contexts = self._contexts.setdefault(metric_name, OrderedDict())
+
+        key = tuple(tags) if tags else ()
+        if key in contexts:
+            return tags
+
+        with self._lock:
+            if key in contexts or len(contexts) < self.max_contexts:
+                contexts[key] = True
+                return tags
+
+            if metric_name not in self._limited:
+                self._limited.add(metric_name)
+                log.warning(
+                    "metric %s reached the limit of %d contexts, applying policy %s",
+                    metric_name,
+                    self.max_contexts,
+                    self.policy,
+                )
+
+            if self.policy == self.DROP_OLDEST:
+                contexts.popitem(last=False)
+                contexts[key] = True
+                self.evicted += 1
+                return tags
+
+            if self.policy == self.OTHER:
+                self.folded += 1
+                return self._fold(tags)
+
+            self.dropped += 1
+            return None
+
+    def get_stats(self):
+        return {
+            "max_contexts": self.max_contexts,
+            "policy": self.policy,
+            "metrics": len(self._contexts),
+            "limited_metrics": len(self._limited),
+            "dropped": self.dropped,
+            "folded": self.folded,
+            "evicted": self.evicted,
+        }
+
+    def _fold(self, tags):
+        folded = set()
+        for tag in tags:
+            if tag in self.default_tags:
+                folded.add(tag)
+            elif ":" in tag:
+                folded.add("{}:{}".format(tag.split(":", 1)[0], self.OTHER_VALUE))
+            else:
+                folded.add(self.OTHER_VALUE)
+        return sorted(folded)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import time
+import threading
+
+from functools import wraps
+from contextlib import contextmanager
+from collections import deque, namedtuple
+
+RecordedCall = namedtuple("RecordedCall", ("method", "args", "kwargs"))
+
+# A point handed to a client's `submit_many`, see `DataDog.submit_many`. The
+# method is one of `gauge`, `increment`, `decrement` or `histogram`, the name
+# is prefixed and the tags are encoded. Counter values are already scaled
+# for sampling, the sample rate is only passed on for gauges and histograms.
+MetricPoint = namedtuple(
+    "MetricPoint", ("method", "metric_name", "value", "tags", "sample_rate")
+)
+
+
+class NullStats(object):
+    """
+    A client that doesn't do anything. `DataDog` uses it when metrics are
+    disabled and skips building metric names and tags altogether when it
+    finds it. It has all the methods of `datadog.ThreadStats`, so code that
+    uses the client directly keeps working.
+    """
+
+    requires_api_key = False
+
+    def start(self, *args, **kwargs):
+        pass
+
+    def stop(self):
+        pass
+
+    def flush(self, *args, **kwargs):
+        pass
+
+    def gauge(self, *args, **kwargs):
+        pass
+
+    def increment(self, *args, **kwargs):
+        pass
+
+    def decrement(self, *args, **kwargs):
+        pass
+
+    def histogram(self, *args, **kwargs):
+        pass
+
+    def distribution(self, *args, **kwargs):
+        pass
+
+    def timing(self, *args, **kwargs):
+        pass
+
+    def set(self, *args, **kwargs):
+        pass
+
+    def timed(self, *args, **kwargs):
+        return _return_unchanged
+
+    @contextmanager
+    def timer(self, *args, **kwargs):
+        yield
+
+    def event(self, *args, **kwargs):
+        pass
+
+    def submit_many(self, points):
+        pass
+
+
+class RecordingStats(object):
+    """
+    A client that keeps the most recent `max_calls` calls in memory, which is
+    useful for tests::
+
+        DataDog.configure_settings(
+            {"DATADOG_STATS_ENABLED": True, "DATADOG_STATS_BACKEND": "recording"}
+        )
+
+        DataDog.increment("requests")
+
+        assert DataDog.stats().calls[-1].method == "increment"
+
+    Older calls are discarded, so the memory used is bounded no matter how
+    long the client is used for.
+    """
+
+    requires_api_key = False
+    supports_sample_rate = True
+
+    def __init__(self, max_calls=10000):
+        self.calls = deque(maxlen=max_calls)
+        self._lock = threading.Lock()
+
+    def start(self, *args, **kwargs):
+        pass
+
+    def stop(self):
+        pass
+
+    def flush(self, *args, **kwargs):
+        pass
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def get_calls(self, method):
+        with self._lock:
+            return [call for call in self.calls if call.method == method]
+
+    def _record(self, method, args, kwargs):
+        with self._lock:
+            self.calls.append(RecordedCall(method, args, kwargs))
+
+    def gauge(self, *args, **kwargs):
+        self._record("gauge", args, kwargs)
+
+    def increment(self, *args, **kwargs):
+        self._record("increment", args, kwargs)
+
+    def decrement(self, *args, **kwargs):
+        self._record("decrement", args, kwargs)
+
+    def histogram(self, *args, **kwargs):
+        self._record("histogram", args, kwargs)
+
+    def distribution(self, *args, **kwargs):
+        self._record("distribution", args, kwargs)
+
+    def timing(self, *args, **kwargs):
+        self._record("timing", args, kwargs)
+
+    def set(self, *args, **kwargs):
+        self._record("set", args, kwargs)
+
+    def timed(self, metric_name, sample_rate=1, tags=None, host=None):
+        def decorator(func):
+            @wraps(func)
+            def wrapped(*args, **kwargs):
+                with self.timer(metric_name, sample_rate, tags, host):
+                    return func(*args, **kwargs)
+
+            return wrapped
+
+        return decorator
+
+    @contextmanager
+    def timer(self, metric_name, sample_rate=1, tags=None, host=None):
+        # Recorded as a `timing` call in seconds, like `ThreadStats.timer`.
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timing(
+                metric_name,
+                time.monotonic() - start,
+                tags=tags,
+                sample_rate=sample_rate,
+                host=host,
+            )
+
+    def event(self, *args, **kwargs):
+        self._record("event", args, kwargs)
+
+    def submit_many(self, points):
+        # Recorded like the separate calls `DataDog` would have made.
+        calls = []
+        for method, metric_name, value, tags, sample_rate in points:
+            kwargs = {"value": value, "tags": tags}
+            if sample_rate != 1:
+                kwargs["sample_rate"] = sample_rate
+            calls.append(RecordedCall(method, (metric_name,), kwargs))
+
+        with self._lock:
+            self.calls.extend(calls)
+
+
+def _return_unchanged(func):
+    return func
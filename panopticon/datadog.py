@@ -1,13 +1,61 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
+import os
 import time
 import atexit
-import datadog
+import random
+import inspect
+import importlib
+import contextvars
+import threading
 
-from functools import wraps
+from time import perf_counter_ns
+from functools import wraps, lru_cache
 
-from .compat import mock
-from . import PanopticonSettings
+from . import PanopticonSettings, get_setting
+from .clients import MetricPoint, NullStats
+from .sampling import AdaptiveSampler
+from .cardinality import CardinalityLimiter
+
+
+class EmissionStats(object):
+    """
+    Counters for the metrics emitted through `DataDog` and its handles.
+
+    The emission time is the time spent building a point and handing it to
+    the client, after the sampling decision. Counters are updated without a
+    lock, so concurrent threads can lose an update now and then.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.emitted = 0
+        self.sampled_out = 0
+        self.emission_time_ns = 0
+
+    def get_snapshot(self):
+        emitted = self.emitted
+        return {
+            "emitted": emitted,
+            "sampled_out": self.sampled_out,
+            "emission_time_ns": self.emission_time_ns,
+            "average_emission_time_ns": (
+                self.emission_time_ns / emitted if emitted else None
+            ),
+        }
+
+
+_emission_stats = EmissionStats()
+
+# The `ScopedTags` of the innermost `TagScope` entered in the current context.
+_scoped_tags = contextvars.ContextVar("panopticon_scoped_tags", default=None)
+
+# The `(tracker, start)` pairs of the `TimeTracker` blocks entered in the
+# current context, innermost last. Blocks in suspended generators can exit
+# out of order, so a tracker exits its own most recent block.
+_tracked_starts = contextvars.ContextVar("panopticon_tracked_starts", default=())
 
 
 class DataDog(object):
@@ -58,25 +106,75 @@ class DataDog(object):
     KEY_DATADOG_ENABLED = "DATADOG_STATS_ENABLED"
     KEY_DATADOG_STATS_PREFIX = "DATADOG_STATS_PREFIX"
     KEY_DATADOG_DEFAULT_TAGS = "DATADOG_DEFAULT_TAGS"
+    KEY_DATADOG_STATS_BACKEND = "DATADOG_STATS_BACKEND"
+    KEY_DATADOG_SAMPLING_BUDGET = "DATADOG_SAMPLING_BUDGET"
+    KEY_DATADOG_MAX_CONTEXTS_PER_METRIC = "DATADOG_MAX_CONTEXTS_PER_METRIC"
+    KEY_DATADOG_CARDINALITY_POLICY = "DATADOG_CARDINALITY_POLICY"
+    KEY_DATADOG_MAX_BUFFERED_CONTEXTS = "DATADOG_MAX_BUFFERED_CONTEXTS"
+    KEY_DATADOG_STATSD_HOST = "DATADOG_STATSD_HOST"
+    KEY_DATADOG_STATSD_PORT = "DATADOG_STATSD_PORT"
+    KEY_DATADOG_STATSD_SOCKET_PATH = "DATADOG_STATSD_SOCKET_PATH"
+    KEY_DATADOG_STATSD_MAX_PACKET_SIZE = "DATADOG_STATSD_MAX_PACKET_SIZE"
+    KEY_DATADOG_SHARED_MEMORY_PATH = "DATADOG_SHARED_MEMORY_PATH"
+    KEY_DATADOG_SHARED_MEMORY_SLOTS = "DATADOG_SHARED_MEMORY_SLOTS"
+    KEY_DATADOG_PROMETHEUS_BUCKETS = "DATADOG_PROMETHEUS_BUCKETS"
+
+    # Settings that are only used by some of the backends, they are stored
+    # in `settings` and passed on to the backend's `from_settings`.
+    BACKEND_SETTINGS_KEYS = (
+        KEY_DATADOG_STATSD_HOST,
+        KEY_DATADOG_STATSD_PORT,
+        KEY_DATADOG_STATSD_SOCKET_PATH,
+        KEY_DATADOG_STATSD_MAX_PACKET_SIZE,
+        KEY_DATADOG_SHARED_MEMORY_PATH,
+        KEY_DATADOG_SHARED_MEMORY_SLOTS,
+        KEY_DATADOG_MAX_BUFFERED_CONTEXTS,
+        KEY_DATADOG_PROMETHEUS_BUCKETS,
+    )
 
     # this is just the default
     STATS_ENABLED = False
     STATS_PREFIX = "panopticon"
+    STATS_BACKEND = "threadstats"
+
+    # The clients that can be selected with `DATADOG_STATS_BACKEND`. A backend
+    # can also be specified as the dotted path to a client class.
+    BACKENDS = {
+        "threadstats": "panopticon.threadstats.ThreadStats",
+        "aggregator": "panopticon.aggregator.Aggregator",
+        "dogstatsd": "panopticon.dogstatsd.DogStatsD",
+        "shared": "panopticon.shared.SharedMemoryAggregator",
+        "prometheus": "panopticon.prometheus.PrometheusExporter",
+        "recording": "panopticon.clients.RecordingStats",
+    }
 
     ROLLUP_INTERVAL = 10
     FLUSH_INTERVAL = 10
 
+    # The number of distinct per-call tag sets whose encoded form is cached.
+    TAG_CACHE_SIZE = 1024
+
     _stats_instance = None
+    # The process that created the client, a client inherited through a fork
+    # is replaced the first time it is used in the child process.
+    _stats_pid = None
+    _stats_lock = threading.Lock()
+    # `stop` is registered with atexit along with the first client, so that
+    # importing panopticon doesn't leave anything behind.
+    _atexit_registered = False
+    # Bumped whenever settings or the client change so that metric handles
+    # know when to resolve their name, tags and client again.
+    _generation = 0
+    _default_tags = {}
+    _encoded_default_tags = ()
+    _sampler = None
+    _limiter = None
+    emission_stats = _emission_stats
     settings = PanopticonSettings()
 
     @staticmethod
     def _get_value_for_key(settings, key, default=None):
-        try:
-            value = settings.get(key, default)
-        except AttributeError:
-            value = getattr(settings, key, default)
-
-        return value
+        return get_setting(settings, key, default)
 
     @classmethod
     def configure_settings(cls, settings, tags=None):
@@ -89,46 +187,123 @@ class DataDog(object):
         cls.STATS_PREFIX = cls._get_value_for_key(
             settings, cls.KEY_DATADOG_STATS_PREFIX, default=cls.STATS_PREFIX
         )
+        cls.STATS_BACKEND = cls._get_value_for_key(
+            settings, cls.KEY_DATADOG_STATS_BACKEND, default=cls.STATS_BACKEND
+        )
         cls._default_tags = tags or {}
 
         api_key = cls._get_value_for_key(settings, cls.KEY_DATADOG_API_KEY)
         cls.settings[cls.KEY_DATADOG_API_KEY] = api_key
 
+        budget = cls._get_value_for_key(settings, cls.KEY_DATADOG_SAMPLING_BUDGET)
+        cls._sampler = AdaptiveSampler(budget) if budget else None
+
+        for key in cls.BACKEND_SETTINGS_KEYS:
+            cls.settings[key] = cls._get_value_for_key(settings, key)
+
         default_tags = cls._get_value_for_key(settings, cls.KEY_DATADOG_DEFAULT_TAGS)
         cls._default_tags = default_tags or {}
         cls._default_tags.update(tags or {})
 
+        # The default tags are encoded once here instead of on every metric.
+        cls._encoded_default_tags = tuple(sorted(_tags_as_list(cls._default_tags)))
+        _encode_tags.cache_clear()
+
+        max_contexts = cls._get_value_for_key(
+            settings, cls.KEY_DATADOG_MAX_CONTEXTS_PER_METRIC
+        )
+        cls._limiter = None
+        if max_contexts:
+            cls._limiter = CardinalityLimiter(
+                int(max_contexts),
+                policy=cls._get_value_for_key(
+                    settings,
+                    cls.KEY_DATADOG_CARDINALITY_POLICY,
+                    default=CardinalityLimiter.DROP,
+                ),
+                default_tags=cls._encoded_default_tags,
+            )
+
+        cls._generation += 1
+
     @classmethod
     def stats(cls):
         """
-        Get the threaded datadog client (singleton): `datadog.ThreadStats`.
+        Get the threaded datadog client (singleton): `datadog.ThreadStats` or
+        the client selected by the `DATADOG_STATS_BACKEND` setting.
 
-        This will return a `mock.Mock` instance if the `DATADOG_ENABLED` setting
+        This will return a `NullStats` instance if the `DATADOG_ENABLED` setting
         is `False`. This makes it possible to run this in development without
         having to make any additional changes or conditional checks.
 
+        The client is created once per process, even if several threads ask
+        for it at the same time. A client that was created before the process
+        was forked, e.g. in the master process of gunicorn or uWSGI, is
+        dropped along with all its buffered points and replaced by a new one
+        in the child. The points are still sent by the parent, so they are
+        never counted twice.
+
         :return datadog.ThreadState
         """
-        if cls._stats_instance:
+        if cls._stats_instance is not None and cls._stats_pid == os.getpid():
             return cls._stats_instance
 
+        with cls._stats_lock:
+            if cls._stats_pid != os.getpid():
+                # The flush thread of an inherited client doesn't exist in
+                # this process, so we drop it without flushing.
+                cls._discard_inherited_client()
+
+            if cls._stats_instance is None:
+                cls._register_atexit()
+                cls._stats_instance = cls._create_client()
+                cls._stats_pid = os.getpid()
+                cls._generation += 1
+
+        return cls._stats_instance
+
+    @classmethod
+    def _create_client(cls):
         # If datadog is disabled by the Django setting DATADOG_ENABLED, we use
-        # a mock object instead of the actual datadog client. This makes it
-        # easier to switch it out without too much additional work and should
-        # be good enough for development.
+        # a client that doesn't do anything instead of the actual datadog
+        # client. This makes it easier to switch it out without too much
+        # additional work and costs next to nothing.
         api_key = cls.settings.get(cls.KEY_DATADOG_API_KEY, None)
-        if cls.STATS_ENABLED is False or not api_key:
-            cls._stats_instance = mock.Mock()
+        backend_class = cls._get_backend_class() if cls.STATS_ENABLED else None
+        requires_api_key = getattr(backend_class, "requires_api_key", True)
+
+        if cls.STATS_ENABLED is False or (requires_api_key and not api_key):
+            return NullStats()
+
+        if api_key:
+            # The datadog package is only loaded once metrics are sent.
+            import datadog
 
-        else:
             datadog.initialize(api_key=api_key)
 
-            cls._stats_instance = datadog.ThreadStats()
-            cls._stats_instance.start(
-                roll_up_interval=cls.ROLLUP_INTERVAL, flush_interval=cls.FLUSH_INTERVAL
-            )
+        factory = getattr(backend_class, "from_settings", None)
+        if factory:
+            client = factory(cls.settings)
+        else:
+            client = backend_class()
 
-        return cls._stats_instance
+        client.start(
+            roll_up_interval=cls.ROLLUP_INTERVAL, flush_interval=cls.FLUSH_INTERVAL
+        )
+
+        return client
+
+    @classmethod
+    def _register_atexit(cls):
+        if not cls._atexit_registered:
+            cls._atexit_registered = True
+            atexit.register(cls.stop)
+
+    @classmethod
+    def _get_backend_class(cls):
+        path = cls.BACKENDS.get(cls.STATS_BACKEND, cls.STATS_BACKEND)
+        module_name, class_name = path.rsplit(".", 1)
+        return getattr(importlib.import_module(module_name), class_name)
 
     @classmethod
     def get_metric_name(cls, *args):
@@ -143,27 +318,129 @@ class DataDog(object):
     def stop(cls):
         """
         Ensure that we flush all metrics before shutting down the client.
+
+        A client inherited from a parent process is dropped without flushing,
+        the parent is responsible for its metrics.
         """
-        if not cls._stats_instance:
+        with cls._stats_lock:
+            client, cls._stats_instance = cls._stats_instance, None
+            cls._generation += 1
+
+            if client is None or cls._stats_pid != os.getpid():
+                return
+
+            client.flush(time.time() + cls.ROLLUP_INTERVAL)
+
+            try:
+                client.stop()
+            except Exception:  # noqa
+                pass
+
+    @classmethod
+    def _after_fork_in_child(cls):
+        # The lock could have been held by another thread while forking, that
+        # thread doesn't exist in the child so it would never be released.
+        cls._stats_lock = threading.Lock()
+        cls.emission_stats.reset()
+        cls._discard_inherited_client()
+
+    @classmethod
+    def _discard_inherited_client(cls):
+        client, cls._stats_instance = cls._stats_instance, None
+        if client is None or cls._stats_pid == os.getpid():
             return
 
-        cls._stats_instance.flush(time.time() + cls.ROLLUP_INTERVAL)
+        # Handles resolved before the fork still hold on to the inherited
+        # client.
+        cls._generation += 1
+
+        # `datadog.ThreadStats` registers its own atexit hook that flushes
+        # its buffers, so the child would send the parent's points again when
+        # it exits. A disabled client doesn't flush and the buffered points
+        # are dropped.
+        if hasattr(client, "_metric_aggregator"):
+            client._disabled = True
+            client._metric_aggregator = type(client._metric_aggregator)(
+                client.roll_up_interval
+            )
+            client._event_aggregator = type(client._event_aggregator)()
 
-        try:
-            cls._stats_instance.stop()
-        except Exception:  # noqa
-            pass
+    @classmethod
+    def get_pipeline_stats(cls):
+        """
+        Get a snapshot of panopticon's own metrics: the number of points
+        emitted and dropped by sampling, the time spent per emission and, if
+        the client supports it (`get_stats`), its buffer size, flushed and
+        dropped points and flush latency.
+        """
+        client = cls.stats()
+
+        snapshot = cls.emission_stats.get_snapshot()
+        snapshot["backend"] = type(client).__name__
+
+        get_stats = getattr(client, "get_stats", None)
+        snapshot["client"] = get_stats() if get_stats is not None else {}
 
-        cls._stats_instance = None
+        if cls._limiter is not None:
+            snapshot["cardinality"] = cls._limiter.get_stats()
+
+        return snapshot
+
+    @classmethod
+    def counter(cls, metric_name, tags=None, sample_rate=1):
+        """
+        Get a `Counter` handle for `metric_name` with a fixed set of `tags`.
+
+        Handles can be created once, e.g. at module level, and resolve the
+        prefixed metric name, the encoded tags and the client only when they
+        are first used or the settings have changed::
+
+            requests_counter = DataDog.counter("requests", tags={"app": "web"})
+
+            requests_counter.increment()
+        """
+        return Counter(cls, metric_name, tags, sample_rate)
+
+    @classmethod
+    def timer(cls, metric_name, tags=None, sample_rate=1):
+        """
+        Get a `Timer` handle for `metric_name` with a fixed set of `tags`.
+        Timings are recorded as a histogram.
+        """
+        return Timer(cls, metric_name, tags, sample_rate)
 
     @classmethod
-    def track_time(cls, metric_name=None):
+    def histogram_handle(cls, metric_name, tags=None, sample_rate=1):
         """
-        A decorator that tracks execution time for any wrapped function.
+        Get a `Histogram` handle for `metric_name` with a fixed set of `tags`.
+        """
+        return Histogram(cls, metric_name, tags, sample_rate)
+
+    @classmethod
+    def track_time(cls, metric_name=None, tags=None, sample_rate=1, outcome=False):
+        """
+        Track the execution time of a function or a block of code.
+
+        As a decorator, the `metric_name` is optional and will default to the
+        function name. In both cases, the full metric name will include the
+        `DATADOG_STATS_PREFIX`. Coroutine functions are timed until the
+        coroutine finishes and generator functions until the generator is
+        exhausted or closed::
+
+            @DataDog.track_time
+            def update_index():
+                pass
 
-        The `metric_name` is optional and will default to the function name. In
-        both cases, they full metric name will include the
-        `DATADOG_STATS_PREFIX`.
+            @DataDog.track_time("fetch_user", tags={"source": "api"})
+            async def fetch_user(user_id):
+                pass
+
+            with DataDog.track_time("render", outcome=True):
+                pass
+
+        If `outcome` is set, timings are tagged with `outcome:success` or
+        `outcome:error` depending on whether an exception was raised. Only a
+        `sample_rate` share of the timings is recorded.
 
         To apply this decorator to a class' method, use the Django utility
         decorator `method_decorator`::
@@ -173,32 +450,187 @@ class DataDog(object):
 
             class SomeClass(object):
 
-                @method_decorator(DataDog.track_time)
+                @method_decorator(DataDog.track_time("method_to_wrap"))
                 def method_to_wrap(self, *args, **kwargs):
                     pass
 
         """
+        if callable(metric_name):
+            return TimeTracker(cls, None, tags, sample_rate, outcome)(metric_name)
 
-        def track_time_decorator(func):
-            name = metric_name or func.__name__
+        return TimeTracker(cls, metric_name, tags, sample_rate, outcome)
 
-            @wraps(func)
-            def wrapped_func(*args, **kwargs):
-                start = time.time()
-                result = func(*args, **kwargs)
-                request_time = time.time() - start
+    @classmethod
+    def tag_scope(cls, tags):
+        """
+        Add `tags` to every metric and event emitted within the scope, used
+        as a context manager or a decorator::
+
+            with DataDog.tag_scope({"tenant": tenant.slug}):
+                import_orders(tenant)
+
+            @DataDog.tag_scope({"job": "reindex"})
+            def reindex():
+                pass
+
+        Scopes can be nested, the inner scope adds its tags to those of the
+        outer one. They apply to the current thread or asyncio task and to
+        the tasks it creates, but not to other threads.
+        """
+        return TagScope(cls, tags)
+
+    @classmethod
+    def batch(cls, tags=None):
+        """
+        Collect several metrics and send them with `submit_many` at the end
+        of the block, e.g. when a job finishes::
+
+            with DataDog.batch(tags={"queue": "default"}) as batch:
+                batch.increment("jobs.finished")
+                batch.histogram("jobs.duration", duration)
+                batch.gauge("jobs.queue_size", queue_size)
+
+        `tags` are added to every metric of the batch.
+        """
+        return MetricBatch(cls, tags)
+
+    @classmethod
+    def submit_many(cls, points, tags=None):
+        """
+        Send several metrics at once. Each point is a tuple of the method
+        (`gauge`, `increment`, `decrement` or `histogram`), the metric name,
+        the value and optionally its own tags and sample rate::
+
+            DataDog.submit_many(
+                [
+                    ("increment", "jobs.finished", 1),
+                    ("histogram", "jobs.duration", duration, {"step": "fetch"}),
+                ],
+                tags={"queue": "default"},
+            )
+
+        The client is looked up and `tags` are converted once for all points.
+        Clients with a `submit_many` method get all points in one call, e.g.
+        the `aggregator` and `dogstatsd` backends then take their lock only
+        once. Other clients get a call per point.
+        """
+        client = cls.stats()
+        if isinstance(client, NullStats):
+            return
+
+        start = perf_counter_ns()
+
+        shared_tags = cls._convert_tags(tags)
+        limiter = cls._limiter
+
+        batch = []
+        for point in points:
+            method, metric_name, value = point[:3]
+            point_tags = point[3] if len(point) > 3 else None
+            sample_rate = point[4] if len(point) > 4 else 1
+
+            if method not in _BATCH_METHODS:
+                raise ValueError("unknown metric method {!r}".format(method))
+
+            if method == "histogram":
+                sample_rate = cls._get_histogram_sample_rate(
+                    client, metric_name, sample_rate
+                )
+            else:
+                sample_rate = cls._get_sample_rate(metric_name, sample_rate)
+            if not sample_rate:
+                continue
+
+            if sample_rate < 1 and method in _COUNTER_METHODS:
+                value = value / sample_rate
+                sample_rate = 1
+
+            encoded_tags = shared_tags
+            if point_tags:
+                encoded_tags = sorted(
+                    set(shared_tags).union(cls._convert_tags(point_tags))
+                )
+
+            if limiter is not None:
+                encoded_tags = limiter.check(metric_name, encoded_tags)
+                if encoded_tags is None:
+                    continue
+
+            batch.append(
+                MetricPoint(
+                    method,
+                    cls.get_metric_name(metric_name),
+                    value,
+                    encoded_tags,
+                    sample_rate,
+                )
+            )
+
+        if batch:
+            cls._submit_points(client, batch)
+
+        cls.emission_stats.emission_time_ns += perf_counter_ns() - start
+
+    @staticmethod
+    def _submit_points(client, points):
+        submit_many = getattr(client, "submit_many", None)
+        if submit_many is not None:
+            submit_many(points)
+            return
+
+        for method, metric_name, value, tags, sample_rate in points:
+            kwargs = {"sample_rate": sample_rate} if sample_rate != 1 else {}
+            getattr(client, method)(metric_name, value=value, tags=tags, **kwargs)
+
+    @classmethod
+    def _get_sample_rate(cls, metric_name, sample_rate):
+        """
+        Decide whether a point for `metric_name` is sampled. Returns the
+        effective sample rate, or `0` if the point should be dropped.
+
+        If `DATADOG_SAMPLING_BUDGET` is set, the sample rate is lowered
+        further for metrics that are emitted more often than the budget of
+        points per second allows.
+        """
+        if cls._sampler is not None:
+            sample_rate *= cls._sampler.get_sample_rate(metric_name)
 
-                metric_name = cls.get_metric_name(name)
-                cls.stats().histogram(metric_name, request_time)
+        if sample_rate < 1 and random.random() >= sample_rate:
+            cls.emission_stats.sampled_out += 1
+            return 0
 
-                return result
+        cls.emission_stats.emitted += 1
+        return sample_rate
 
-            return wrapped_func
+    @classmethod
+    def _get_histogram_sample_rate(cls, client, metric_name, sample_rate):
+        """
+        Like `_get_sample_rate`, for histograms sent to `client`.
+
+        Histograms can only be sampled if the client accounts for the sample
+        rate in their counts (`supports_sample_rate`), clients that ignore
+        it, like `datadog.ThreadStats`, would undercount them. Histograms
+        sent to those clients aren't sampled.
+        """
+        if getattr(client, "supports_sample_rate", False):
+            return cls._get_sample_rate(metric_name, sample_rate)
+
+        cls.emission_stats.emitted += 1
+        return 1
 
-        return track_time_decorator
+    @classmethod
+    def _get_tags(cls, metric_name, tags):
+        """
+        Convert `tags` and apply the cardinality limit of `metric_name`, if
+        one is configured. Returns `None` if the point should be dropped.
+        """
+        tags = cls._convert_tags(tags)
+        if cls._limiter is not None:
+            return cls._limiter.check(metric_name, tags)
+        return tags
 
     @classmethod
-    def _convert_tags(cls, tags):
+    def _convert_tags(cls, tags, scoped=True):
         """
         Convert tags, which may be a dict or iterable, into
         the DataDog format of a list of 'key:value' strings.
@@ -206,22 +638,45 @@ class DataDog(object):
         To make it easier to write test assertions that validate
         mock calls, the resulting list is sorted.
 
+        The encoded tags for a dict are cached (see `TAG_CACHE_SIZE`) so
+        emitting the same tags again is only a lookup and a copy.
+
+        Unless `scoped` is `False`, the tags of the current `tag_scope` are
+        added.
+
         Args:
             tags (Dict, Sequence):
 
         Returns:
             [str]
         """
-        converted_tags = _tags_as_list(cls._default_tags)
-        if isinstance(tags, dict):
-            converted_tags += _tags_as_list(tags)
+        scope = _scoped_tags.get() if scoped else None
+        if scope is None:
+            base_tags = cls._encoded_default_tags
         else:
-            converted_tags = list(tags)
+            base_tags = scope.get_base_tags(cls._encoded_default_tags)
 
-        return sorted(converted_tags)
+        if tags is None:
+            return list(base_tags)
+
+        if not isinstance(tags, dict):
+            if scope is None:
+                return sorted(tags)
+            return sorted(set(scope.tags).union(tags))
+
+        # Tag values that compare equal but format differently, e.g. `1` and
+        # `True`, must not share a cache entry. Passing the values as separate
+        # arguments to the typed cache makes their types part of the key.
+        try:
+            encoded_tags = _encode_tags(base_tags, tuple(tags), *tags.values())
+        except TypeError:
+            # unhashable tag values can't be cached
+            encoded_tags = sorted(base_tags + tuple(_tags_as_list(tags)))
+
+        return list(encoded_tags)
 
     @classmethod
-    def gauge(cls, metric_name, value, tags=None, **kwargs):
+    def gauge(cls, metric_name, value, tags=None, sample_rate=1, **kwargs):
         """
         Record a gauge value (for a gauge, the latest value within any one
         minute is the value stored).
@@ -230,16 +685,30 @@ class DataDog(object):
             metric_name (str): name of the metric to be stored
             value (int or float): the value of the metric
             tags (list or dict): miscellaneous tags to describe the value
+            sample_rate (float): the share of calls that is sent
         """
-        cls.stats().gauge(
-            cls.get_metric_name(metric_name),
-            value=value,
-            tags=cls._convert_tags(tags),
-            **kwargs
-        )
+        client = cls.stats()
+        if isinstance(client, NullStats):
+            return
+
+        sample_rate = cls._get_sample_rate(metric_name, sample_rate)
+        if not sample_rate:
+            return
+
+        start = perf_counter_ns()
+
+        if sample_rate < 1:
+            kwargs["sample_rate"] = sample_rate
+
+        tags = cls._get_tags(metric_name, tags)
+        if tags is None:
+            return
+
+        client.gauge(cls.get_metric_name(metric_name), value=value, tags=tags, **kwargs)
+        cls.emission_stats.emission_time_ns += perf_counter_ns() - start
 
     @classmethod
-    def increment(cls, metric_name, value=1, tags=None, **kwargs):
+    def increment(cls, metric_name, value=1, tags=None, sample_rate=1, **kwargs):
         """
         Increment a metric_name value (all the increments and decrements within
         a given minute are summed together).
@@ -248,16 +717,33 @@ class DataDog(object):
             metric_name (str): name of the metric to be incremented
             value (int or float): how much to increment the metric value
             tags (list or dict): miscellaneous tags to describe the value
+            sample_rate (float): the share of calls that is sent, the value
+                is scaled up to make up for the dropped calls
         """
-        cls.stats().increment(
-            cls.get_metric_name(metric_name),
-            value=value,
-            tags=cls._convert_tags(tags),
-            **kwargs
+        client = cls.stats()
+        if isinstance(client, NullStats):
+            return
+
+        sample_rate = cls._get_sample_rate(metric_name, sample_rate)
+        if not sample_rate:
+            return
+
+        start = perf_counter_ns()
+
+        if sample_rate < 1:
+            value = value / sample_rate
+
+        tags = cls._get_tags(metric_name, tags)
+        if tags is None:
+            return
+
+        client.increment(
+            cls.get_metric_name(metric_name), value=value, tags=tags, **kwargs
         )
+        cls.emission_stats.emission_time_ns += perf_counter_ns() - start
 
     @classmethod
-    def decrement(cls, metric_name, value=1, tags=None, **kwargs):
+    def decrement(cls, metric_name, value=1, tags=None, sample_rate=1, **kwargs):
         """
         Decrement a metric_name value (all the increments and decrements within
         a given minute are summed together).
@@ -266,16 +752,33 @@ class DataDog(object):
             metric_name (str): name of the metric to be decremented
             value (int or float): how much to decrement the metric value
             tags (list or dict): miscellaneous tags to describe the value
+            sample_rate (float): the share of calls that is sent, the value
+                is scaled up to make up for the dropped calls
         """
-        cls.stats().decrement(
-            cls.get_metric_name(metric_name),
-            value=value,
-            tags=cls._convert_tags(tags),
-            **kwargs
+        client = cls.stats()
+        if isinstance(client, NullStats):
+            return
+
+        sample_rate = cls._get_sample_rate(metric_name, sample_rate)
+        if not sample_rate:
+            return
+
+        start = perf_counter_ns()
+
+        if sample_rate < 1:
+            value = value / sample_rate
+
+        tags = cls._get_tags(metric_name, tags)
+        if tags is None:
+            return
+
+        client.decrement(
+            cls.get_metric_name(metric_name), value=value, tags=tags, **kwargs
         )
+        cls.emission_stats.emission_time_ns += perf_counter_ns() - start
 
     @classmethod
-    def histogram(cls, metric_name, value, tags=None, **kwargs):
+    def histogram(cls, metric_name, value, tags=None, sample_rate=1, **kwargs):
         """
         Send a histogram metric value. Histograms describe the distribution
         of the recorded values of a metric (minimum, maximum, average, count
@@ -285,13 +788,29 @@ class DataDog(object):
             metric_name (str): name of the metric to be stored
             value (int or float): the value of the metric
             tags (list or dict): miscellaneous tags to describe the value
+            sample_rate (float): the share of calls that is sent
         """
-        cls.stats().histogram(
-            cls.get_metric_name(metric_name),
-            value=value,
-            tags=cls._convert_tags(tags),
-            **kwargs
+        client = cls.stats()
+        if isinstance(client, NullStats):
+            return
+
+        sample_rate = cls._get_histogram_sample_rate(client, metric_name, sample_rate)
+        if not sample_rate:
+            return
+
+        start = perf_counter_ns()
+
+        if sample_rate < 1:
+            kwargs["sample_rate"] = sample_rate
+
+        tags = cls._get_tags(metric_name, tags)
+        if tags is None:
+            return
+
+        client.histogram(
+            cls.get_metric_name(metric_name), value=value, tags=tags, **kwargs
         )
+        cls.emission_stats.emission_time_ns += perf_counter_ns() - start
 
     @classmethod
     def event(cls, title, text, tags=None, **kwargs):
@@ -307,11 +826,459 @@ class DataDog(object):
                 MarkDown (see http://docs.datadoghq.com/guides/markdown/ )
             tags (list or dict): miscellaneous tags to describe the value
         """
-        cls.stats().event(title, text, tags=cls._convert_tags(tags), **kwargs)
+        client = cls.stats()
+        if isinstance(client, NullStats):
+            return
+
+        client.event(title, text, tags=cls._convert_tags(tags), **kwargs)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=DataDog._after_fork_in_child)
+
+
+class MetricHandle(object):
+    """
+    A metric bound to a name and a fixed set of tags. Use the `DataDog`
+    factory methods, e.g. `DataDog.counter`, to create handles.
+
+    Resolving the prefixed metric name, the encoded tags and the client is
+    done once and only repeated if `DataDog` has been reconfigured, the
+    client has changed or the process has been forked since. Additional
+    tags can be passed when recording a value, they are merged with the tags
+    of the handle.
+
+    Values are sampled with `sample_rate` unless a different sample rate is
+    passed when recording a value.
+    """
+
+    def __init__(self, datadog, metric_name, tags=None, sample_rate=1):
+        self.datadog = datadog
+        self.metric_name = metric_name
+        self.tags = tags
+        self.sample_rate = sample_rate
+
+        self._generation = None
+        self._pid = None
+        self._name = None
+        self._tags = None
+        self._client = None
+        self._enabled = False
+
+    def _resolve(self):
+        datadog = self.datadog
+
+        self._client = datadog.stats()
+        self._enabled = not isinstance(self._client, NullStats)
+
+        if self._enabled:
+            self._name = datadog.get_metric_name(self.metric_name)
+            # Scoped tags are added when a value is recorded.
+            self._tags = datadog._convert_tags(self.tags, scoped=False)
+
+        self._generation = datadog._generation
+        # The fork hooks don't run for every fork, e.g. not for `os.fork`
+        # called from C extensions, so the process is checked too.
+        self._pid = os.getpid()
+
+    def _sample(self, sample_rate):
+        if sample_rate is None:
+            sample_rate = self.sample_rate
+        return self.datadog._get_sample_rate(self.metric_name, sample_rate)
+
+    def _get_tags(self, tags):
+        if tags is None:
+            scope = _scoped_tags.get()
+            tags = self._tags if scope is None else scope.merge(self._tags)
+        else:
+            tags = sorted(set(self._tags).union(self.datadog._convert_tags(tags)))
+
+        limiter = self.datadog._limiter
+        if limiter is not None:
+            return limiter.check(self.metric_name, tags)
+        return tags
+
+
+class Counter(MetricHandle):
+    def increment(self, value=1, tags=None, sample_rate=None, **kwargs):
+        if self._generation != self.datadog._generation or self._pid != os.getpid():
+            self._resolve()
+
+        if not self._enabled:
+            return
+
+        sample_rate = self._sample(sample_rate)
+        if not sample_rate:
+            return
+
+        start = perf_counter_ns()
+
+        if sample_rate < 1:
+            value = value / sample_rate
+
+        tags = self._get_tags(tags)
+        if tags is None:
+            return
+
+        self._client.increment(self._name, value=value, tags=tags, **kwargs)
+        self.datadog.emission_stats.emission_time_ns += perf_counter_ns() - start
+
+    def decrement(self, value=1, tags=None, sample_rate=None, **kwargs):
+        if self._generation != self.datadog._generation or self._pid != os.getpid():
+            self._resolve()
+
+        if not self._enabled:
+            return
 
+        sample_rate = self._sample(sample_rate)
+        if not sample_rate:
+            return
+
+        start = perf_counter_ns()
+
+        if sample_rate < 1:
+            value = value / sample_rate
+
+        tags = self._get_tags(tags)
+        if tags is None:
+            return
 
-atexit.register(DataDog.stop)
+        self._client.decrement(self._name, value=value, tags=tags, **kwargs)
+        self.datadog.emission_stats.emission_time_ns += perf_counter_ns() - start
+
+
+class Histogram(MetricHandle):
+    def record(self, value, tags=None, sample_rate=None, **kwargs):
+        if self._generation != self.datadog._generation or self._pid != os.getpid():
+            self._resolve()
+
+        if not self._enabled:
+            return
+
+        if sample_rate is None:
+            sample_rate = self.sample_rate
+        sample_rate = self.datadog._get_histogram_sample_rate(
+            self._client, self.metric_name, sample_rate
+        )
+        if not sample_rate:
+            return
+
+        start = perf_counter_ns()
+
+        if sample_rate < 1:
+            kwargs["sample_rate"] = sample_rate
+
+        tags = self._get_tags(tags)
+        if tags is None:
+            return
+
+        self._client.histogram(self._name, value, tags=tags, **kwargs)
+        self.datadog.emission_stats.emission_time_ns += perf_counter_ns() - start
+
+
+class Timer(Histogram):
+    """
+    A histogram of durations in seconds.
+    """
+
+
+class TimeTracker(object):
+    """
+    Records durations with a `Timer` as a decorator or a context manager,
+    see `DataDog.track_time`.
+
+    The timers are created when the metric name is known, i.e. when the
+    tracker is created or when it decorates a function, so timing a call
+    doesn't do more than reading `perf_counter_ns` twice and recording the
+    value. The tracker can be shared by threads and tasks and used
+    re-entrantly, the start times of `with` blocks are kept in a context
+    variable shared by all trackers.
+    """
+
+    SUCCESS = "success"
+    ERROR = "error"
+
+    def __init__(
+        self, datadog, metric_name=None, tags=None, sample_rate=1, outcome=False
+    ):
+        self.datadog = datadog
+        self.metric_name = metric_name
+        self.tags = tags
+        self.sample_rate = sample_rate
+        self.outcome = outcome
+
+        self._success_timer = self._error_timer = None
+        if metric_name is not None:
+            self._create_timers(metric_name)
+
+    def __call__(self, func):
+        tracker = self
+        if self._success_timer is None:
+            tracker = TimeTracker(
+                self.datadog, func.__name__, self.tags, self.sample_rate, self.outcome
+            )
+
+        if inspect.iscoroutinefunction(func):
+            return tracker._wrap_coroutine_function(func)
+        if inspect.isgeneratorfunction(func):
+            return tracker._wrap_generator_function(func)
+        return tracker._wrap_function(func)
+
+    def __enter__(self):
+        if self._success_timer is None:
+            raise ValueError("a metric name is required to time a block")
+
+        _tracked_starts.set(_tracked_starts.get() + ((self, perf_counter_ns()),))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        starts = list(_tracked_starts.get())
+
+        index = len(starts) - 1
+        while index >= 0 and starts[index][0] is not self:
+            index -= 1
+        if index < 0:
+            # The block was entered in another context, e.g. by a generator
+            # that is closed in another thread, so its duration is unknown.
+            return
+
+        _, start = starts.pop(index)
+        _tracked_starts.set(tuple(starts))
+
+        timer = self._error_timer if exc_type else self._success_timer
+        timer.record((perf_counter_ns() - start) / 1e9)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.__exit__(exc_type, exc_value, traceback)
+
+    def _create_timers(self, metric_name):
+        if not self.outcome:
+            timer = self.datadog.timer(metric_name, self.tags, self.sample_rate)
+            self._success_timer = self._error_timer = timer
+            return
+
+        self._success_timer = self.datadog.timer(
+            metric_name, _add_tag(self.tags, "outcome", self.SUCCESS), self.sample_rate
+        )
+        self._error_timer = self.datadog.timer(
+            metric_name, _add_tag(self.tags, "outcome", self.ERROR), self.sample_rate
+        )
+
+    def _wrap_function(self, func):
+        success_timer, error_timer = self._success_timer, self._error_timer
+
+        @wraps(func)
+        def wrapped_func(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                error_timer.record((perf_counter_ns() - start) / 1e9)
+                raise
+
+            success_timer.record((perf_counter_ns() - start) / 1e9)
+            return result
+
+        return wrapped_func
+
+    def _wrap_coroutine_function(self, func):
+        success_timer, error_timer = self._success_timer, self._error_timer
+
+        @wraps(func)
+        async def wrapped_func(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                error_timer.record((perf_counter_ns() - start) / 1e9)
+                raise
+
+            success_timer.record((perf_counter_ns() - start) / 1e9)
+            return result
+
+        return wrapped_func
+
+    def _wrap_generator_function(self, func):
+        success_timer, error_timer = self._success_timer, self._error_timer
+
+        @wraps(func)
+        def wrapped_func(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                result = yield from func(*args, **kwargs)
+            except GeneratorExit:
+                # The consumer stopped early, which isn't an error.
+                success_timer.record((perf_counter_ns() - start) / 1e9)
+                raise
+            except Exception:
+                error_timer.record((perf_counter_ns() - start) / 1e9)
+                raise
+
+            success_timer.record((perf_counter_ns() - start) / 1e9)
+            return result
+
+        return wrapped_func
+
+
+class MetricBatch(object):
+    """
+    Collects metrics and sends them with `DataDog.submit_many` when the
+    `with` block ends or `submit` is called, see `DataDog.batch`.
+
+    Recording a value only appends it to a list, nothing is built or sent
+    until the batch is submitted. A batch isn't meant to be shared by
+    threads.
+    """
+
+    def __init__(self, datadog, tags=None):
+        self.datadog = datadog
+        self.tags = tags
+        self.points = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Metrics recorded before an exception are still sent.
+        self.submit()
+
+    def gauge(self, metric_name, value, tags=None, sample_rate=1):
+        self.points.append(("gauge", metric_name, value, tags, sample_rate))
+
+    def increment(self, metric_name, value=1, tags=None, sample_rate=1):
+        self.points.append(("increment", metric_name, value, tags, sample_rate))
+
+    def decrement(self, metric_name, value=1, tags=None, sample_rate=1):
+        self.points.append(("decrement", metric_name, value, tags, sample_rate))
+
+    def histogram(self, metric_name, value, tags=None, sample_rate=1):
+        self.points.append(("histogram", metric_name, value, tags, sample_rate))
+
+    def submit(self):
+        points, self.points = self.points, []
+        if points:
+            self.datadog.submit_many(points, self.tags)
+
+
+class TagScope(object):
+    """
+    Adds tags to the metrics emitted within a `with` block or a decorated
+    function, see `DataDog.tag_scope`.
+
+    The tags are merged with those of the enclosing scope and encoded once
+    when the scope is entered, metrics only look them up. The active scope
+    is kept in a context variable, so a scope can be shared by threads and
+    tasks and used re-entrantly.
+    """
+
+    def __init__(self, datadog, tags):
+        self.datadog = datadog
+        self.tags = tags
+
+    def __call__(self, func):
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def wrapped_func(*args, **kwargs):
+                with self:
+                    return await func(*args, **kwargs)
+
+        else:
+
+            @wraps(func)
+            def wrapped_func(*args, **kwargs):
+                with self:
+                    return func(*args, **kwargs)
+
+        return wrapped_func
+
+    def __enter__(self):
+        parent = _scoped_tags.get()
+
+        tags = set(parent.tags) if parent is not None else set()
+        if isinstance(self.tags, dict):
+            tags.update(_tags_as_list(self.tags))
+        elif self.tags:
+            tags.update(self.tags)
+
+        _scoped_tags.set(
+            ScopedTags(tuple(sorted(tags)), parent, self.datadog._encoded_default_tags)
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        scoped_tags = _scoped_tags.get()
+        _scoped_tags.set(scoped_tags.parent if scoped_tags is not None else None)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.__exit__(exc_type, exc_value, traceback)
+
+
+class ScopedTags(object):
+    """
+    The encoded tags of an entered `TagScope`, including those of enclosing
+    scopes.
+    """
+
+    __slots__ = ("tags", "parent", "_base_tags", "_merged")
+
+    def __init__(self, tags, parent, default_tags):
+        self.tags = tags
+        self.parent = parent
+
+        # (default tags, default tags with the scoped tags)
+        self._base_tags = (
+            default_tags,
+            tuple(sorted(set(default_tags).union(tags))),
+        )
+        # the tags of metric handles, merged with the scoped tags
+        self._merged = {}
+
+    def get_base_tags(self, default_tags):
+        """
+        Get the scoped tags combined with `default_tags`, which are only
+        merged again if the default tags have changed since.
+        """
+        base_tags = self._base_tags
+        if base_tags[0] is not default_tags:
+            base_tags = self._base_tags = (
+                default_tags,
+                tuple(sorted(set(default_tags).union(self.tags))),
+            )
+        return base_tags[1]
+
+    def merge(self, tags):
+        key = tuple(tags)
+
+        merged = self._merged.get(key)
+        if merged is None:
+            merged = self._merged[key] = sorted(set(tags).union(self.tags))
+        return merged
+
+
+_BATCH_METHODS = frozenset(("gauge", "increment", "decrement", "histogram"))
+_COUNTER_METHODS = frozenset(("increment", "decrement"))
+
+
+def _add_tag(tags, key, value):
+    if tags is None:
+        return {key: value}
+    if isinstance(tags, dict):
+        return dict(tags, **{key: value})
+    return list(tags) + ["{}:{}".format(key, value)]
 
 
 def _tags_as_list(tags: dict):
     return ["{}:{}".format(key, value) for key, value in tags.items()]
+
+
+@lru_cache(maxsize=DataDog.TAG_CACHE_SIZE, typed=True)
+def _encode_tags(encoded_default_tags, keys, *values):
+    encoded = ["{}:{}".format(key, value) for key, value in zip(keys, values)]
+    return tuple(sorted(encoded_default_tags + tuple(encoded)))
@@ -17,5 +17,9 @@ class PanopticonConfig(AppConfig):
 
         from django.conf import settings
         from panopticon.datadog import DataDog
+        from panopticon.events import EventPipeline
+        from panopticon.health import HealthCheck
 
         DataDog.configure_settings(settings)
+        EventPipeline.configure_settings(settings)
+        HealthCheck.configure_settings(settings)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+from rest_framework import status
+from rest_framework.views import APIView
+from rest_framework.response import Response
+
+from ..health import HealthCheck
+
+
+class HealthCheckView(APIView):
+    """
+    Serve the health check result through django-rest-framework. Use
+    `panopticon.django.views.HealthView` unless DRF's content negotiation
+    or renderers are needed, it doesn't import DRF at all.
+    """
+
+    permission_classes = []
+
+    # The health check profile served by the view, e.g. `HealthCheck.LIVENESS`.
+    # All health checks are run if it's not set.
+    profile = None
+
+    def get(self, request, *args, **kwargs):
+        result = HealthCheck.get_result(self.profile)
+
+        status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+
+        if result.is_healthy:
+            status_code = status.HTTP_200_OK
+
+        return Response(result.data, status=status_code)
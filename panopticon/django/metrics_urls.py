@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+from django.urls import re_path
+
+from .views import MetricsView
+
+urlpatterns = [re_path(r"^metrics/$", MetricsView.as_view(), name="metrics")]
@@ -1,8 +1,22 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
 import time
+import asyncio
 
+from time import perf_counter_ns
+
+from django.conf import settings
+from django.urls import Resolver404, resolve
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    iscoroutinefunction = asyncio.iscoroutinefunction
+    markcoroutinefunction = None
+
+from panopticon import get_setting
 from panopticon.datadog import DataDog
+from panopticon.events import EventPipeline
 
 
 class DataDogMiddleware(object):
@@ -18,8 +32,32 @@ class DataDogMiddleware(object):
     DD_REQUESTS_FAILED = "requests.failed"
     DD_REQUESTS_SUCCESSFUL = "requests.successful"
 
+    KEY_DATADOG_REQUESTS_SAMPLE_RATE = "DATADOG_REQUESTS_SAMPLE_RATE"
+
+    SAMPLE_RATE = 1
+
     def __init__(self):
-        self.stats = DataDog.stats()
+        sample_rate = float(
+            get_setting(
+                settings, self.KEY_DATADOG_REQUESTS_SAMPLE_RATE, self.SAMPLE_RATE
+            )
+        )
+
+        self.requests_time = DataDog.histogram_handle(
+            self.DD_REQUESTS_TIME, sample_rate=sample_rate
+        )
+        self.requests_failed = DataDog.counter(
+            self.DD_REQUESTS_FAILED, sample_rate=sample_rate
+        )
+        self.requests_successful = DataDog.counter(
+            self.DD_REQUESTS_SUCCESSFUL, sample_rate=sample_rate
+        )
+
+    @property
+    def stats(self):
+        # The client is looked up on every use instead of being kept around,
+        # a client created before forking would be useless in the worker.
+        return DataDog.stats()
 
     def process_request(self, request):
         setattr(request, self.DD_REQUEST_START_ATTRIBUTE, time.time())
@@ -31,31 +69,178 @@ class DataDogMiddleware(object):
         start_time = getattr(request, self.DD_REQUEST_START_ATTRIBUTE)
         request_time = time.time() - start_time
 
-        self.stats.histogram(
-            DataDog.get_metric_name(self.DD_REQUESTS_TIME),
-            int(request_time * 1000),  # report in milliseconds
-            tags=self._get_metric_tags(request),
-        )
+        tags = self._get_metric_tags(request)
 
-        metric_name = DataDog.get_metric_name(self.DD_REQUESTS_SUCCESSFUL)
-        self.stats.increment(metric_name, tags=self._get_metric_tags(request))
+        # report in milliseconds
+        self.requests_time.record(int(request_time * 1000), tags=tags)
+        self.requests_successful.increment(tags=tags)
 
         return response
 
     def process_exception(self, request, exception):
         title = "Exception occured at {}".format(request.path)
 
-        self.stats.event(
-            title=title,
-            text=str(exception),
+        EventPipeline.get_pipeline().send(
+            title, str(exception), aggregation_key=request.path, alert_type="error"
+        )
+
+        self.requests_failed.increment(tags=self._get_metric_tags(request))
+
+    def _get_metric_tags(self, request):
+        return ["path:{}".format(request.path)]
+
+
+class RequestMetricsMiddleware(object):
+    """
+    A `MIDDLEWARE` compatible replacement for `DataDogMiddleware` that works
+    with both WSGI and ASGI.
+
+    Requests are tagged with the route they were resolved to, i.e. the URL
+    name or pattern (`route:orders:detail` rather than `path:/orders/123/`),
+    and the class of the response status (`status_class:2xx`), which keeps
+    the number of tag combinations bounded. Requests that didn't match any
+    route are tagged with `route:unresolved`.
+
+    A set of metric handles is created for each combination of route and
+    status class, so their tags are only built once. Durations are measured
+    with `perf_counter_ns`.
+
+    With `DATADOG_REQUESTS_TAG_SCOPE`, the route tag is also added to all
+    metrics and events emitted while the request is handled (see
+    `DataDog.tag_scope`). The URL is resolved before the view runs for that.
+
+    When the middleware chain is async, the middleware runs as a coroutine
+    and doesn't make Django switch to a thread for it.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    DD_REQUESTS_TIME = DataDogMiddleware.DD_REQUESTS_TIME
+    DD_REQUESTS_FAILED = DataDogMiddleware.DD_REQUESTS_FAILED
+    DD_REQUESTS_SUCCESSFUL = DataDogMiddleware.DD_REQUESTS_SUCCESSFUL
+
+    KEY_DATADOG_REQUESTS_SAMPLE_RATE = (
+        DataDogMiddleware.KEY_DATADOG_REQUESTS_SAMPLE_RATE
+    )
+    KEY_DATADOG_REQUESTS_TAG_SCOPE = "DATADOG_REQUESTS_TAG_SCOPE"
+
+    SAMPLE_RATE = DataDogMiddleware.SAMPLE_RATE
+    # Add the route tag to all metrics emitted while handling the request.
+    TAG_SCOPE = False
+    UNRESOLVED_ROUTE = "unresolved"
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = float(
+            get_setting(
+                settings, self.KEY_DATADOG_REQUESTS_SAMPLE_RATE, self.SAMPLE_RATE
+            )
+        )
+        self.tag_scope = get_setting(
+            settings, self.KEY_DATADOG_REQUESTS_TAG_SCOPE, self.TAG_SCOPE
+        )
+
+        self._handles = {}
+        self._failed_handles = {}
+
+        self._is_async = iscoroutinefunction(get_response)
+        if self._is_async:
+            if markcoroutinefunction is not None:
+                markcoroutinefunction(self)
+            else:
+                self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self._is_async:
+            return self.__acall__(request)
+
+        start = perf_counter_ns()
+        if self.tag_scope:
+            with self._get_tag_scope(request):
+                response = self.get_response(request)
+        else:
+            response = self.get_response(request)
+        self._record(request, response, start)
+
+        return response
+
+    async def __acall__(self, request):
+        start = perf_counter_ns()
+        if self.tag_scope:
+            with self._get_tag_scope(request):
+                response = await self.get_response(request)
+        else:
+            response = await self.get_response(request)
+        self._record(request, response, start)
+
+        return response
+
+    def process_exception(self, request, exception):
+        EventPipeline.get_pipeline().send(
+            "Exception occured at {}".format(request.path),
+            str(exception),
             aggregation_key=request.path,
             alert_type="error",
         )
 
-        self.stats.increment(
-            DataDog.get_metric_name(self.DD_REQUESTS_FAILED),
-            tags=self._get_metric_tags(request),
+        route = self._get_route(request)
+        counter = self._failed_handles.get(route)
+        if counter is None:
+            counter = self._failed_handles[route] = DataDog.counter(
+                self.DD_REQUESTS_FAILED,
+                tags=["route:{}".format(route)],
+                sample_rate=self.sample_rate,
+            )
+
+        counter.increment()
+
+    def _record(self, request, response, start):
+        key = (self._get_route(request), "{}xx".format(response.status_code // 100))
+
+        handles = self._handles.get(key)
+        if handles is None:
+            handles = self._handles[key] = self._create_handles(*key)
+
+        requests_time, requests_successful = handles
+
+        # report in milliseconds
+        requests_time.record((perf_counter_ns() - start) // 1000000)
+        requests_successful.increment()
+
+    def _create_handles(self, route, status_class):
+        tags = ["route:{}".format(route), "status_class:{}".format(status_class)]
+
+        return (
+            DataDog.histogram_handle(
+                self.DD_REQUESTS_TIME, tags=tags, sample_rate=self.sample_rate
+            ),
+            DataDog.counter(
+                self.DD_REQUESTS_SUCCESSFUL, tags=tags, sample_rate=self.sample_rate
+            ),
         )
 
-    def _get_metric_tags(self, request):
-        return ["path:{}".format(request.path)]
+    def _get_tag_scope(self, request):
+        return DataDog.tag_scope(["route:{}".format(self._get_route(request, True))])
+
+    def _get_route(self, request, resolve_url=False):
+        resolver_match = getattr(request, "resolver_match", None)
+        if resolver_match is None and resolve_url:
+            # Django resolves the URL after the middleware chain was entered,
+            # with the urlconf set on the request by earlier middleware.
+            try:
+                resolver_match = resolve(
+                    request.path_info, getattr(request, "urlconf", None)
+                )
+            except Resolver404:
+                pass
+
+        if resolver_match is None:
+            return self.UNRESOLVED_ROUTE
+
+        # Unnamed URLs are tagged with their pattern instead of the dotted
+        # path of the view.
+        if resolver_match.url_name:
+            return resolver_match.view_name
+
+        return getattr(resolver_match, "route", None) or resolver_match.view_name
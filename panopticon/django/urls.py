@@ -1,8 +1,22 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
-from django.conf.urls import url
+from django.urls import re_path
 
-from .views import HealthCheckView
+from ..health import HealthCheck
+from .views import HealthView
 
+app_name = "panopticon"
 
-urlpatterns = [url(r"^healthcheck/$", HealthCheckView.as_view(), name="healthcheck")]
+urlpatterns = [
+    re_path(r"^healthcheck/$", HealthView.as_view(), name="healthcheck"),
+    re_path(
+        r"^healthcheck/live/$",
+        HealthView.as_view(profile=HealthCheck.LIVENESS),
+        name="healthcheck-live",
+    ),
+    re_path(
+        r"^healthcheck/ready/$",
+        HealthView.as_view(profile=HealthCheck.READINESS),
+        name="healthcheck-ready",
+    ),
+]
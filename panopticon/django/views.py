@@ -1,22 +1,61 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
-from rest_framework import status
-from rest_framework.views import APIView
-from rest_framework.response import Response
+from django.http import Http404, HttpResponse
+from django.views import View
 
-from ..health import HealthCheck
+from ..datadog import DataDog
+from ..web import get_responder
 
 
-class HealthCheckView(APIView):
-    permission_classes = []
+class HealthView(View):
+    """
+    Serve the health check result as JSON without going through DRF.
+
+    The encoded response is reused while the result doesn't change and
+    requests with a matching `If-None-Match` header get a `304`.
+    """
+
+    # The health check profile served by the view, e.g. `HealthCheck.LIVENESS`.
+    # All health checks are run if it's not set.
+    profile = None
+
+    def get(self, request, *args, **kwargs):
+        responder = get_responder(self.profile)
+        status_code, headers, body = responder.get_response(
+            responder.get_result(), request.META.get("HTTP_IF_NONE_MATCH")
+        )
+
+        response = HttpResponse(body, status=status_code)
+        for name, value in headers:
+            response[name] = value
+
+        return response
+
+
+class MetricsView(View):
+    """
+    Serve the metrics of the `prometheus` backend for Prometheus to scrape.
+
+    Responds with a `404` if a different backend is used or metrics are
+    disabled.
+    """
 
     def get(self, request, *args, **kwargs):
-        health_check = HealthCheck()
-        result = health_check.run()
+        client = DataDog.stats()
+
+        render = getattr(client, "render", None)
+        if render is None:
+            raise Http404("metrics aren't exported for scraping")
+
+        return HttpResponse(render(), content_type=client.CONTENT_TYPE)
+
 
-        status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+def __getattr__(name):
+    # `HealthCheckView` moved to `drf_views`, it's only imported from there
+    # when it's used so that the health check URLs never load DRF.
+    if name == "HealthCheckView":
+        from .drf_views import HealthCheckView
 
-        if result.is_healthy:
-            status_code = status.HTTP_200_OK
+        return HealthCheckView
 
-        return Response(result.data, status=status_code)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
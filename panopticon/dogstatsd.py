@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import socket
+import logging
+import threading
+
+log = logging.getLogger("panopticon.dogstatsd")
+
+
+class DogStatsD(object):
+    """
+    A client that sends metrics and events to a local DataDog agent using the
+    DogStatsD protocol over UDP or a Unix datagram socket.
+
+    Instead of sending a datagram per metric, lines are packed into a buffer
+    and sent once the next line wouldn't fit into `max_packet_size` bytes.
+    Anything left in the buffer is sent every `flush_interval` seconds by a
+    background thread and when calling `flush`.
+
+    The agent does the aggregation and talks to the DataDog API, so the
+    client doesn't need an API key.
+
+    `get_stats` returns counters for the lines added and the packets sent
+    and dropped.
+    """
+
+    requires_api_key = False
+    # The agent scales the counts of sampled histograms.
+    supports_sample_rate = True
+
+    # The default fits a single IPv4 datagram into an ethernet frame, for
+    # Unix sockets a much larger size (e.g. 8192) can be used.
+    MAX_PACKET_SIZE = 1432
+
+    # The DogStatsD type of each method of `MetricPoint`s.
+    METRIC_TYPES = {"gauge": "g", "increment": "c", "decrement": "c", "histogram": "h"}
+
+    def __init__(
+        self,
+        host="localhost",
+        port=8125,
+        socket_path=None,
+        max_packet_size=MAX_PACKET_SIZE,
+        flush_interval=1,
+    ):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.max_packet_size = max_packet_size
+        self.flush_interval = flush_interval
+
+        self._socket = None
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+
+        # updated while holding `_lock`
+        self.lines = 0
+        self.packets = 0
+        self.bytes_sent = 0
+        self.dropped_packets = 0
+        self.last_send_failed = False
+
+        self._stop_event = threading.Event()
+        self._flush_thread = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Create a client from the settings stored by
+        `DataDog.configure_settings`.
+        """
+        from .datadog import DataDog
+
+        return cls(
+            host=settings.get(DataDog.KEY_DATADOG_STATSD_HOST) or "localhost",
+            port=int(settings.get(DataDog.KEY_DATADOG_STATSD_PORT) or 8125),
+            socket_path=settings.get(DataDog.KEY_DATADOG_STATSD_SOCKET_PATH),
+            max_packet_size=int(
+                settings.get(DataDog.KEY_DATADOG_STATSD_MAX_PACKET_SIZE)
+                or cls.MAX_PACKET_SIZE
+            ),
+        )
+
+    def start(self, **kwargs):
+        if self._flush_thread and self._flush_thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._flush_thread = threading.Thread(
+            target=self._flush_periodically, name="panopticon-dogstatsd"
+        )
+        self._flush_thread.daemon = True
+        self._flush_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+        if self._flush_thread:
+            self._flush_thread.join()
+            self._flush_thread = None
+
+        self.flush()
+
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+
+    def gauge(self, metric_name, value, tags=None, sample_rate=1, **kwargs):
+        self._add_line(metric_name, value, "g", tags, sample_rate)
+
+    def increment(self, metric_name, value=1, tags=None, sample_rate=1, **kwargs):
+        self._add_line(metric_name, value, "c", tags, sample_rate)
+
+    def decrement(self, metric_name, value=1, tags=None, sample_rate=1, **kwargs):
+        self._add_line(metric_name, -value, "c", tags, sample_rate)
+
+    def histogram(self, metric_name, value, tags=None, sample_rate=1, **kwargs):
+        self._add_line(metric_name, value, "h", tags, sample_rate)
+
+    def distribution(self, metric_name, value, tags=None, sample_rate=1, **kwargs):
+        self._add_line(metric_name, value, "d", tags, sample_rate)
+
+    def timing(self, metric_name, value, tags=None, sample_rate=1, **kwargs):
+        self._add_line(metric_name, value, "ms", tags, sample_rate)
+
+    def event(
+        self,
+        title,
+        text,
+        tags=None,
+        alert_type=None,
+        aggregation_key=None,
+        source_type_name=None,
+        date_happened=None,
+        priority=None,
+        host=None,
+        **kwargs
+    ):
+        text = (text or "").replace("\n", "\\n")
+        # The agent expects the lengths in bytes, not characters.
+        line = "_e{{{},{}}}:{}|{}".format(
+            len(title.encode("utf-8")), len(text.encode("utf-8")), title, text
+        )
+
+        for prefix, value in (
+            ("d", date_happened),
+            ("h", host),
+            ("k", aggregation_key),
+            ("p", priority),
+            ("s", source_type_name),
+            ("t", alert_type),
+        ):
+            if value:
+                line += "|{}:{}".format(prefix, value)
+
+        if tags:
+            line += "|#" + ",".join(tags)
+
+        self._add(line.encode("utf-8"))
+
+    def submit_many(self, points):
+        """
+        Add the lines for several `MetricPoint`s, taking the lock once.
+        """
+        lines = []
+        for method, metric_name, value, tags, sample_rate in points:
+            if method == "decrement":
+                value = -value
+            lines.append(
+                self._format_line(
+                    metric_name, value, self.METRIC_TYPES[method], tags, sample_rate
+                )
+            )
+
+        with self._lock:
+            for line in lines:
+                self._append(line)
+
+    def _add_line(self, metric_name, value, metric_type, tags, sample_rate):
+        self._add(self._format_line(metric_name, value, metric_type, tags, sample_rate))
+
+    @staticmethod
+    def _format_line(metric_name, value, metric_type, tags, sample_rate):
+        # Each line is formatted and encoded in one go and then copied into
+        # the packet buffer, nothing else is allocated per metric.
+        if tags:
+            if sample_rate != 1:
+                line = "{}:{}|{}|@{}|#{}".format(
+                    metric_name, value, metric_type, sample_rate, ",".join(tags)
+                )
+            else:
+                line = "{}:{}|{}|#{}".format(
+                    metric_name, value, metric_type, ",".join(tags)
+                )
+        elif sample_rate != 1:
+            line = "{}:{}|{}|@{}".format(metric_name, value, metric_type, sample_rate)
+        else:
+            line = "{}:{}|{}".format(metric_name, value, metric_type)
+
+        return line.encode("utf-8")
+
+    def get_stats(self):
+        """
+        Get a snapshot of the client's own counters.
+        """
+        return {
+            "lines": self.lines,
+            "buffer_size": len(self._buffer),
+            "packets": self.packets,
+            "bytes_sent": self.bytes_sent,
+            "dropped_packets": self.dropped_packets,
+            "last_flush_failed": self.last_send_failed,
+        }
+
+    def _add(self, line):
+        with self._lock:
+            self._append(line)
+
+    def _append(self, line):
+        # Called while holding `_lock`.
+        self.lines += 1
+        buffer = self._buffer
+
+        if buffer and len(buffer) + len(line) + 1 > self.max_packet_size:
+            self._send(buffer)
+            buffer.clear()
+
+        if buffer:
+            buffer += b"\n"
+        buffer += line
+
+    def flush(self, timestamp=None):
+        with self._lock:
+            if self._buffer:
+                self._send(self._buffer)
+                self._buffer.clear()
+
+    def _send(self, packet):
+        try:
+            if self._socket is None:
+                self._socket = self._get_socket()
+            self.bytes_sent += self._socket.send(packet)
+        except (OSError, socket.error):
+            # The agent might not be running or its buffers are full, there
+            # is nothing we can do but drop the packet.
+            log.debug("sending packet to dogstatsd failed", exc_info=True)
+            self.dropped_packets += 1
+            self.last_send_failed = True
+        else:
+            self.packets += 1
+            self.last_send_failed = False
+
+    def _get_socket(self):
+        if self.socket_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.connect(self.socket_path)
+        else:
+            address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_DGRAM)[0]
+            sock = socket.socket(address[0], socket.SOCK_DGRAM)
+            sock.connect(address[4])
+
+        sock.setblocking(False)
+        return sock
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
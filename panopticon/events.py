@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import os
+import time
+import atexit
+import logging
+import threading
+
+from . import get_setting
+from .clients import NullStats
+from .datadog import DataDog
+
+log = logging.getLogger("panopticon.events")
+
+
+class EventPipeline(object):
+    """
+    Sends DataDog events from a background thread, coalescing and rate
+    limiting events that share an aggregation key (or title, if there's no
+    key).
+
+    Only the first event for a key within `window` seconds is sent, later
+    ones are counted and the count is added to the text of the next event
+    that is sent for that key. If no other event is sent once the window
+    closed, e.g. because the incident is over, a summary event with the count
+    is sent instead. On top of that, each key has a token bucket that allows
+    `burst` events at once and refills with `rate` events per second, which
+    limits keys that keep failing and recovering.
+
+    Queuing an event takes a lock and a dict lookup, all calls to the client
+    happen on the flush thread every `flush_interval` seconds.
+    """
+
+    KEY_DATADOG_EVENTS_WINDOW = "DATADOG_EVENTS_WINDOW"
+    KEY_DATADOG_EVENTS_BURST = "DATADOG_EVENTS_BURST"
+    KEY_DATADOG_EVENTS_RATE = "DATADOG_EVENTS_RATE"
+
+    WINDOW = 60
+    BURST = 3
+    # ten events per hour
+    RATE = 10 / 3600.0
+    FLUSH_INTERVAL = 1
+    # Keys that haven't been seen for this many windows are forgotten.
+    KEY_EXPIRY_WINDOWS = 10
+
+    _pipeline = None
+    _pipeline_pid = None
+    _pipeline_lock = threading.Lock()
+    _atexit_registered = False
+
+    def __init__(self, window=None, burst=None, rate=None, flush_interval=None):
+        self.window = self.WINDOW if window is None else window
+        self.burst = self.BURST if burst is None else burst
+        self.rate = self.RATE if rate is None else rate
+        self.flush_interval = (
+            self.FLUSH_INTERVAL if flush_interval is None else flush_interval
+        )
+
+        # aggregation key -> [tokens, last refill, last queued, suppressed,
+        # (title, tags, kwargs) of the last queued event]
+        self._keys = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        self._stop_event = threading.Event()
+        self._flush_thread = None
+
+    @classmethod
+    def configure_settings(cls, settings):
+        window = get_setting(settings, cls.KEY_DATADOG_EVENTS_WINDOW)
+        if window is not None:
+            cls.WINDOW = float(window)
+
+        burst = get_setting(settings, cls.KEY_DATADOG_EVENTS_BURST)
+        if burst is not None:
+            cls.BURST = int(burst)
+
+        rate = get_setting(settings, cls.KEY_DATADOG_EVENTS_RATE)
+        if rate is not None:
+            cls.RATE = float(rate)
+
+        cls.stop_pipeline()
+
+    @classmethod
+    def get_pipeline(cls):
+        """
+        Get the pipeline of the current process, a forked child gets a new
+        one without the events queued by its parent.
+        """
+        pid = os.getpid()
+        if cls._pipeline is not None and cls._pipeline_pid == pid:
+            return cls._pipeline
+
+        with cls._pipeline_lock:
+            if cls._pipeline is None or cls._pipeline_pid != pid:
+                # Registered after `DataDog.stop`, so queued events are handed
+                # to the client before it's flushed for the last time.
+                DataDog._register_atexit()
+                if not cls._atexit_registered:
+                    cls._atexit_registered = True
+                    atexit.register(cls.stop_pipeline)
+
+                cls._pipeline = cls()
+                cls._pipeline_pid = pid
+
+        return cls._pipeline
+
+    @classmethod
+    def stop_pipeline(cls):
+        """
+        Send all queued events and stop the pipeline of the current process.
+        """
+        with cls._pipeline_lock:
+            pipeline, cls._pipeline = cls._pipeline, None
+
+        if pipeline is not None and cls._pipeline_pid == os.getpid():
+            pipeline.stop()
+
+    @classmethod
+    def _after_fork_in_child(cls):
+        cls._pipeline_lock = threading.Lock()
+
+    def send(self, title, text, aggregation_key=None, tags=None, **kwargs):
+        """
+        Queue an event for `DataDog.event`. Returns `False` if the event was
+        suppressed.
+        """
+        if isinstance(DataDog.stats(), NullStats):
+            return False
+
+        key = aggregation_key or title
+        now = time.monotonic()
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None:
+                state = self._keys[key] = [self.burst, now, None, 0, None]
+
+            tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            state[0], state[1] = tokens, now
+
+            last_queued = state[2]
+            if (last_queued is not None and now - last_queued < self.window) or (
+                tokens < 1
+            ):
+                state[3] += 1
+                return False
+
+            state[0] -= 1
+            state[2] = now
+
+            # The tags are converted now, the tags of the current tag scope
+            # don't apply in the flush thread.
+            tags = DataDog._convert_tags(tags)
+            kwargs = dict(kwargs, aggregation_key=key)
+
+            self._pending[key] = (
+                title,
+                text,
+                tags,
+                dict(kwargs, date_happened=int(time.time())),
+                state[3],
+            )
+            state[3] = 0
+            state[4] = (title, tags, kwargs)
+
+        self._ensure_started()
+        return True
+
+    def flush(self, final=False):
+        """
+        Send the queued events and the summaries of windows that closed with
+        suppressed events. If `final` is set, summaries are sent for all
+        keys with suppressed events.
+        """
+        with self._lock:
+            self._queue_summaries(final)
+            pending, self._pending = self._pending, {}
+            self._expire_keys()
+
+        for title, text, tags, kwargs, suppressed in pending.values():
+            if suppressed:
+                note = "{} similar events were suppressed.".format(suppressed)
+                text = "{}\n\n{}".format(text, note) if text else note
+
+            try:
+                DataDog.event(title, text, tags=tags, **kwargs)
+            except Exception:  # noqa
+                log.exception("sending event %r failed", title)
+
+    def stop(self):
+        self._stop_event.set()
+
+        if self._flush_thread:
+            self._flush_thread.join()
+            self._flush_thread = None
+
+        self.flush(final=True)
+
+    def _queue_summaries(self, final):
+        # Called while holding `_lock`. A summary is queued like an event
+        # without text, it opens a new window and needs a token unless it's
+        # the final one.
+        now = time.monotonic()
+
+        for key, state in self._keys.items():
+            if not state[3] or state[4] is None or key in self._pending:
+                continue
+
+            if not final:
+                if now - state[2] < self.window:
+                    continue
+
+                tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+                state[0], state[1] = tokens, now
+                if tokens < 1:
+                    continue
+
+                state[0] -= 1
+                state[2] = now
+
+            title, tags, kwargs = state[4]
+            self._pending[key] = (
+                title,
+                None,
+                tags,
+                dict(kwargs, date_happened=int(time.time())),
+                state[3],
+            )
+            state[3] = 0
+
+    def _expire_keys(self):
+        # Keys with suppressed events are kept until their summary is sent.
+        now = time.monotonic()
+        expiry = self.window * self.KEY_EXPIRY_WINDOWS
+
+        expired = [
+            key
+            for key, state in self._keys.items()
+            if now - state[1] > expiry and not state[3] and key not in self._pending
+        ]
+        for key in expired:
+            del self._keys[key]
+
+    def _ensure_started(self):
+        if self._flush_thread is not None:
+            return
+
+        with self._lock:
+            if self._flush_thread is not None:
+                return
+
+            self._flush_thread = threading.Thread(
+                target=self._flush_periodically, name="panopticon-events"
+            )
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=EventPipeline._after_fork_in_child)
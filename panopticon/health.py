@@ -1,13 +1,36 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
 import time
-import requests
+import inspect
+import os
+import queue
+import logging
+import threading
+import contextvars
 
-from functools import wraps
+from functools import wraps, partial, lru_cache
 from datetime import datetime
 from collections import namedtuple
+from concurrent import futures
 
+from . import get_setting
 from .datadog import DataDog
+from .events import EventPipeline
+
+# asyncio, requests and aiohttp are imported where they are used, so that
+# importing this module stays cheap for processes that only register checks.
+
+log = logging.getLogger("panopticon.health")
+
+# The number of keep-alive connections kept per host by the shared session
+# used for URL checks. This also bounds the threads used by `check_urls`.
+URL_CHECK_POOL_SIZE = 10
+
+_session = None
+_session_lock = threading.Lock()
+
+# The `_TimedCall` running a health check in this context, if any.
+_current_call = contextvars.ContextVar("panopticon_current_call", default=None)
 
 
 HealthCheckResult = namedtuple("HealthCheckResult", ("name", "data", "is_healthy"))
@@ -20,61 +43,536 @@ class HealthCheck(object):
     TIMESTAMP = "timestamp"
     COMPONENTS = "components"
     STATUS_MESSAGE = "status_message"
+    SKIPPED = "skipped"
+
+    # Profiles select the health checks run by a probe. Liveness checks
+    # should be nearly free, they only tell whether the process should be
+    # restarted. Readiness checks tell whether it can serve traffic.
+    LIVENESS = "liveness"
+    READINESS = "readiness"
+
+    DEFAULT_PROFILES = (READINESS,)
+    DEFAULT_COST = 1
+
+    KEY_CONCURRENT = "HEALTHCHECK_CONCURRENT"
+    KEY_MAX_WORKERS = "HEALTHCHECK_MAX_WORKERS"
+    KEY_TIMEOUT = "HEALTHCHECK_TIMEOUT"
+    KEY_CACHE_TTL = "HEALTHCHECK_CACHE_TTL"
+    KEY_SHORT_CIRCUIT = "HEALTHCHECK_SHORT_CIRCUIT"
+    KEY_METRICS_PIPELINE = "HEALTHCHECK_METRICS_PIPELINE"
+    KEY_CIRCUIT_BREAKER_THRESHOLD = "HEALTHCHECK_CIRCUIT_BREAKER_THRESHOLD"
+    KEY_CIRCUIT_BREAKER_TIMEOUT = "HEALTHCHECK_CIRCUIT_BREAKER_TIMEOUT"
+    KEY_CIRCUIT_BREAKER_MAX_TIMEOUT = "HEALTHCHECK_CIRCUIT_BREAKER_MAX_TIMEOUT"
+
+    CIRCUIT_BREAKER = "circuit_breaker"
+
+    # these are just the defaults
+    CONCURRENT = False
+    MAX_WORKERS = 8
+    TIMEOUT = None
+    CACHE_TTL = None
+    SHORT_CIRCUIT = False
+    CIRCUIT_BREAKER_THRESHOLD = None
+    CIRCUIT_BREAKER_TIMEOUT = 30
+    CIRCUIT_BREAKER_MAX_TIMEOUT = 300
 
     health_checks = {}
 
+    _caches = {}
+    _cache_lock = threading.Lock()
+
+    _pools = {}
+    _pool_lock = threading.Lock()
+    # The invocation of each check that is in flight, see `_join_call`.
+    _calls = {}
+
+    def __init__(
+        self, concurrent=None, max_workers=None, timeout=None, short_circuit=None
+    ):
+        self.concurrent = self.CONCURRENT if concurrent is None else concurrent
+        self.max_workers = max_workers or self.MAX_WORKERS
+        self.timeout = self.TIMEOUT if timeout is None else timeout
+        self.short_circuit = (
+            self.SHORT_CIRCUIT if short_circuit is None else short_circuit
+        )
+
+    @classmethod
+    def configure_settings(cls, settings):
+        """
+        Configure how health checks are executed by `HealthCheck.run`.
+        """
+        cls.CONCURRENT = get_setting(settings, cls.KEY_CONCURRENT, cls.CONCURRENT)
+        cls.MAX_WORKERS = get_setting(settings, cls.KEY_MAX_WORKERS, cls.MAX_WORKERS)
+        cls.TIMEOUT = get_setting(settings, cls.KEY_TIMEOUT, cls.TIMEOUT)
+        cls.CACHE_TTL = get_setting(settings, cls.KEY_CACHE_TTL, cls.CACHE_TTL)
+        cls.SHORT_CIRCUIT = get_setting(
+            settings, cls.KEY_SHORT_CIRCUIT, cls.SHORT_CIRCUIT
+        )
+        cls.CIRCUIT_BREAKER_THRESHOLD = get_setting(
+            settings, cls.KEY_CIRCUIT_BREAKER_THRESHOLD, cls.CIRCUIT_BREAKER_THRESHOLD
+        )
+        cls.CIRCUIT_BREAKER_TIMEOUT = get_setting(
+            settings, cls.KEY_CIRCUIT_BREAKER_TIMEOUT, cls.CIRCUIT_BREAKER_TIMEOUT
+        )
+        cls.CIRCUIT_BREAKER_MAX_TIMEOUT = get_setting(
+            settings,
+            cls.KEY_CIRCUIT_BREAKER_MAX_TIMEOUT,
+            cls.CIRCUIT_BREAKER_MAX_TIMEOUT,
+        )
+
+        if get_setting(settings, cls.KEY_METRICS_PIPELINE, False):
+            register_metrics_pipeline_healthcheck(cls)
+
     @classmethod
-    def register_healthcheck(cls, func):
+    def get_cache(cls, profile=None):
+        """
+        Get the result cache for this class and `profile` (singleton):
+        `HealthCheckCache`.
+
+        The cache is created with `CACHE_TTL` on first use and starts a
+        background thread that keeps the results warm.
+        """
+        key = (cls, profile)
+
+        cache = cls._caches.get(key)
+        if cache:
+            return cache
+
+        with cls._cache_lock:
+            if key not in cls._caches:
+                cache = HealthCheckCache(cls(), ttl=cls.CACHE_TTL, profile=profile)
+                cache.start()
+                cls._caches[key] = cache
+
+        return cls._caches[key]
+
+    @classmethod
+    def get_result(cls, profile=None):
+        """
+        Get the current system result for `profile` (all health checks if
+        it's `None`). This is served from the result cache if `CACHE_TTL` is
+        configured and runs the health checks otherwise.
+        """
+        if cls.CACHE_TTL:
+            return cls.get_cache(profile).get()
+        return cls().run(profile)
+
+    @classmethod
+    def register_healthcheck(
+        cls,
+        func=None,
+        timeout=None,
+        ttl=None,
+        profiles=None,
+        cost=None,
+        critical=False,
+        failure_threshold=None,
+        reset_timeout=None,
+    ):
+        """
+        Register `func` as a health check. This can be used as a plain
+        decorator or called with options::
+
+            @HealthCheck.register_healthcheck(timeout=2, cost=10, critical=True)
+            def database(data):
+                ...
+
+        The `timeout` (in seconds) overrides the default deadline for this
+        check when health checks are run concurrently. The `ttl` (in seconds)
+        overrides how long the result of this check is cached when the result
+        cache is used.
+
+        The `profiles` are the probes the check is run for, by default it's
+        only run for `READINESS` (and whenever all checks are run). Checks
+        are run in the order of their `cost`, cheapest first. If a `critical`
+        check fails and short-circuiting is enabled, the remaining checks
+        are skipped.
+
+        After `failure_threshold` consecutive failures (or timeouts) the
+        check's circuit breaker opens: the last unhealthy result is returned
+        without running the check for `reset_timeout` seconds, then a single
+        trial run decides whether it closes again. The defaults are the
+        `HEALTHCHECK_CIRCUIT_BREAKER_*` settings, see `CircuitBreaker`.
+        """
+        if func is None:
+            return partial(
+                cls.register_healthcheck,
+                timeout=timeout,
+                ttl=ttl,
+                profiles=profiles,
+                cost=cost,
+                critical=critical,
+                failure_threshold=failure_threshold,
+                reset_timeout=reset_timeout,
+            )
+
         func_name = func.__name__
+        breaker = CircuitBreaker(cls, failure_threshold, reset_timeout)
 
-        @wraps(func)
-        def wrapped(*args, **kwargs):
-            # Let's pass in a pre-populated dict so we can ensure certain
-            # values being in the dict.
-            data = {
-                cls.HEALTHY: False,
-                cls.STATUS_MESSAGE: "Health check didn't provide a status 😭.",
-            }
-
-            start = time.time()
-
-            # If we don't get a useful set of data back from the health check
-            # we use the default dict from above to ensure consistency
-            data = func(data, *args, **kwargs) or data
-
-            # We only set the response time if it's not already been added
-            # by the health check function itself.
-            if cls.RESPONSE_TIME not in data:
-                data[cls.RESPONSE_TIME] = time.time() - start
-
-            # Let's trigger an event in Datadog if a healthcheck fails so we
-            # can see how it effects other metrics.
-            healthy = data.get(cls.HEALTHY, False)
-            if not healthy:
-                DataDog.stats().event(
-                    title="Healthcheck {} failed".format(func_name),
-                    text=str(data),
-                    tags=["application:healtcheck"],
-                    alert_type="error",
-                )
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def wrapped(*args, **kwargs):
+                import asyncio
 
-            return HealthCheckResult(name=func_name, data=data, is_healthy=healthy)
+                if not breaker.allow():
+                    return cls._get_open_circuit_result(func_name, breaker)
+
+                data = cls._get_default_data()
+                start = time.time()
+                try:
+                    data = await func(data, *args, **kwargs) or data
+                except asyncio.CancelledError:
+                    # The runner that cancelled the check records the timeout,
+                    # this is an `Exception` before Python 3.8.
+                    raise
+                except Exception:
+                    if not _is_abandoned():
+                        breaker.record_failure()
+                    raise
+
+                result = cls._get_check_result(func_name, data, start)
+                return result if _is_abandoned() else breaker.record(result)
+
+        else:
+
+            @wraps(func)
+            def wrapped(*args, **kwargs):
+                if not breaker.allow():
+                    return cls._get_open_circuit_result(func_name, breaker)
+
+                data = cls._get_default_data()
+                start = time.time()
+                try:
+                    data = func(data, *args, **kwargs) or data
+                except Exception:
+                    if not _is_abandoned():
+                        breaker.record_failure()
+                    raise
+
+                result = cls._get_check_result(func_name, data, start)
+                return result if _is_abandoned() else breaker.record(result)
+
+        wrapped.timeout = timeout
+        wrapped.ttl = ttl
+        wrapped.profiles = frozenset(
+            cls.DEFAULT_PROFILES if profiles is None else profiles
+        )
+        wrapped.cost = cls.DEFAULT_COST if cost is None else cost
+        wrapped.critical = critical
+        wrapped.circuit_breaker = breaker
 
         if func_name not in cls.health_checks:
             cls.health_checks[func_name] = wrapped
 
         return wrapped
 
-    def get_health_check_functions(self):
-        return self.health_checks.values()
+    @classmethod
+    def _get_default_data(cls):
+        # Let's pass in a pre-populated dict so we can ensure certain
+        # values being in the dict.
+        return {
+            cls.HEALTHY: False,
+            cls.STATUS_MESSAGE: "Health check didn't provide a status 😭.",
+        }
+
+    @classmethod
+    def _get_open_circuit_result(cls, func_name, breaker):
+        # The last unhealthy result is returned as is, without sending
+        # another event for it.
+        last_result = breaker.last_result
+        if last_result is not None:
+            data = dict(last_result.data)
+        else:
+            data = cls._get_default_data()
+            data[cls.STATUS_MESSAGE] = "Health check raised an exception."
+
+        data[cls.CIRCUIT_BREAKER] = breaker.get_data()
 
-    def run(self):
-        components = []
+        return HealthCheckResult(name=func_name, data=data, is_healthy=False)
+
+    @classmethod
+    def _get_check_result(cls, func_name, data, start):
+        # If we don't get a useful set of data back from the health check
+        # we use the default dict to ensure consistency. We only set the
+        # response time if it's not already been added by the health check
+        # function itself.
+        if cls.RESPONSE_TIME not in data:
+            data[cls.RESPONSE_TIME] = time.time() - start
 
-        for health_check in self.get_health_check_functions():
-            result = health_check()
+        # Let's trigger an event in Datadog if a healthcheck fails so we
+        # can see how it effects other metrics.
+        healthy = data.get(cls.HEALTHY, False)
+        if not healthy:
+            EventPipeline.get_pipeline().send(
+                "Healthcheck {} failed".format(func_name),
+                str(data),
+                tags=["application:healtcheck"],
+                alert_type="error",
+            )
+
+        return HealthCheckResult(name=func_name, data=data, is_healthy=healthy)
+
+    def get_health_check_functions(self, profile=None):
+        """
+        Get the health checks of `profile` (all of them if it's `None`),
+        cheapest first.
+        """
+        health_checks = self.health_checks.values()
+        if profile is not None:
+            health_checks = [
+                hc
+                for hc in health_checks
+                if profile in getattr(hc, "profiles", self.DEFAULT_PROFILES)
+            ]
+
+        return sorted(
+            health_checks, key=lambda hc: getattr(hc, "cost", self.DEFAULT_COST)
+        )
+
+    def run(self, profile=None, short_circuit=None):
+        """
+        Run the health checks of `profile` (all of them if it's `None`) and
+        combine them into a single system result.
+
+        If `concurrent` is enabled, the checks are run in a bounded thread
+        pool shared by all runs of this class and each check is given until
+        its timeout, counted from when it starts running, to finish. A check
+        that misses its deadline is reported as an unhealthy component and
+        isn't run again until the abandoned invocation has finished. In
+        sequential mode the timeout isn't enforced.
+
+        With `short_circuit`, the checks that haven't run yet are skipped
+        once a critical check failed.
+        """
+        if short_circuit is None:
+            short_circuit = self.short_circuit
+
+        components = self._run_checks(
+            self.get_health_check_functions(profile), short_circuit
+        )
+        return self._get_system_result(components)
+
+    def _run_checks(self, health_checks, short_circuit=False):
+        if self.concurrent:
+            return self._run_concurrently(health_checks, short_circuit)
+
+        components = []
+        for count, health_check in enumerate(health_checks, 1):
+            result = self._call_check(health_check)
             components.append(result)
 
+            if short_circuit and self._is_critical_failure(health_check, result):
+                components.extend(
+                    self._get_skipped_result(hc, health_check)
+                    for hc in health_checks[count:]
+                )
+                break
+
+        return components
+
+    async def run_async(self, profile=None):
+        """
+        Run the health checks of `profile` (all of them if it's `None`) on
+        the running event loop and combine them into a single system result.
+
+        Coroutine health checks are awaited directly, plain health checks are
+        run in the loop's default executor. Each check is cancelled once it
+        reaches its timeout and reported as an unhealthy component.
+        """
+        import asyncio
+
+        health_checks = self.get_health_check_functions(profile)
+        components = await asyncio.gather(
+            *(self._run_check_async(hc) for hc in health_checks)
+        )
+        return self._get_system_result(components)
+
+    async def _run_check_async(self, health_check):
+        import asyncio
+
+        call = None
+        if inspect.iscoroutinefunction(health_check):
+            awaitable = health_check()
+        else:
+            call = _TimedCall(self._call_check, health_check)
+            loop = asyncio.get_running_loop()
+            awaitable = loop.run_in_executor(None, call)
+
+        start = time.monotonic()
+        try:
+            return await asyncio.wait_for(
+                awaitable, self._get_check_timeout(health_check)
+            )
+        except asyncio.TimeoutError:
+            # A cancelled coroutine never reports back, a plain check keeps
+            # running in the executor and its result is dropped.
+            return self._get_timeout_result(
+                health_check,
+                time.monotonic() - start,
+                record=call is None or call.abandon(),
+            )
+
+    @staticmethod
+    def _call_check(health_check):
+        # Coroutine health checks can still be used from synchronous code,
+        # they just get their own event loop.
+        if inspect.iscoroutinefunction(health_check):
+            import asyncio
+
+            return asyncio.run(health_check())
+        return health_check()
+
+    def _get_check_timeout(self, health_check):
+        return getattr(health_check, "timeout", None) or self.timeout
+
+    def _run_concurrently(self, health_checks, short_circuit=False):
+        pool = self._get_pool()
+        calls = [self._join_call(pool, hc) for hc in health_checks]
+
+        components = []
+        failed_check = None
+        try:
+            for call in calls:
+                health_check = call.health_check
+
+                # Checks that haven't started yet are skipped once a critical
+                # check failed, running ones can't be interrupted and are
+                # still reported.
+                if failed_check is not None and self._cancel_call(call):
+                    components.append(
+                        self._get_skipped_result(health_check, failed_check)
+                    )
+                    continue
+
+                result = self._wait_for_check(call)
+                components.append(result)
+
+                if short_circuit and failed_check is None:
+                    if self._is_critical_failure(health_check, result):
+                        failed_check = health_check
+        finally:
+            self._leave_calls(calls)
+
+        return components
+
+    def _join_call(self, pool, health_check):
+        # There is at most one invocation of each check in flight. A probe
+        # that comes while the check is still running, e.g. because it hung
+        # and was abandoned by an earlier probe, waits for that invocation
+        # instead of tying up another worker.
+        key = (type(self), health_check)
+
+        with self._pool_lock:
+            call = self._calls.get(key)
+            if call is None or call.pid != os.getpid() or call.future.done():
+                call = _TimedCall(self._call_check, health_check)
+                call.future = pool.submit(call)
+                self._calls[key] = call
+
+            call.waiters += 1
+
+        return call
+
+    def _leave_calls(self, calls):
+        with self._pool_lock:
+            for call in calls:
+                call.waiters -= 1
+
+    def _cancel_call(self, call):
+        # A call that other probes are waiting for is left alone.
+        with self._pool_lock:
+            return call.waiters == 1 and call.future.cancel()
+
+    def _wait_for_check(self, call):
+        health_check, future = call.health_check, call.future
+        timeout = self._get_check_timeout(health_check)
+        if timeout is None:
+            return future.result()
+
+        # The deadline of a check starts when it starts running, not while
+        # it's waiting for a worker. A check that doesn't get a worker within
+        # its timeout, e.g. because hung checks keep the workers busy, is
+        # reported as timed out as well.
+        waiting = time.monotonic()
+        if not call.started.wait(timeout):
+            if self._cancel_call(call) or not (future.running() or future.done()):
+                return self._get_timeout_result(
+                    health_check, time.monotonic() - waiting, started=False
+                )
+            # It got a worker just now.
+            call.started.wait()
+
+        remaining = max(0, call.start + timeout - time.monotonic())
+        try:
+            return future.result(timeout=remaining)
+        except futures.TimeoutError:
+            pass
+
+        # We can't interrupt a running thread, the check finishes in the
+        # background and its result is dropped. The timeout is recorded on
+        # the circuit breaker once per invocation, even if several probes
+        # waited for it.
+        abandoned = call.abandon()
+        if call.finished:
+            return future.result()
+
+        return self._get_timeout_result(
+            health_check, time.monotonic() - call.start, record=abandoned
+        )
+
+    def _get_pool(self):
+        key = (type(self), self.max_workers)
+
+        pool = self._pools.get(key)
+        if pool:
+            return pool
+
+        with self._pool_lock:
+            if key not in self._pools:
+                self._pools[key] = _WorkerPool(self.max_workers)
+
+        return self._pools[key]
+
+    def _get_timeout_result(self, health_check, elapsed, started=True, record=True):
+        if started:
+            message = "Health check timed out after {:.3f}s.".format(elapsed)
+        else:
+            message = "Health check didn't start within {:.3f}s.".format(elapsed)
+
+        data = {
+            self.HEALTHY: False,
+            self.STATUS_MESSAGE: message,
+            self.RESPONSE_TIME: elapsed,
+        }
+        result = HealthCheckResult(
+            name=health_check.__name__, data=data, is_healthy=False
+        )
+
+        # A check that never ran isn't counted as a failure of its own.
+        breaker = getattr(health_check, "circuit_breaker", None)
+        if breaker is not None and started and record:
+            result = breaker.record(result)
+
+        return result
+
+    @staticmethod
+    def _is_critical_failure(health_check, result):
+        return not result.is_healthy and getattr(health_check, "critical", False)
+
+    def _get_skipped_result(self, health_check, failed_check):
+        data = {
+            self.HEALTHY: False,
+            self.SKIPPED: True,
+            self.STATUS_MESSAGE: "Skipped because critical check {} failed.".format(
+                failed_check.__name__
+            ),
+        }
+        return HealthCheckResult(
+            name=health_check.__name__, data=data, is_healthy=False
+        )
+
+    def _get_system_result(self, components):
         is_healthy = all(r.is_healthy for r in components)
 
         data = {
@@ -86,30 +584,548 @@ class HealthCheck(object):
         return HealthCheckResult(name="system", data=data, is_healthy=is_healthy)
 
 
-def check_url(url, expected_status=200, timeout=5):
+class CircuitBreaker(object):
+    """
+    Stops running a failing health check for a while, see
+    `HealthCheck.register_healthcheck`.
+
+    The breaker is `closed` while the check passes. After `failure_threshold`
+    consecutive failures it's `open` and `allow` returns `False` for
+    `reset_timeout` seconds. Then it's `half_open` and a single trial run is
+    allowed: if it passes the breaker closes, otherwise it opens again and
+    the timeout is doubled, up to `CIRCUIT_BREAKER_MAX_TIMEOUT`.
+
+    Settings that aren't given are taken from the `health_check_class` when
+    they're used, so they can still be configured after the check has been
+    registered. Without a threshold the breaker is disabled.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, health_check_class, failure_threshold=None, reset_timeout=None):
+        self.health_check_class = health_check_class
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.last_result = None
+
+        self._opened_at = None
+        self._timeout = None
+        self._lock = threading.Lock()
+
+    def get_failure_threshold(self):
+        return (
+            self.failure_threshold or self.health_check_class.CIRCUIT_BREAKER_THRESHOLD
+        )
+
+    def allow(self):
+        """
+        Return whether the check should be run now.
+        """
+        if self.state == self.CLOSED:
+            return True
+
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if time.monotonic() - self._opened_at < self._timeout:
+                return False
+
+            # The trial run is given as long as the breaker was open, if it
+            # never reports back another trial is allowed after that.
+            self.state = self.HALF_OPEN
+            self._opened_at = time.monotonic()
+            return True
+
+    def record(self, result):
+        """
+        Record the `result` of a run and add the breaker's state to its
+        data, if the breaker is enabled.
+        """
+        if not self.get_failure_threshold():
+            return result
+
+        if result.is_healthy:
+            self.record_success()
+        else:
+            self.record_failure(result)
+
+        result.data[self.health_check_class.CIRCUIT_BREAKER] = self.get_data()
+        return result
+
+    def record_success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.last_result = None
+            self._opened_at = self._timeout = None
+
+    def record_failure(self, result=None):
+        threshold = self.get_failure_threshold()
+        if not threshold:
+            return
+
+        with self._lock:
+            self.failures += 1
+            self.last_result = result
+
+            if self.state == self.HALF_OPEN:
+                self._open(min(self._timeout * 2, self._get_max_timeout()))
+            elif self.state == self.CLOSED and self.failures >= threshold:
+                self._open(self._get_reset_timeout())
+
+    def get_data(self):
+        data = {"state": self.state, "failures": self.failures}
+
+        if self.state == self.OPEN:
+            data["retry_in"] = max(
+                0, self._opened_at + self._timeout - time.monotonic()
+            )
+
+        return data
+
+    def _open(self, timeout):
+        # Called while holding `_lock`.
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._timeout = timeout
+
+    def _get_reset_timeout(self):
+        return self.reset_timeout or self.health_check_class.CIRCUIT_BREAKER_TIMEOUT
+
+    def _get_max_timeout(self):
+        return max(
+            self._get_reset_timeout(),
+            self.health_check_class.CIRCUIT_BREAKER_MAX_TIMEOUT,
+        )
+
+
+class HealthCheckCache(object):
+    """
+    Cache for the results of a `HealthCheck` instance.
+
+    Each health check's result is kept for its own `ttl` (or the default
+    `ttl` of the cache) and only expired checks are run again on refresh.
+    Calling `get` never waits for a refresh once there is a result: if the
+    result is stale, the last result is returned and a refresh is started in
+    the background. Its `timestamp` shows when it was generated.
+
+    Calling `start` runs a background thread that refreshes results as they
+    expire, so they are kept warm without a caller ever triggering a refresh.
+    A stale `get` wakes that thread instead of starting another one. Without
+    it, at most one refresh thread is started at a time.
+    """
+
+    def __init__(self, health_check, ttl, profile=None):
+        self.health_check = health_check
+        self.ttl = ttl
+        self.profile = profile
+
+        self._result = None
+        self._components = {}
+        self._expires_at = 0
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._thread = None
+
+    def get(self):
+        result = self._result
+
+        if result is None:
+            return self.refresh()
+
+        if time.monotonic() >= self._expires_at:
+            self._refresh_in_background()
+
+        return result
+
+    def refresh(self):
+        """
+        Run all expired health checks and update the cached result.
+        """
+        with self._refresh_lock:
+            now = time.monotonic()
+
+            health_checks = [
+                hc
+                for hc in self.health_check.get_health_check_functions(self.profile)
+                if self._components.get(hc.__name__, (None, 0))[1] <= now
+            ]
+            components = self.health_check._run_checks(
+                health_checks, self.health_check.short_circuit
+            )
+
+            with self._lock:
+                # Skipped checks expire with the critical check that failed,
+                # which comes before them, so they're all run again together.
+                failed_expires_at = now
+                for health_check, result in zip(health_checks, components):
+                    if result.data.get(self.health_check.SKIPPED):
+                        expires_at = failed_expires_at
+                    else:
+                        ttl = getattr(health_check, "ttl", None) or self.ttl
+                        expires_at = now + ttl
+                        if self.health_check._is_critical_failure(health_check, result):
+                            failed_expires_at = expires_at
+
+                    self._components[result.name] = (result, expires_at)
+
+                self._result = self.health_check._get_system_result(
+                    [result for result, _ in self._components.values()]
+                )
+                self._expires_at = min(
+                    (expires_at for _, expires_at in self._components.values()),
+                    default=now + self.ttl,
+                )
+
+            return self._result
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._refresh_periodically, name="panopticon-healthcheck-cache"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _refresh_periodically(self):
+        while not self._stop_event.is_set():
+            self._wake_event.wait(max(self._expires_at - time.monotonic(), 0.1))
+            self._wake_event.clear()
+
+            if not self._stop_event.is_set():
+                self._refresh_safely()
+
+    def _refresh_in_background(self):
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._wake_event.set()
+            return
+
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        thread = threading.Thread(target=self._refresh_once)
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_once(self):
+        try:
+            self._refresh_safely()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _refresh_safely(self):
+        try:
+            self.refresh()
+        except Exception:  # noqa
+            log.exception("refreshing health check results failed")
+
+
+class _TimedCall(object):
+    """
+    Calls `func` with `health_check` and records when it started running.
+    The probes waiting for the call are counted in `waiters`.
+
+    A call is either `finished` by the health check, which then records its
+    result on the circuit breaker, or `abandoned` by the runner once it
+    timed out, whichever comes first.
+    """
+
+    def __init__(self, func, health_check):
+        self.func = func
+        self.health_check = health_check
+        self.pid = os.getpid()
+        self.future = None
+        self.waiters = 0
+        self.start = None
+        self.started = threading.Event()
+        self.finished = self.abandoned = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        self.start = time.monotonic()
+        self.started.set()
+
+        token = _current_call.set(self)
+        try:
+            return self.func(self.health_check)
+        finally:
+            _current_call.reset(token)
+
+    def finish(self):
+        """
+        Return whether the result of the call should be recorded.
+        """
+        with self._lock:
+            self.finished = not self.abandoned
+            return self.finished
+
+    def abandon(self):
+        """
+        Return whether the call has been abandoned by this caller.
+        """
+        with self._lock:
+            if self.finished or self.abandoned:
+                return False
+            self.abandoned = True
+            return True
+
+
+def _is_abandoned():
+    # Checks that aren't run by the concurrent runners always record.
+    call = _current_call.get()
+    return call is not None and not call.finish()
+
+
+class _WorkerPool(object):
+    """
+    A bounded pool of daemon threads shared by all concurrent runs of a
+    `HealthCheck` class, returning `concurrent.futures.Future` objects.
+
+    Unlike `ThreadPoolExecutor`, its threads are not joined when the
+    interpreter exits, so a hung check can't block the shutdown. Threads are
+    started as needed up to `max_workers` and stay idle between probes. A
+    forked child starts its own threads.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._reset()
+
+    def submit(self, func, *args):
+        if self._pid != os.getpid():
+            self._reset()
+
+        future = futures.Future()
+        self._queue.put((future, func, args))
+
+        if not self._idle.acquire(blocking=False):
+            with self._lock:
+                if self._threads < self.max_workers:
+                    self._threads += 1
+                    thread = threading.Thread(
+                        target=self._work, name="panopticon-healthcheck"
+                    )
+                    thread.daemon = True
+                    thread.start()
+
+        return future
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = queue.SimpleQueue()
+        self._idle = threading.Semaphore(0)
+        self._lock = threading.Lock()
+        self._threads = 0
+
+    def _work(self):
+        work_queue, idle = self._queue, self._idle
+        while True:
+            future, func, args = work_queue.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = func(*args)
+                except BaseException as exc:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+            idle.release()
+
+
+def metrics_pipeline(data):
+    """
+    Health check for panopticon's own metrics pipeline, see
+    `register_metrics_pipeline_healthcheck`.
+    """
+    stats = DataDog.get_pipeline_stats()
+    failed = stats["client"].get("last_flush_failed", False)
+
+    data[HealthCheck.HEALTHY] = not failed
+    data[HealthCheck.STATUS_MESSAGE] = (
+        "Sending metrics failed." if failed else "Metrics pipeline is working."
+    )
+    data["pipeline"] = stats
+
+    return data
+
+
+def register_metrics_pipeline_healthcheck(health_check_class=HealthCheck):
+    """
+    Register the `metrics_pipeline` health check, which reports the
+    counters of `DataDog.get_pipeline_stats` and is unhealthy if the last
+    flush of the metrics client failed.
+
+    It isn't part of any profile, so the liveness and readiness probes don't
+    run it. It's run along with all other checks, e.g. by `/healthcheck/`,
+    and makes that result unhealthy while the last flush failed. It's
+    registered automatically if `HEALTHCHECK_METRICS_PIPELINE` is set.
+    """
+    return health_check_class.register_healthcheck(profiles=(), cost=0)(
+        metrics_pipeline
+    )
+
+
+def get_session():
+    """
+    Get the `requests.Session` shared by all URL checks (singleton).
+
+    Sharing the session keeps connections to the checked hosts alive between
+    probes instead of setting up a new TCP and TLS connection every time.
+    """
+    global _session
+
+    if _session:
+        return _session
+
+    with _session_lock:
+        if not _session:
+            import requests
+
+            from requests.adapters import HTTPAdapter
+
+            adapter = HTTPAdapter(
+                pool_connections=URL_CHECK_POOL_SIZE, pool_maxsize=URL_CHECK_POOL_SIZE
+            )
+
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+            _session = session
+
+    return _session
+
+
+def check_url(url, expected_status=200, timeout=5, method="GET", stream=False):
     """
     A simple check if `url` is reachable and resturns `expected_status`.
+
+    Use `method="HEAD"` or `stream=True` to only look at the status code
+    without downloading the response body. Streamed responses are closed
+    without reading the body, which means the connection isn't reused.
     """
     if not url:
-        return {
-            HealthCheck.HEALTHY: False,
-            HealthCheck.STATUS_MESSAGE: "No URL specified to check.",
-        }
+        return _get_missing_url_data()
+
+    import requests
 
     try:
-        response = requests.get(url, timeout=timeout)
+        response = get_session().request(method, url, timeout=timeout, stream=stream)
     except requests.RequestException as exc:
-        message = "Error connecting to URL: {}".format(str(exc))
-        return {HealthCheck.HEALTHY: False, HealthCheck.STATUS_MESSAGE: message}
+        return _get_connection_error_data(exc)
 
-    if expected_status == response.status_code:
+    if stream:
+        response.close()
+
+    return _get_status_code_data(response.status_code, expected_status)
+
+
+def check_urls(urls, expected_status=200, timeout=5, method="GET", stream=False):
+    """
+    Check several URLs in parallel using `check_url` with the same options.
+
+    Returns a dict mapping each URL to its component data, including the
+    response time for each URL.
+    """
+    urls = list(urls)
+    if not urls:
+        return {}
+
+    def check(url):
+        start = time.time()
+        data = check_url(url, expected_status, timeout, method=method, stream=stream)
+        data[HealthCheck.RESPONSE_TIME] = time.time() - start
+        return data
+
+    max_workers = min(URL_CHECK_POOL_SIZE, len(urls))
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(urls, executor.map(check, urls)))
+
+
+async def check_url_async(url, expected_status=200, timeout=5):
+    """
+    The asyncio counterpart of `check_url`.
+
+    This uses `aiohttp` if it is installed and falls back to running
+    `check_url` in the loop's default executor otherwise.
+    """
+    if not url:
+        return _get_missing_url_data()
+
+    import asyncio
+
+    aiohttp = _import_aiohttp()
+    if aiohttp is None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, partial(check_url, url, expected_status, timeout)
+        )
+
+    try:
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        async with aiohttp.ClientSession(timeout=client_timeout) as session:
+            async with session.get(url) as response:
+                status_code = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+        return _get_connection_error_data(exc)
+
+    return _get_status_code_data(status_code, expected_status)
+
+
+@lru_cache(maxsize=None)
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        return None
+    return aiohttp
+
+
+def _get_missing_url_data():
+    return {
+        HealthCheck.HEALTHY: False,
+        HealthCheck.STATUS_MESSAGE: "No URL specified to check.",
+    }
+
+
+def _get_connection_error_data(exc):
+    message = "Error connecting to URL: {}".format(str(exc))
+    return {HealthCheck.HEALTHY: False, HealthCheck.STATUS_MESSAGE: message}
+
+
+def _get_status_code_data(status_code, expected_status):
+    if expected_status == status_code:
         return {
             HealthCheck.HEALTHY: True,
             HealthCheck.STATUS_MESSAGE: "URL is available",
         }
 
-    message = "server responded with unexpected status code: {}".format(
-        response.status_code
-    )
+    message = "server responded with unexpected status code: {}".format(status_code)
 
     return {HealthCheck.HEALTHY: False, HealthCheck.STATUS_MESSAGE: message}
@@ -1,18 +1,38 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
-import structlog
+import logging
 import importlib
+import importlib.util
 
-log = structlog.get_logger("panopticon.loader")
+log = logging.getLogger("panopticon.loader")
 
 
 def load_healthcheck_modules(package_names, module_name="healthchecks"):
+    """
+    Import the `module_name` module of each package in `package_names`, if
+    it exists.
+
+    Packages without such a module are skipped without trying to import it,
+    errors raised while importing an existing module are not hidden.
+    """
     for name in package_names:
         healthcheck_module = "{name}.{module}".format(name=name, module=module_name)
 
-        try:
-            importlib.import_module(healthcheck_module)
-        except ImportError:
-            log.debug("importing {} failed".format(healthcheck_module))
-        else:
-            log.info("imported: {}".format(healthcheck_module))
+        if not module_exists(healthcheck_module):
+            log.debug("no module %s", healthcheck_module)
+            continue
+
+        importlib.import_module(healthcheck_module)
+        log.info("imported: %s", healthcheck_module)
+
+
+def module_exists(name):
+    """
+    Check whether the module `name` can be imported without importing it
+    (only its parent packages are imported).
+    """
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        # The parent package doesn't exist or isn't a package.
+        return False
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import re
+import math
+import time
+import bisect
+import threading
+
+_INVALID_NAME_CHARACTERS = re.compile(r"[^a-zA-Z0-9_:]")
+_INVALID_LABEL_CHARACTERS = re.compile(r"[^a-zA-Z0-9_]")
+
+
+class PrometheusExporter(object):
+    """
+    A client that keeps metrics in process and renders them in the Prometheus
+    text exposition format when they are scraped, see
+    `panopticon.django.views.MetricsView`.
+
+    Nothing is pushed: there is no flush thread and recording a value only
+    updates a series in memory. Metric names are converted to Prometheus
+    names (`panopticon.requests` becomes `panopticon_requests`) and tags to
+    labels, tags without a value become a label with the value `true`.
+
+    * Counters are cumulative and exposed with a `_total` suffix. A metric
+      that is ever decremented can go down, which Prometheus would take for
+      a counter reset, so from then on all its series are exposed as gauges
+      without the suffix, keeping their values.
+    * Gauges keep the last value.
+    * Histograms count values in `buckets`, with `_bucket`, `_sum` and
+      `_count` series. Sampled values are weighted by `1 / sample_rate`.
+
+    Each series is encoded once and its lines are reused by the next scrape
+    unless it was updated in between. Series are kept in `stripes` buffers
+    with their own locks, like in the `Aggregator`. At most `max_series`
+    series are kept, values for new series are dropped and counted once
+    that's reached.
+    """
+
+    requires_api_key = False
+    supports_sample_rate = True
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    MAX_SERIES = 100000
+
+    def __init__(self, buckets=BUCKETS, max_series=MAX_SERIES, stripes=16):
+        self.buckets = tuple(sorted(float(bucket) for bucket in buckets))
+        self.max_series = max_series
+
+        self._stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+        self._max_stripe_series = max(1, max_series // stripes)
+
+        # The names of metrics that were decremented.
+        self._up_down_metrics = set()
+
+        self.dropped_points = 0
+        self.scrapes = 0
+        self.reused_series = 0
+        self.last_scrape_duration = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        from .datadog import DataDog
+
+        buckets = settings.get(DataDog.KEY_DATADOG_PROMETHEUS_BUCKETS)
+        if isinstance(buckets, str):
+            buckets = [bucket for bucket in buckets.split(",") if bucket.strip()]
+
+        return cls(
+            buckets=buckets or cls.BUCKETS,
+            max_series=int(
+                settings.get(DataDog.KEY_DATADOG_MAX_BUFFERED_CONTEXTS)
+                or cls.MAX_SERIES
+            ),
+        )
+
+    def start(self, *args, **kwargs):
+        pass
+
+    def stop(self):
+        pass
+
+    def flush(self, *args, **kwargs):
+        pass
+
+    def gauge(self, metric_name, value, tags=None, **kwargs):
+        self._update(_Gauge, metric_name, tags, value)
+
+    def increment(self, metric_name, value=1, tags=None, **kwargs):
+        self._update(_Counter, metric_name, tags, value)
+
+    def decrement(self, metric_name, value=1, tags=None, **kwargs):
+        self._update(_UpDownCounter, metric_name, tags, -value)
+
+    def histogram(self, metric_name, value, tags=None, sample_rate=1, **kwargs):
+        self._update(_Histogram, metric_name, tags, value, _get_weight(sample_rate))
+
+    timing = distribution = histogram
+
+    def event(self, *args, **kwargs):
+        # Prometheus has no events.
+        pass
+
+    def submit_many(self, points):
+        for method, metric_name, value, tags, sample_rate in points:
+            if method == "decrement":
+                value = -value
+            self._update(
+                _METHOD_SERIES[method],
+                metric_name,
+                tags,
+                value,
+                _get_weight(sample_rate),
+            )
+
+    def render(self):
+        """
+        Render all series in the text exposition format as bytes.
+        """
+        start = time.monotonic()
+
+        families = {}
+        reused = 0
+        for lock, series_by_key in self._stripes:
+            with lock:
+                for series in series_by_key.values():
+                    lines, was_reused = series.render()
+                    reused += was_reused
+
+                    family = families.get(series.family)
+                    if family is None:
+                        family = families[series.family] = [series.header]
+                    family.append(lines)
+
+        output = b"".join(b"".join(families[name]) for name in sorted(families))
+
+        self.scrapes += 1
+        self.reused_series += reused
+        self.last_scrape_duration = time.monotonic() - start
+
+        return output
+
+    def get_stats(self):
+        """
+        Get a snapshot of the exporter's own counters.
+        """
+        series = 0
+        for lock, series_by_key in self._stripes:
+            series += len(series_by_key)
+
+        return {
+            "series": series,
+            "dropped_points": self.dropped_points,
+            "scrapes": self.scrapes,
+            "reused_series": self.reused_series,
+            "last_scrape_duration": self.last_scrape_duration,
+        }
+
+    def _update(self, series_class, metric_name, tags, value, weight=1):
+        if series_class is _UpDownCounter and metric_name not in self._up_down_metrics:
+            self._convert_to_up_down(metric_name)
+
+        # The stripe doesn't depend on the series class, so a counter that is
+        # converted stays in its stripe.
+        context = (metric_name, tuple(tags) if tags else None)
+        lock, series_by_key = self._stripes[hash(context) % len(self._stripes)]
+
+        with lock:
+            if series_class is _Counter and metric_name in self._up_down_metrics:
+                series_class = _UpDownCounter
+
+            key = (series_class,) + context
+            series = series_by_key.get(key)
+            if series is None:
+                if len(series_by_key) >= self._max_stripe_series:
+                    self.dropped_points += 1
+                    return
+
+                series = series_by_key[key] = series_class(
+                    get_prometheus_name(metric_name), tags, self.buckets
+                )
+
+            series.update(value, weight)
+
+    def _convert_to_up_down(self, metric_name):
+        """
+        Expose the series of the counter `metric_name` as gauges from now on,
+        keeping their values. All stripes are locked, so no update can add
+        to a counter series of the metric meanwhile.
+        """
+        for lock, _ in self._stripes:
+            lock.acquire()
+        try:
+            if metric_name in self._up_down_metrics:
+                return
+            self._up_down_metrics.add(metric_name)
+
+            for _, series_by_key in self._stripes:
+                keys = [
+                    key
+                    for key in series_by_key
+                    if key[0] is _Counter and key[1] == metric_name
+                ]
+                for key in keys:
+                    counter = series_by_key.pop(key)
+                    series = _UpDownCounter(counter.name, key[2], self.buckets)
+                    series.update(counter.value)
+                    series_by_key[(_UpDownCounter,) + key[1:]] = series
+        finally:
+            for lock, _ in self._stripes:
+                lock.release()
+
+
+class _Series(object):
+    """
+    A series of a metric family. The encoded lines are kept along with the
+    number of updates they were rendered at.
+    """
+
+    TYPE = None
+    SUFFIX = ""
+
+    def __init__(self, name, tags, buckets):
+        self.name = name
+        self.family = name + self.SUFFIX
+        self.header = "# TYPE {} {}\n".format(self.family, self.TYPE).encode("utf-8")
+        self.labels = get_prometheus_labels(tags)
+
+        self.updates = 0
+        self._rendered = (None, b"")
+
+    def update(self, value, weight=1):
+        """
+        Update the series with `value`. The `weight` is the number of values
+        it stands for, only histograms use it.
+        """
+        raise NotImplementedError
+
+    def render(self):
+        """
+        Return the encoded lines of the series and whether they were reused.
+        """
+        rendered_updates, lines = self._rendered
+        if rendered_updates == self.updates:
+            return lines, True
+
+        lines = self._render().encode("utf-8")
+        self._rendered = (self.updates, lines)
+        return lines, False
+
+    def _render(self):
+        raise NotImplementedError
+
+    def _format_labels(self, *extra):
+        labels = self.labels + list(extra)
+        if not labels:
+            return ""
+        return "{{{}}}".format(",".join(labels))
+
+
+class _Counter(_Series):
+    TYPE = "counter"
+    SUFFIX = "_total"
+
+    def __init__(self, name, tags, buckets):
+        super(_Counter, self).__init__(name, tags, buckets)
+        self.value = 0
+
+    def update(self, value, weight=1):
+        self.value += value
+        self.updates += 1
+
+    def _render(self):
+        return "{}{} {}\n".format(
+            self.family, self._format_labels(), _format_value(self.value)
+        )
+
+
+class _UpDownCounter(_Counter):
+    """
+    A counter that was decremented, exposed as a gauge.
+    """
+
+    TYPE = "gauge"
+    SUFFIX = ""
+
+
+class _Gauge(_Series):
+    TYPE = "gauge"
+
+    def __init__(self, name, tags, buckets):
+        super(_Gauge, self).__init__(name, tags, buckets)
+        self.value = 0
+
+    def update(self, value, weight=1):
+        self.value = value
+        self.updates += 1
+
+    def _render(self):
+        return "{}{} {}\n".format(
+            self.family, self._format_labels(), _format_value(self.value)
+        )
+
+
+class _Histogram(_Series):
+    TYPE = "histogram"
+
+    def __init__(self, name, tags, buckets):
+        super(_Histogram, self).__init__(name, tags, buckets)
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def update(self, value, weight=1):
+        # Counts are per bucket, they're only made cumulative when rendered.
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += weight
+
+        self.count += weight
+        self.sum += value * weight
+        self.updates += 1
+
+    def _render(self):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(
+                "{}_bucket{} {}\n".format(
+                    self.family,
+                    self._format_labels('le="{}"'.format(_format_value(bound))),
+                    _format_value(cumulative),
+                )
+            )
+
+        labels = self._format_labels()
+        lines.append(
+            "{}_bucket{} {}\n".format(
+                self.family,
+                self._format_labels('le="+Inf"'),
+                _format_value(self.count),
+            )
+        )
+        lines.append(
+            "{}_sum{} {}\n".format(self.family, labels, _format_value(self.sum))
+        )
+        lines.append(
+            "{}_count{} {}\n".format(self.family, labels, _format_value(self.count))
+        )
+
+        return "".join(lines)
+
+
+_METHOD_SERIES = {
+    "gauge": _Gauge,
+    "increment": _Counter,
+    "decrement": _UpDownCounter,
+    "histogram": _Histogram,
+}
+
+
+def get_prometheus_name(metric_name):
+    """
+    Convert a DataDog metric name into a valid Prometheus metric name.
+    """
+    name = _INVALID_NAME_CHARACTERS.sub("_", metric_name)
+    if name[:1].isdigit():
+        name = "_" + name
+    return name
+
+
+def get_prometheus_labels(tags):
+    """
+    Convert DataDog tags (`key:value`) into a sorted list of encoded
+    Prometheus labels (`key="value"`). If a key appears more than once, the
+    last value wins.
+    """
+    labels = {}
+    for tag in tags or ():
+        key, separator, value = tag.partition(":")
+        if not separator:
+            value = "true"
+
+        key = _INVALID_LABEL_CHARACTERS.sub("_", key)
+        if not key or key[0].isdigit():
+            key = "_" + key
+
+        labels[key] = value
+
+    return [
+        '{}="{}"'.format(key, _escape_label_value(value))
+        for key, value in sorted(labels.items())
+    ]
+
+
+def _get_weight(sample_rate):
+    # Keeps counts integers unless values are sampled.
+    return 1 / sample_rate if sample_rate != 1 else 1
+
+
+def _escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import time
+
+
+class AdaptiveSampler(object):
+    """
+    Keeps the number of points emitted for each metric within a `budget` of
+    points per second by lowering the sample rate of busy metrics.
+
+    The rate of each metric is measured over windows of `window` seconds and
+    the sample rate for the next window is set so that the expected number
+    of emitted points matches the budget. Metrics below the budget are
+    always sampled at `1`.
+
+    Getting a sample rate is a clock read and a dict lookup. Counts are
+    updated without locking, so concurrent threads may lose an update now and
+    then, which only makes the measured rate slightly less precise.
+    """
+
+    def __init__(self, budget, window=1.0):
+        self.budget = budget
+        self.window = window
+        self._states = {}
+
+    def get_sample_rate(self, metric_name):
+        now = time.monotonic()
+
+        state = self._states.get(metric_name)
+        if state is None:
+            # window start, number of points in the window, sample rate
+            state = self._states[metric_name] = [now, 0, 1.0]
+
+        elapsed = now - state[0]
+        if elapsed >= self.window:
+            rate = state[1] / elapsed
+            state[2] = self.budget / rate if rate > self.budget else 1.0
+            state[0], state[1] = now, 0
+
+        state[1] += 1
+        return state[2]
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import os
+import time
+import mmap
+import zlib
+import fcntl
+import struct
+import logging
+import tempfile
+import threading
+
+from .aggregator import (
+    Aggregator,
+    QuantileSketch,
+    _COUNTER,
+    _GAUGE,
+    _HISTOGRAM,
+)
+
+log = logging.getLogger("panopticon.shared")
+
+
+class SharedRegion(object):
+    """
+    A table of metric contexts in a memory-mapped file that is shared by all
+    processes on a host using the same `path`.
+
+    Each slot holds the aggregated value of one metric context: the sum of a
+    counter, the latest value of a gauge or a histogram summary (count, sum,
+    minimum, maximum and a fixed number of logarithmic buckets). Slots are
+    found by hashing the context and are never freed, so the size of the
+    region is fixed by the number of `slots`.
+
+    Access is serialised across processes with a `fcntl` lock on the file and
+    across threads with a regular lock.
+    """
+
+    MAGIC = b"PANOPTI1"
+    HEADER = struct.Struct("<8sI")
+
+    BINS = 256
+    # Histogram buckets have the accuracy of a `QuantileSketch` with this
+    # relative accuracy, starting at ~1e-4 and covering values up to ~1e7.
+    RELATIVE_ACCURACY = 0.05
+    BIN_OFFSET = -92
+
+    MAX_KEY_LENGTH = 512
+    # used, type, dirty, key length, key, value, timestamp, count, sum, min,
+    # max, zero count, buckets
+    SLOT = struct.Struct("<BBBxH{}sddQdddQ{}I".format(MAX_KEY_LENGTH, BINS))
+
+    TYPES = {_COUNTER: 1, _GAUGE: 2, _HISTOGRAM: 3}
+    METRIC_TYPES = {value: key for key, value in TYPES.items()}
+
+    def __init__(self, path, slots=4096):
+        self.path = path
+        self.slots = slots
+        self.size = self.HEADER.size + slots * self.SLOT.size
+
+        self._lock = threading.Lock()
+        self._slot_indexes = {}
+        self.dropped = 0
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        with self._locked():
+            if os.fstat(self._fd).st_size < self.size:
+                os.ftruncate(self._fd, self.size)
+
+            self._mmap = mmap.mmap(self._fd, self.size)
+
+            magic, existing_slots = self.HEADER.unpack_from(self._mmap, 0)
+            if magic != self.MAGIC:
+                self.HEADER.pack_into(self._mmap, 0, self.MAGIC, slots)
+            elif existing_slots != slots:
+                raise ValueError(
+                    "{} was created with {} slots".format(path, existing_slots)
+                )
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+    def merge(self, rolled_up):
+        """
+        Add the rolled up values of an `Aggregator` to the shared table.
+        """
+        with self._locked():
+            for (interval, context), value in rolled_up:
+                index = self._get_slot_index(context)
+                if index is None:
+                    self.dropped += 1
+                    continue
+
+                offset = self._get_offset(index)
+                slot = list(self.SLOT.unpack_from(self._mmap, offset))
+                metric_type = context[0]
+
+                if metric_type is _COUNTER:
+                    slot[5] += value
+                elif metric_type is _GAUGE:
+                    if interval >= slot[6]:
+                        slot[5], slot[6] = value, interval
+                else:
+                    self._merge_sketch(slot, value)
+
+                slot[2] = 1
+                self.SLOT.pack_into(self._mmap, offset, *slot)
+
+    def collect(self):
+        """
+        Return all values added since the last call as `(context, value)`
+        pairs and reset them.
+        """
+        collected = []
+
+        with self._locked():
+            for index in range(self.slots):
+                offset = self._get_offset(index)
+                slot = self.SLOT.unpack_from(self._mmap, offset)
+                used, slot_type, dirty, key_length, key = slot[:5]
+
+                if not used or not dirty:
+                    continue
+
+                metric_type = self.METRIC_TYPES[slot_type]
+                context = self._decode_context(metric_type, key[:key_length])
+
+                if metric_type is _HISTOGRAM:
+                    value = self._get_sketch(slot)
+                else:
+                    value = slot[5]
+
+                collected.append((context, value))
+                self.SLOT.pack_into(
+                    self._mmap, offset, *self._get_empty_slot(slot_type, slot)
+                )
+
+        return collected
+
+    def _get_slot_index(self, context):
+        index = self._slot_indexes.get(context)
+        if index is not None:
+            return index
+
+        slot_type = self.TYPES[context[0]]
+        key = self._encode_context(context)
+        if len(key) > self.MAX_KEY_LENGTH:
+            return None
+
+        start = zlib.crc32(key) % self.slots
+        for probe in range(self.slots):
+            index = (start + probe) % self.slots
+            offset = self._get_offset(index)
+            used, existing_type, _, key_length, existing_key = self.SLOT.unpack_from(
+                self._mmap, offset
+            )[:5]
+
+            if not used:
+                self.SLOT.pack_into(
+                    self._mmap,
+                    offset,
+                    *self._get_empty_slot(slot_type, (1, slot_type, 0, len(key), key))
+                )
+            elif existing_type != slot_type or existing_key[:key_length] != key:
+                continue
+
+            self._slot_indexes[context] = index
+            return index
+
+        return None
+
+    def _get_offset(self, index):
+        return self.HEADER.size + index * self.SLOT.size
+
+    def _get_empty_slot(self, slot_type, slot):
+        return (
+            (1, slot_type, 0, slot[3], slot[4])
+            + (0.0, 0.0, 0, 0.0, float("inf"), float("-inf"), 0)
+            + (0,) * self.BINS
+        )
+
+    def _merge_sketch(self, slot, sketch):
+        # Counts of sampled values are weighted and may not be whole numbers,
+        # the slots only hold integers.
+        slot[7] += round(sketch.count)
+        slot[8] += sketch.sum
+        slot[9] = min(slot[9], sketch.min)
+        slot[10] = max(slot[10], sketch.max)
+        slot[11] += round(sketch.zero_count)
+
+        # The local sketches use the same relative accuracy, so their bucket
+        # indexes only need to be shifted.
+        for index, count in sketch.bins.items():
+            index = min(max(index - self.BIN_OFFSET, 0), self.BINS - 1)
+            slot[12 + index] += round(count)
+
+    def _get_sketch(self, slot):
+        sketch = QuantileSketch(self.RELATIVE_ACCURACY, max_bins=self.BINS)
+        sketch.count, sketch.sum, sketch.min, sketch.max = slot[7:11]
+        sketch.zero_count = slot[11]
+        sketch.bins = {
+            index + self.BIN_OFFSET: count
+            for index, count in enumerate(slot[12:])
+            if count
+        }
+        return sketch
+
+    @staticmethod
+    def _encode_context(context):
+        _, metric_name, host, tags = context
+        parts = [metric_name, host or ""] + list(tags or ())
+        return "\x1f".join(parts).encode("utf-8")
+
+    @staticmethod
+    def _decode_context(metric_type, key):
+        metric_name, host, *tags = key.decode("utf-8").split("\x1f")
+        return (metric_type, metric_name, host or None, tuple(tags) or None)
+
+    def _locked(self):
+        return _FileLock(self._lock, self._fd)
+
+
+class SharedMemoryAggregator(Aggregator):
+    """
+    An `Aggregator` that combines the metrics of all processes on a host,
+    e.g. the workers of a gunicorn server, before they are sent to DataDog.
+
+    Every process aggregates its metrics locally, just like the regular
+    `Aggregator`, and adds them to a `SharedRegion` every `sync_interval`
+    seconds. One process on the host holds a lock on `<path>.lock` and is
+    the flusher: it collects the combined metrics from the shared region
+    every flush interval and sends them. If the flusher exits, another
+    process takes over at its next flush. Events are sent by each process
+    directly.
+    """
+
+    requires_api_key = True
+
+    SKETCH_RELATIVE_ACCURACY = SharedRegion.RELATIVE_ACCURACY
+
+    def __init__(self, path=None, slots=4096, sync_interval=1, **kwargs):
+        super(SharedMemoryAggregator, self).__init__(**kwargs)
+
+        self.path = path or os.path.join(_get_shared_memory_dir(), "panopticon.metrics")
+        self.sync_interval = sync_interval
+
+        self._region = SharedRegion(self.path, slots)
+        self._leader_fd = None
+        self._last_flush = time.time()
+
+    @classmethod
+    def from_settings(cls, settings):
+        from .datadog import DataDog
+
+        return cls(
+            path=settings.get(DataDog.KEY_DATADOG_SHARED_MEMORY_PATH),
+            slots=int(settings.get(DataDog.KEY_DATADOG_SHARED_MEMORY_SLOTS) or 4096),
+            max_contexts=int(
+                settings.get(DataDog.KEY_DATADOG_MAX_BUFFERED_CONTEXTS)
+                or cls.MAX_CONTEXTS
+            ),
+        )
+
+    def start(self, roll_up_interval=10, flush_interval=10, **kwargs):
+        # The flusher sends whatever was collected since its last flush, so
+        # the flush interval is the roll up interval as well.
+        super(SharedMemoryAggregator, self).start(
+            roll_up_interval=flush_interval, flush_interval=flush_interval, **kwargs
+        )
+
+    def stop(self):
+        super(SharedMemoryAggregator, self).stop()
+
+        if self._leader_fd is not None:
+            os.close(self._leader_fd)
+            self._leader_fd = None
+
+    @property
+    def is_flusher(self):
+        if self._leader_fd is not None:
+            return True
+
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            return False
+
+        self._leader_fd = fd
+        return True
+
+    def sync(self):
+        """
+        Add all locally aggregated metrics to the shared region.
+        """
+        self._region.merge(self._drain(float("inf")))
+
+    def flush(self, timestamp=None):
+        """
+        Add all local metrics to the shared region, send all queued events
+        and, if this process is the flusher, send the combined metrics.
+        """
+        with self._flush_lock:
+            self.sync()
+
+            metrics = []
+            if self.is_flusher:
+                now = time.time()
+                interval = now - now % self._roll_up_interval
+
+                metrics = self._format_metrics(
+                    ((interval, context), value)
+                    for context, value in self._region.collect()
+                )
+                self._last_flush = now
+
+            with self._events_lock:
+                events, self._events = self._events, []
+
+            self._report(metrics, events)
+
+    def get_stats(self):
+        stats = super(SharedMemoryAggregator, self).get_stats()
+        stats["dropped_contexts"] = self._region.dropped
+        stats["is_flusher"] = self._leader_fd is not None
+        return stats
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(self.sync_interval):
+            try:
+                if time.time() - self._last_flush >= self._flush_interval:
+                    self.flush()
+                else:
+                    self.sync()
+            except Exception:  # noqa
+                log.exception("syncing metrics to shared memory failed")
+
+
+class _FileLock(object):
+    def __init__(self, lock, fd):
+        self._lock = lock
+        self._fd = fd
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        except Exception:
+            self._lock.release()
+            raise
+
+    def __exit__(self, *args):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+
+def _get_shared_memory_dir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
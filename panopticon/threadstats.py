@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import time
+
+import datadog
+
+
+class ThreadStats(datadog.ThreadStats):
+    """
+    `datadog.ThreadStats` with the counters of `get_stats`, like panopticon's
+    own backends.
+
+    `ThreadStats.flush` logs and swallows the errors of its reporter, so
+    every reporter set on the client, including the one created by `start`,
+    is wrapped to count the requests it sends, how long the last one took
+    and whether it failed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.flushes = 0
+        self.flush_errors = 0
+        self.flushed_series = 0
+        self.flushed_events = 0
+        self.dropped_series = 0
+        self.last_flush_duration = None
+        self.last_flush_failed = False
+
+        self._reporter = None
+        super(ThreadStats, self).__init__(*args, **kwargs)
+
+    @property
+    def reporter(self):
+        return self._reporter
+
+    @reporter.setter
+    def reporter(self, reporter):
+        if reporter is not None and not isinstance(reporter, _Reporter):
+            reporter = _Reporter(self, reporter)
+        self._reporter = reporter
+
+    def get_stats(self):
+        """
+        Get a snapshot of the client's counters.
+        """
+        aggregator = self._metric_aggregator
+        with aggregator._lock:
+            buffer_size = sum(len(metrics) for metrics in aggregator._metrics.values())
+
+        return {
+            "buffer_size": buffer_size,
+            "queued_events": len(self._event_aggregator._events),
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "flushed_series": self.flushed_series,
+            "flushed_events": self.flushed_events,
+            "dropped_series": self.dropped_series,
+            "last_flush_duration": self.last_flush_duration,
+            "last_flush_failed": self.last_flush_failed,
+        }
+
+
+class _Reporter(object):
+    """
+    Sends with `reporter` and updates the counters of `client`.
+    """
+
+    def __init__(self, client, reporter):
+        self.client = client
+        self.reporter = reporter
+
+    def flush_metrics(self, metrics):
+        self._report(self.reporter.flush_metrics, metrics)
+
+    def flush_distributions(self, distributions):
+        self._report(self.reporter.flush_distributions, distributions)
+
+    def flush_events(self, events):
+        self._report(self.reporter.flush_events, events, events=True)
+
+    def _report(self, flush, items, events=False):
+        client = self.client
+        start = time.monotonic()
+        try:
+            flush(items)
+        except Exception:
+            client.flush_errors += 1
+            if not events:
+                client.dropped_series += len(items)
+            client.last_flush_failed = True
+            raise
+        else:
+            if events:
+                client.flushed_events += len(items)
+            else:
+                client.flushed_series += len(items)
+            client.last_flush_failed = False
+        finally:
+            client.flushes += 1
+            client.last_flush_duration = time.monotonic() - start
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import json
+import hashlib
+import threading
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+from .health import HealthCheck
+
+_responders = {}
+_responders_lock = threading.Lock()
+
+
+class HealthCheckResponder(object):
+    """
+    Turns the health check result of a `profile` into an HTTP response,
+    independent of any web framework.
+
+    The encoded body and its ETag are kept for the last result and reused as
+    long as `HealthCheck.get_result` returns the same result object, which
+    is the case while it's served from the result cache. A request with a
+    matching `If-None-Match` header gets a `304 Not Modified` without a
+    body, but only for a healthy result: an unhealthy one is always a `500`
+    so that monitors accepting a `304` never see a failing service as up.
+    """
+
+    CONTENT_TYPE = "application/json"
+
+    def __init__(self, profile=None, health_check_class=HealthCheck):
+        self.profile = profile
+        self.health_check_class = health_check_class
+
+        # (result, body, etag) of the last response
+        self._last = (None, None, None)
+
+    def get_response(self, result, if_none_match=None):
+        """
+        Return the status code, headers and body of the response for
+        `result`.
+        """
+        body, etag = self._encode(result)
+        headers = [
+            ("Content-Type", self.CONTENT_TYPE),
+            ("Cache-Control", "no-cache"),
+            ("ETag", etag),
+        ]
+
+        if not result.is_healthy:
+            return 500, headers, body
+
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return 304, headers, b""
+
+        return 200, headers, body
+
+    def get_result(self):
+        return self.health_check_class.get_result(self.profile)
+
+    async def get_result_async(self):
+        # Served from the cache it's only a lookup, otherwise the checks are
+        # run on the event loop instead of blocking it.
+        health_check_class = self.health_check_class
+        if health_check_class.CACHE_TTL:
+            return health_check_class.get_result(self.profile)
+        return await health_check_class().run_async(self.profile)
+
+    def _encode(self, result):
+        last_result, body, etag = self._last
+        if result is last_result:
+            return body, etag
+
+        body = dumps(result.data)
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        self._last = (result, body, etag)
+
+        return body, etag
+
+
+class HealthCheckApp(object):
+    """
+    A WSGI application that serves the health check result of `profile`,
+    e.g. to mount it next to an application with a dispatcher middleware
+    or to serve probes from a separate port.
+    """
+
+    STATUS_LINES = {
+        200: "200 OK",
+        304: "304 Not Modified",
+        500: "500 Internal Server Error",
+    }
+
+    def __init__(self, profile=None, health_check_class=HealthCheck):
+        self.responder = get_responder(profile, health_check_class)
+
+    def __call__(self, environ, start_response):
+        status_code, headers, body = self.responder.get_response(
+            self.responder.get_result(), environ.get("HTTP_IF_NONE_MATCH")
+        )
+
+        headers.append(("Content-Length", str(len(body))))
+        start_response(self.STATUS_LINES[status_code], headers)
+
+        return [body]
+
+
+class HealthCheckASGIApp(object):
+    """
+    An ASGI application that serves the health check result of `profile`.
+
+    If results aren't cached, the health checks are run with
+    `HealthCheck.run_async` on the running event loop.
+    """
+
+    def __init__(self, profile=None, health_check_class=HealthCheck):
+        self.responder = get_responder(profile, health_check_class)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+
+        if_none_match = None
+        for name, value in scope.get("headers", ()):
+            if name == b"if-none-match":
+                if_none_match = value.decode("latin-1")
+                break
+
+        status_code, headers, body = self.responder.get_response(
+            await self.responder.get_result_async(), if_none_match
+        )
+
+        headers.append(("Content-Length", str(len(body))))
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status_code,
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+def get_responder(profile=None, health_check_class=HealthCheck):
+    """
+    Get the `HealthCheckResponder` for `profile` (singleton), so that all
+    views and apps serving the same results share the encoded body.
+    """
+    key = (health_check_class, profile)
+
+    responder = _responders.get(key)
+    if responder is not None:
+        return responder
+
+    with _responders_lock:
+        if key not in _responders:
+            _responders[key] = HealthCheckResponder(profile, health_check_class)
+
+    return _responders[key]
+
+
+def dumps(data):
+    """
+    Encode `data` as JSON bytes, using `orjson` if it's installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=str)
+
+    return json.dumps(
+        data, separators=(",", ":"), ensure_ascii=False, default=str
+    ).encode("utf-8")
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match.strip() == "*":
+        return True
+
+    # weak comparison, as for GET requests
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+
+    return False
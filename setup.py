@@ -14,6 +14,8 @@ if sys.version_info < (3,):
 
 
 dev_requires = ["tox", "bumpversion", "twine", "wheel"]
+async_requires = ["aiohttp"]
+json_requires = ["orjson"]
 
 
 class PyTest(TestCommand):
@@ -40,6 +42,7 @@ setup(
     author_email="ops@mobify.com",
     url="https://python-panopticon.readthedocs.org",
     packages=["panopticon", "panopticon.django"],
+    python_requires=">=3.7",
     install_requires=requires,
     classifiers=[
         "Development Status :: 1 - Planning",
@@ -47,10 +50,18 @@ setup(
         "Intended Audience :: Developers",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "Programming Language :: Python :: Implementation :: CPython",
     ],
-    extras_require={"test": tests_requires, "dev": dev_requires},
+    extras_require={
+        "test": tests_requires,
+        "dev": dev_requires,
+        "async": async_requires,
+        "json": json_requires,
+    },
     cmdclass={"test": PyTest},
 )
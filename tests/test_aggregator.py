@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import random
+import threading
+
+import pytest
+
+from panopticon.compat import mock
+from panopticon.clients import MetricPoint
+from panopticon.datadog import DataDog
+from panopticon.aggregator import Aggregator, QuantileSketch
+
+
+def get_metrics_by_name(reporter):
+    metrics = {}
+    for call in reporter.flush_metrics.call_args_list:
+        for metric in call[0][0]:
+            metrics[metric["metric"]] = metric
+    return metrics
+
+
+@pytest.mark.parametrize("quantile", [0.5, 0.75, 0.95, 0.99])
+def test_sketch_quantiles_are_relatively_accurate(quantile):
+    sketch = QuantileSketch(relative_accuracy=0.02)
+    values = [random.lognormvariate(3, 1) for _ in range(10000)]
+
+    for value in values:
+        sketch.add(value)
+
+    expected = sorted(values)[int(quantile * (len(values) - 1))]
+    assert sketch.quantile(quantile) == pytest.approx(expected, rel=0.05)
+
+
+def test_sketch_size_is_bounded():
+    sketch = QuantileSketch(max_bins=32)
+
+    for value in range(1, 100000):
+        sketch.add(value)
+
+    assert len(sketch.bins) == 32
+    assert sketch.count == 99999
+    assert sketch.min == 1
+    assert sketch.max == 99999
+
+
+def test_merged_sketches_match_single_sketch():
+    first, second, combined = QuantileSketch(), QuantileSketch(), QuantileSketch()
+
+    for value in range(1, 1000):
+        (first if value % 2 else second).add(value)
+        combined.add(value)
+
+    first.merge(second)
+
+    assert first.count == combined.count
+    assert first.sum == combined.sum
+    assert first.quantile(0.95) == combined.quantile(0.95)
+
+
+def test_aggregator_rolls_up_points_from_many_threads():
+    reporter = mock.Mock()
+    aggregator = Aggregator(reporter=reporter)
+    aggregator._roll_up_interval = 10
+
+    def emit():
+        for value in range(1000):
+            aggregator.increment("requests", tags=["app:web"], timestamp=100)
+            aggregator.histogram("latency", value, tags=["app:web"], timestamp=100)
+
+    threads = [threading.Thread(target=emit) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    aggregator.gauge("queue", 3, timestamp=101)
+    aggregator.gauge("queue", 5, timestamp=102)
+    aggregator.flush(120)
+
+    metrics = get_metrics_by_name(reporter)
+
+    assert metrics["requests"]["points"] == [[100, 400.0]]
+    assert metrics["requests"]["tags"] == ["app:web"]
+    assert metrics["queue"]["points"] == [[100, 5]]
+    assert metrics["latency.count"]["points"] == [[100, 400.0]]
+    assert metrics["latency.max"]["points"] == [[100, 999]]
+    assert metrics["latency.95percentile"]["points"][0][1] == pytest.approx(
+        950, rel=0.02
+    )
+
+
+def test_aggregator_only_flushes_finished_intervals():
+    reporter = mock.Mock()
+    aggregator = Aggregator(reporter=reporter)
+
+    aggregator.increment("requests", timestamp=100)
+    aggregator.increment("requests", timestamp=115)
+    aggregator.flush(115)
+
+    assert get_metrics_by_name(reporter)["requests"]["points"] == [[100, 0.1]]
+
+
+def test_aggregator_weights_sampled_histogram_values():
+    reporter = mock.Mock()
+    aggregator = Aggregator(reporter=reporter)
+
+    aggregator.histogram("latency", 2, timestamp=100, sample_rate=0.1)
+    aggregator.histogram("latency", 4, timestamp=100)
+    aggregator.flush(115)
+
+    metrics = get_metrics_by_name(reporter)
+    assert metrics["latency.count"]["points"] == [[100, 1.1]]
+    assert metrics["latency.avg"]["points"][0][1] == pytest.approx(24 / 11)
+
+
+def test_aggregator_can_be_selected_as_backend():
+    DataDog.stop()
+    DataDog.configure_settings(
+        {
+            "DATADOG_STATS_ENABLED": True,
+            "DATADOG_API_KEY": "test_api_key",
+            "DATADOG_STATS_BACKEND": "aggregator",
+        }
+    )
+
+    try:
+        assert isinstance(DataDog.stats(), Aggregator)
+    finally:
+        with mock.patch.object(Aggregator, "flush"):
+            DataDog.stop()
+        DataDog.configure_settings({})
+
+
+def test_aggregator_stats_count_points_and_failed_flushes():
+    reporter = mock.Mock()
+    reporter.flush_metrics.side_effect = [IOError("unreachable"), None]
+    aggregator = Aggregator(reporter=reporter)
+
+    aggregator.increment("requests", timestamp=100)
+    aggregator.increment("requests", timestamp=101)
+    aggregator.gauge("queue", 5, timestamp=100)
+
+    assert aggregator.get_stats()["points"] == 3
+    assert aggregator.get_stats()["buffer_size"] == 2
+
+    aggregator.flush(timestamp=200)
+    stats = aggregator.get_stats()
+    assert stats["flush_errors"] == 1
+    assert stats["dropped_series"] == 2
+    assert stats["last_flush_failed"] is True
+    assert stats["buffer_size"] == 0
+
+    aggregator.increment("requests", timestamp=200)
+    aggregator.flush(timestamp=300)
+    stats = aggregator.get_stats()
+    assert stats["flushed_series"] == 1
+    assert stats["last_flush_failed"] is False
+    assert stats["last_flush_duration"] >= 0
+
+
+def test_aggregator_drops_points_for_new_contexts_when_full():
+    aggregator = Aggregator(stripes=1, reporter=mock.Mock(), max_contexts=2)
+
+    aggregator.increment("requests", tags=["path:/a"], timestamp=100)
+    aggregator.increment("requests", tags=["path:/b"], timestamp=100)
+    aggregator.increment("requests", tags=["path:/c"], timestamp=100)
+    aggregator.increment("requests", tags=["path:/a"], timestamp=100)
+
+    stats = aggregator.get_stats()
+    assert stats["buffer_size"] == 2
+    assert stats["dropped_points"] == 1
+
+
+def test_aggregator_adds_batches_like_single_points():
+    reporter = mock.Mock()
+    aggregator = Aggregator(reporter=reporter)
+
+    with mock.patch("panopticon.aggregator.time.time", return_value=100):
+        aggregator.submit_many(
+            [
+                MetricPoint("increment", "requests", 3, ["app:web"], 1),
+                MetricPoint("decrement", "requests", 1, ["app:web"], 1),
+                MetricPoint("gauge", "queue", 5, None, 1),
+                MetricPoint("histogram", "latency", 12, ["app:web"], 0.5),
+            ]
+        )
+    aggregator.flush(120)
+
+    metrics = get_metrics_by_name(reporter)
+
+    assert metrics["requests"]["points"] == [[100, 0.2]]
+    assert metrics["queue"]["points"] == [[100, 5]]
+    assert metrics["latency.max"]["points"] == [[100, 12]]
+    assert aggregator.get_stats()["points"] == 4
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import pytest
+
+from panopticon.cardinality import CardinalityLimiter
+from panopticon.clients import RecordingStats
+from panopticon.datadog import DataDog
+
+
+@pytest.fixture
+def stats():
+    DataDog.stop()
+    DataDog.configure_settings(
+        {
+            "DATADOG_STATS_ENABLED": True,
+            "DATADOG_STATS_BACKEND": "recording",
+            "DATADOG_DEFAULT_TAGS": {"env": "prod"},
+            "DATADOG_MAX_CONTEXTS_PER_METRIC": 2,
+            "DATADOG_CARDINALITY_POLICY": "other",
+        }
+    )
+
+    yield DataDog.stats()
+
+    DataDog.stop()
+    DataDog.configure_settings({})
+
+
+def test_new_contexts_are_dropped_over_limit():
+    limiter = CardinalityLimiter(2)
+
+    assert limiter.check("requests", ["path:/a"]) == ["path:/a"]
+    assert limiter.check("requests", ["path:/b"]) == ["path:/b"]
+    assert limiter.check("requests", ["path:/c"]) is None
+    assert limiter.check("requests", ["path:/a"]) == ["path:/a"]
+    assert limiter.check("latency", ["path:/c"]) == ["path:/c"]
+
+    assert limiter.get_stats()["dropped"] == 1
+    assert limiter.get_stats()["limited_metrics"] == 1
+
+
+def test_oldest_context_is_evicted_over_limit():
+    limiter = CardinalityLimiter(2, policy=CardinalityLimiter.DROP_OLDEST)
+
+    limiter.check("requests", ["path:/a"])
+    limiter.check("requests", ["path:/b"])
+
+    assert limiter.check("requests", ["path:/c"]) == ["path:/c"]
+    assert list(limiter._contexts["requests"]) == [("path:/b",), ("path:/c",)]
+    assert limiter.evicted == 1
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        CardinalityLimiter(2, policy="sometimes")
+
+
+def test_contexts_over_limit_are_folded_into_other(stats):
+    counter = DataDog.counter("requests", tags={"app": "web"})
+
+    for path in ("/a", "/b", "/c", "/d"):
+        counter.increment(tags={"path": path})
+
+    assert [call.kwargs["tags"] for call in stats.get_calls("increment")] == [
+        ["app:web", "env:prod", "path:/a"],
+        ["app:web", "env:prod", "path:/b"],
+        ["app:other", "env:prod", "path:other"],
+        ["app:other", "env:prod", "path:other"],
+    ]
+    assert DataDog.get_pipeline_stats()["cardinality"]["folded"] == 2
+
+
+def test_dropped_points_are_not_sent(stats):
+    DataDog.configure_settings(
+        {
+            "DATADOG_STATS_ENABLED": True,
+            "DATADOG_STATS_BACKEND": "recording",
+            "DATADOG_MAX_CONTEXTS_PER_METRIC": 1,
+        }
+    )
+
+    DataDog.histogram("latency", 1, tags={"user": 1})
+    DataDog.histogram("latency", 2, tags={"user": 2})
+
+    assert isinstance(DataDog.stats(), RecordingStats)
+    calls = DataDog.stats().get_calls("histogram")
+    assert [call.kwargs["value"] for call in calls] == [1]
@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
-import collections
+import os
+import sys
+import time
+import asyncio
 import random
 import string
+import contextvars
+import subprocess
+import threading
+import collections
 
 from panopticon.compat import mock
+from panopticon.clients import NullStats, RecordedCall, RecordingStats
 from panopticon.datadog import DataDog
+from panopticon.sampling import AdaptiveSampler
 import pytest
 
 
@@ -24,6 +33,20 @@ def random_string(choose_from=None, length=8):
     return "".join(random.choice(choices) for _ in range(length))
 
 
+def configure_recording_stats(settings=None):
+    """
+    Configure `DataDog` to use a fresh `RecordingStats` client and return it.
+    """
+    DataDog.stop()
+    DataDog.configure_settings(
+        dict(
+            {"DATADOG_STATS_ENABLED": True, "DATADOG_STATS_BACKEND": "recording"},
+            **(settings or {})
+        )
+    )
+    return DataDog.stats()
+
+
 def test_can_create_prefixed_metric_name():
     DataDog.configure_settings(
         {"DATADOG_STATS_ENABLED": True, "DATADOG_STATS_PREFIX": "my_fancy_prefix"}
@@ -41,11 +64,10 @@ def test_can_create_prefixed_metric_name():
 
 
 def test_track_time():
-    DataDog.configure_settings({"DATADOG_STATS_PREFIX": "my_fancy_prefix"})
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "my_fancy_prefix"})
 
-    with mock.patch("panopticon.datadog.time.time") as time:
-        time.side_effect = [1, 2]
-        DataDog.stats().histogram = mock.Mock()
+    with mock.patch("panopticon.datadog.perf_counter_ns") as perf_counter_ns:
+        perf_counter_ns.side_effect = [1000000000, 2000000000, 0, 0]
 
         @DataDog.track_time("track_time_test")
         def test_function():
@@ -53,10 +75,71 @@ def test_track_time():
 
         test_function()
 
-        histogram = DataDog.stats().histogram
+        histogram_calls = stats.get_calls("histogram")
+
+        assert len(histogram_calls) == 1
+        assert histogram_calls[0].args == ("my_fancy_prefix.track_time_test", 1)
+
+
+def test_track_time_defaults_to_function_name():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "timed"})
+
+    @DataDog.track_time
+    def update_index():
+        return "done"
+
+    assert update_index() == "done"
+    assert update_index.__name__ == "update_index"
+    assert stats.get_calls("histogram")[0].args[0] == "timed.update_index"
+
+
+def test_track_time_waits_for_coroutines():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "timed"})
+
+    @DataDog.track_time("fetch", tags={"source": "api"})
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return 42
+
+    assert asyncio.run(fetch()) == 42
+
+    (call,) = stats.get_calls("histogram")
+    assert call.args[1] >= 0.02
+    assert call.kwargs == {"tags": ["source:api"]}
+
+
+def test_track_time_waits_for_generators():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "timed"})
+
+    @DataDog.track_time("items")
+    def items():
+        yield 1
+        time.sleep(0.02)
+        yield 2
+
+    generator = items()
+    assert next(generator) == 1
+    assert stats.get_calls("histogram") == []
+
+    assert list(generator) == [2]
+    assert stats.get_calls("histogram")[0].args[1] >= 0.02
+
+
+def test_track_time_tags_outcome_of_blocks():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "timed"})
+    tracker = DataDog.track_time("render", tags=["app:web"], outcome=True)
+
+    with tracker:
+        pass
 
-        assert histogram.call_count == 1
-        assert histogram.call_args[0] == ("my_fancy_prefix.track_time_test", 1)
+    with pytest.raises(KeyError):
+        with tracker:
+            raise KeyError("missing")
+
+    assert [call.kwargs["tags"] for call in stats.get_calls("histogram")] == [
+        ["app:web", "outcome:success"],
+        ["app:web", "outcome:error"],
+    ]
 
 
 def test_api_key():
@@ -72,14 +155,7 @@ def test_api_key():
 )
 def test_metrics(method_name):
     metric_prefix = test_metrics.__name__
-    DataDog.configure_settings(
-        {"DATADOG_STATS_ENABLED": True, "DATADOG_STATS_PREFIX": metric_prefix}
-    )
-
-    mock_dd = DataDog.stats()
-    mock_dd.reset_mock()
-    mocked_method = mock.Mock()
-    setattr(mock_dd, method_name, mocked_method)
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": metric_prefix})
 
     dd_method = getattr(DataDog, method_name)
     metric_name = random_string()
@@ -91,30 +167,34 @@ def test_metrics(method_name):
 
     dd_method(metric_name, value, tags=tags)
 
-    assert mocked_method.call_count == 1
-    mocked_method.assert_called_with(
-        metric_prefix + "." + metric_name,
-        value=value,
-        tags=sorted(["{}:{}".format(key, value) for key, value in tags.items()]),
+    assert stats.calls == collections.deque(
+        [
+            RecordedCall(
+                method_name,
+                (metric_prefix + "." + metric_name,),
+                {
+                    "value": value,
+                    "tags": sorted(
+                        ["{}:{}".format(key, value) for key, value in tags.items()]
+                    ),
+                },
+            )
+        ]
     )
 
 
 def test_event():
     metric_prefix = test_event.__name__
-    DataDog.configure_settings(
-        {"DATADOG_STATS_ENABLED": True, "DATADOG_STATS_PREFIX": metric_prefix}
-    )
-
-    mock_dd = DataDog.stats()
-    mock_dd.reset_mock()
-    mock_dd.event = mock.Mock()
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": metric_prefix})
 
     tags = collections.OrderedDict([("xyz5", 567), ("abc2", "pqr")])
 
     DataDog.event("mno", "This is the text", tags=tags)
-    mock_dd.event.assert_called_with(
-        "mno", "This is the text", tags=["abc2:pqr", "xyz5:567"]
-    )
+    assert stats.get_calls("event") == [
+        RecordedCall(
+            "event", ("mno", "This is the text"), {"tags": ["abc2:pqr", "xyz5:567"]}
+        )
+    ]
 
 
 def test_default_tags_can_be_set_from_settings():
@@ -131,3 +211,619 @@ def test_default_tags_can_be_set_from_settings_and_args():
 
     assert DataDog._default_tags == {"env": "prod"}
     assert DataDog._convert_tags({}) == ["env:prod"]
+
+
+def test_convert_tags_without_tags_uses_default_tags():
+    DataDog.configure_settings({"DATADOG_DEFAULT_TAGS": {"env": "stage"}})
+
+    assert DataDog._convert_tags(None) == ["env:stage"]
+
+
+def test_converted_tags_are_not_shared_between_calls():
+    DataDog.configure_settings({"DATADOG_DEFAULT_TAGS": {"env": "stage"}})
+
+    first = DataDog._convert_tags({"path": "/"})
+    first.append("mutated:tag")
+
+    assert DataDog._convert_tags({"path": "/"}) == ["env:stage", "path:/"]
+
+
+def test_converted_tags_respect_value_types():
+    DataDog.configure_settings({})
+
+    assert DataDog._convert_tags({"flag": 1}) == ["flag:1"]
+    assert DataDog._convert_tags({"flag": True}) == ["flag:True"]
+    assert DataDog._convert_tags({"flag": [1]}) == ["flag:[1]"]
+
+
+def test_converted_tags_are_updated_with_default_tags():
+    DataDog.configure_settings({"DATADOG_DEFAULT_TAGS": {"env": "stage"}})
+    assert DataDog._convert_tags({"path": "/"}) == ["env:stage", "path:/"]
+
+    DataDog.configure_settings({"DATADOG_DEFAULT_TAGS": {"env": "prod"}})
+    assert DataDog._convert_tags({"path": "/"}) == ["env:prod", "path:/"]
+
+
+def test_counter_handle_is_resolved_once():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "handles"})
+    counter = DataDog.counter("requests", tags={"app": "web"})
+
+    with mock.patch.object(DataDog, "get_metric_name") as get_metric_name:
+        get_metric_name.return_value = "handles.requests"
+
+        counter.increment()
+        counter.increment(value=2)
+
+        assert get_metric_name.call_count == 1
+
+    assert stats.calls[-1] == RecordedCall(
+        "increment", ("handles.requests",), {"value": 2, "tags": ["app:web"]}
+    )
+
+
+def test_handles_follow_changed_settings():
+    configure_recording_stats({"DATADOG_STATS_PREFIX": "before"})
+    histogram = DataDog.histogram_handle("latency", tags={"app": "web"})
+    histogram.record(5)
+
+    stats = configure_recording_stats(
+        {"DATADOG_STATS_PREFIX": "after", "DATADOG_DEFAULT_TAGS": {"env": "prod"}}
+    )
+    histogram.record(7)
+
+    assert stats.calls[-1] == RecordedCall(
+        "histogram", ("after.latency", 7), {"tags": ["app:web", "env:prod"]}
+    )
+
+
+def test_handle_merges_additional_tags():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "handles"})
+    counter = DataDog.counter("requests", tags={"app": "web"})
+
+    counter.decrement(tags=["path:/"])
+
+    assert stats.calls[-1] == RecordedCall(
+        "decrement", ("handles.requests",), {"value": 1, "tags": ["app:web", "path:/"]}
+    )
+
+
+def test_disabled_stats_skip_building_metrics():
+    DataDog.stop()
+    DataDog.configure_settings({"DATADOG_STATS_ENABLED": False})
+
+    assert isinstance(DataDog.stats(), NullStats)
+
+    with mock.patch.object(DataDog, "get_metric_name") as get_metric_name:
+        with mock.patch.object(DataDog, "_convert_tags") as convert_tags:
+            DataDog.increment("requests", tags={"app": "web"})
+            DataDog.histogram("latency", 5)
+            DataDog.event("title", "text")
+            DataDog.counter("requests").increment(tags={"path": "/"})
+
+    assert not get_metric_name.called
+    assert not convert_tags.called
+
+
+def test_recording_stats_are_bounded():
+    stats = RecordingStats(max_calls=10)
+
+    for value in range(25):
+        stats.increment("requests", value=value)
+
+    assert len(stats.calls) == 10
+    assert stats.calls[0].kwargs == {"value": 15}
+
+
+@pytest.mark.parametrize("client_class", [NullStats, RecordingStats])
+def test_clients_have_the_methods_of_thread_stats(client_class):
+    from datadog import ThreadStats
+
+    missing = [
+        name
+        for name in dir(ThreadStats)
+        if not name.startswith("_") and not hasattr(client_class, name)
+    ]
+    assert missing == []
+
+    client = client_class()
+
+    @client.timed("render")
+    def render():
+        return "rendered"
+
+    with client.timer("block"):
+        client.set("users", 5)
+
+    assert render() == "rendered"
+
+
+class SlowStats(object):
+    instances = []
+
+    def __init__(self):
+        time.sleep(0.05)
+        self.points = []
+        self.instances.append(self)
+
+    def start(self, **kwargs):
+        pass
+
+    def flush(self, *args):
+        pass
+
+    def stop(self):
+        pass
+
+    def increment(self, metric_name, value=1, **kwargs):
+        self.points.append((metric_name, value))
+
+
+@pytest.fixture
+def slow_stats():
+    DataDog.stop()
+    DataDog.configure_settings(
+        {
+            "DATADOG_STATS_ENABLED": True,
+            "DATADOG_API_KEY": "test_api_key",
+            "DATADOG_STATS_BACKEND": "tests.test_datadog.SlowStats",
+            "DATADOG_STATS_PREFIX": "test_prefix",
+        }
+    )
+    SlowStats.instances = []
+
+    yield SlowStats
+
+    DataDog.stop()
+    DataDog.configure_settings({})
+
+
+def test_client_is_created_once_by_concurrent_threads(slow_stats):
+    clients = []
+    threads = [
+        threading.Thread(target=lambda: clients.append(DataDog.stats()))
+        for _ in range(8)
+    ]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(slow_stats.instances) == 1
+    assert all(client is slow_stats.instances[0] for client in clients)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_client_is_replaced_in_forked_child(slow_stats):
+    parent_client = DataDog.stats()
+    DataDog.increment("before_fork")
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:  # pragma: no cover
+        child_client = DataDog.stats()
+        DataDog.increment("after_fork")
+
+        ok = child_client is not parent_client and child_client.points == [
+            ("test_prefix.after_fork", 1)
+        ]
+        os.write(write_fd, b"1" if ok else b"0")
+        os._exit(0)
+
+    os.close(write_fd)
+    _, status = os.waitpid(pid, 0)
+
+    assert os.read(read_fd, 1) == b"1"
+    assert DataDog.stats() is parent_client
+    assert parent_client.points == [("test_prefix.before_fork", 1)]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_handles_use_the_client_of_the_forked_child(slow_stats):
+    counter = DataDog.counter("handle")
+    counter.increment()
+    parent_client = DataDog.stats()
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:  # pragma: no cover
+        for _ in range(3):
+            counter.increment()
+
+        child_client = DataDog.stats()
+        ok = (
+            child_client is not parent_client
+            and child_client.points == [("test_prefix.handle", 1)] * 3
+            and parent_client.points == [("test_prefix.handle", 1)]
+        )
+        os.write(write_fd, b"1" if ok else b"0")
+        os._exit(0)
+
+    os.close(write_fd)
+    _, status = os.waitpid(pid, 0)
+
+    assert os.read(read_fd, 1) == b"1"
+    assert parent_client.points == [("test_prefix.handle", 1)]
+
+
+def test_handles_are_resolved_again_in_another_process(slow_stats):
+    counter = DataDog.counter("handle")
+    counter.increment()
+    parent_client = DataDog.stats()
+
+    # A fork that skipped the fork hooks: same generation, another process.
+    with mock.patch("panopticon.datadog.os.getpid", return_value=-1):
+        counter.increment()
+        child_client = DataDog.stats()
+
+    assert child_client is not parent_client
+    assert parent_client.points == [("test_prefix.handle", 1)]
+    assert child_client.points == [("test_prefix.handle", 1)]
+
+
+FORKED_CHILD_EXIT = """
+import os
+import sys
+
+from panopticon.datadog import DataDog
+
+
+class Reporter(object):
+    def flush_metrics(self, metrics):
+        print("child" if os.getpid() != parent else "parent", len(metrics))
+        sys.stdout.flush()
+
+    flush_distributions = flush_events = flush_metrics
+
+
+DataDog.configure_settings(
+    {"DATADOG_STATS_ENABLED": True, "DATADOG_API_KEY": "test_api_key"}
+)
+DataDog.stats().reporter = Reporter()
+DataDog.increment("before_fork")
+
+parent = os.getpid()
+pid = os.fork()
+if pid == 0:
+    sys.exit(0)
+os.waitpid(pid, 0)
+"""
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_forked_child_does_not_flush_inherited_points_at_exit():
+    output = subprocess.check_output([sys.executable, "-c", FORKED_CHILD_EXIT])
+
+    assert output.decode("ascii").split("\n") == ["parent 1", ""]
+
+
+def test_sampled_counters_are_scaled():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "sampled"})
+
+    with mock.patch("panopticon.datadog.random.random") as random_value:
+        random_value.side_effect = [0.1, 0.6]
+
+        DataDog.increment("requests", value=2, sample_rate=0.5)
+        DataDog.increment("requests", value=2, sample_rate=0.5)
+
+    assert list(stats.calls) == [
+        RecordedCall("increment", ("sampled.requests",), {"value": 4.0, "tags": []})
+    ]
+
+
+def test_sample_rate_is_passed_on_for_histograms():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "sampled"})
+    histogram = DataDog.histogram_handle("latency", sample_rate=0.25)
+
+    with mock.patch("panopticon.datadog.random.random") as random_value:
+        random_value.side_effect = [0.1, 0.3]
+
+        histogram.record(5)
+        histogram.record(7)
+
+    assert list(stats.calls) == [
+        RecordedCall(
+            "histogram", ("sampled.latency", 5), {"tags": [], "sample_rate": 0.25}
+        )
+    ]
+
+
+def test_adaptive_sampling_keeps_to_budget():
+    sampler = AdaptiveSampler(budget=10, window=1.0)
+
+    with mock.patch("panopticon.sampling.time.monotonic") as monotonic:
+        monotonic.return_value = 0
+        rates = [sampler.get_sample_rate("busy") for _ in range(100)]
+        assert set(rates) == {1.0}
+
+        monotonic.return_value = 1
+        assert sampler.get_sample_rate("busy") == pytest.approx(0.1)
+        assert sampler.get_sample_rate("quiet") == 1.0
+
+
+def test_sampling_budget_can_be_set_from_settings():
+    configure_recording_stats({"DATADOG_SAMPLING_BUDGET": 100})
+    assert DataDog._sampler.budget == 100
+
+    configure_recording_stats()
+    assert DataDog._sampler is None
+
+
+def test_track_time_blocks_in_concurrent_tasks():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "timed"})
+    tracker = DataDog.track_time("task")
+
+    async def task(delay):
+        async with tracker:
+            await asyncio.sleep(delay)
+
+    async def main():
+        await asyncio.gather(task(0.05), task(0.01))
+
+    asyncio.run(main())
+
+    durations = sorted(call.args[1] for call in stats.get_calls("histogram"))
+    assert 0.01 <= durations[0] < 0.04
+    assert durations[1] >= 0.05
+
+
+def test_inline_track_time_blocks_do_not_grow_the_context():
+    configure_recording_stats()
+
+    def timed_blocks():
+        for _ in range(100):
+            with DataDog.track_time("render", outcome=True):
+                with DataDog.track_time("query"):
+                    pass
+        return len(contextvars.copy_context())
+
+    context = contextvars.Context()
+    size = len(context)
+
+    assert context.run(timed_blocks) <= size + 1
+
+
+def test_track_time_blocks_in_suspended_generators():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "timed"})
+    clock = [0]
+
+    def items():
+        with DataDog.track_time("gen"):
+            yield 1
+            clock[0] += 2
+
+    with mock.patch("panopticon.datadog.perf_counter_ns", lambda: clock[0] * 10**9):
+        generator = items()
+        next(generator)
+        clock[0] += 1
+
+        with DataDog.track_time("outer"):
+            clock[0] += 1
+            list(generator)
+
+    durations = {call.args[0]: call.args[1] for call in stats.get_calls("histogram")}
+    assert durations == {"timed.gen": 4, "timed.outer": 3}
+
+
+def test_track_time_block_closed_in_another_thread():
+    stats = configure_recording_stats({"DATADOG_STATS_PREFIX": "timed"})
+
+    def items():
+        with DataDog.track_time("gen"):
+            yield 1
+
+    def close():
+        try:
+            generator.close()
+        except Exception as exc:  # pragma: no cover
+            errors.append(exc)
+
+    errors = []
+    generator = items()
+    next(generator)
+
+    thread = threading.Thread(target=close)
+    thread.start()
+    thread.join()
+
+    assert errors == []
+    assert stats.get_calls("histogram") == []
+
+
+def test_pipeline_stats_count_emitted_and_sampled_points():
+    configure_recording_stats()
+    DataDog.emission_stats.reset()
+    counter = DataDog.counter("requests")
+
+    with mock.patch("panopticon.datadog.random.random") as random_value:
+        random_value.return_value = 0.9
+
+        for _ in range(10):
+            DataDog.increment("requests")
+        counter.increment(sample_rate=0.5)
+
+    stats = DataDog.get_pipeline_stats()
+
+    assert stats["backend"] == "RecordingStats"
+    assert stats["emitted"] == 10
+    assert stats["sampled_out"] == 1
+    assert stats["average_emission_time_ns"] > 0
+    assert stats["client"] == {}
+
+
+def test_pipeline_stats_of_the_default_backend():
+    class Reporter(object):
+        failing = True
+
+        def flush_metrics(self, metrics):
+            if self.failing:
+                raise IOError("unreachable")
+
+        flush_distributions = flush_events = flush_metrics
+
+    DataDog.stop()
+    DataDog.configure_settings(
+        {
+            "DATADOG_STATS_ENABLED": True,
+            "DATADOG_API_KEY": "test_api_key",
+            "DATADOG_STATS_BACKEND": "threadstats",
+        }
+    )
+    try:
+        client = DataDog.stats()
+        client.reporter = reporter = Reporter()
+
+        DataDog.increment("requests")
+        DataDog.gauge("queue", 2)
+        assert DataDog.get_pipeline_stats()["client"]["buffer_size"] == 2
+
+        client.flush(time.time() + 60)
+        stats = DataDog.get_pipeline_stats()
+        assert stats["backend"] == "ThreadStats"
+        assert stats["client"]["buffer_size"] == 0
+        assert stats["client"]["flush_errors"] == 1
+        assert stats["client"]["dropped_series"] == 2
+        assert stats["client"]["last_flush_failed"] is True
+
+        reporter.failing = False
+        DataDog.increment("requests")
+        client.flush(time.time() + 60)
+        stats = DataDog.get_pipeline_stats()
+        assert stats["client"]["flushed_series"] == 1
+        assert stats["client"]["last_flush_failed"] is False
+        assert stats["client"]["last_flush_duration"] >= 0
+    finally:
+        DataDog.stop()
+        DataDog.configure_settings({})
+
+
+def test_tag_scope_adds_tags_to_metrics():
+    stats = configure_recording_stats({"DATADOG_DEFAULT_TAGS": {"env": "prod"}})
+    counter = DataDog.counter("jobs", tags={"queue": "default"})
+
+    with DataDog.tag_scope({"tenant": "acme"}):
+        with DataDog.tag_scope(["job:reindex"]):
+            DataDog.increment("requests", tags={"path": "/"})
+            DataDog.gauge("workers", 3, tags=["pool:web"])
+            counter.increment()
+        DataDog.increment("requests")
+
+    counter.increment()
+
+    assert [call.kwargs["tags"] for call in stats.calls] == [
+        ["env:prod", "job:reindex", "path:/", "tenant:acme"],
+        ["job:reindex", "pool:web", "tenant:acme"],
+        ["env:prod", "job:reindex", "queue:default", "tenant:acme"],
+        ["env:prod", "tenant:acme"],
+        ["env:prod", "queue:default"],
+    ]
+
+
+def test_tag_scope_decorates_functions_and_coroutines():
+    stats = configure_recording_stats()
+    scope = DataDog.tag_scope({"job": "reindex"})
+
+    @scope
+    def run():
+        DataDog.increment("runs")
+
+    @scope
+    async def run_async():
+        await asyncio.sleep(0)
+        DataDog.increment("runs")
+
+    run()
+    asyncio.run(run_async())
+    DataDog.increment("runs")
+
+    assert [call.kwargs["tags"] for call in stats.calls] == [
+        ["job:reindex"],
+        ["job:reindex"],
+        [],
+    ]
+
+
+def test_tag_scopes_are_separate_for_tasks_and_threads():
+    stats = configure_recording_stats()
+
+    async def task(name):
+        async with DataDog.tag_scope({"task": name}):
+            await asyncio.sleep(0.01)
+            DataDog.increment("tasks")
+
+    async def main():
+        await asyncio.gather(task("a"), task("b"))
+
+    with DataDog.tag_scope({"scope": "main"}):
+        thread = threading.Thread(target=DataDog.increment, args=("threads",))
+        thread.start()
+        thread.join()
+
+        asyncio.run(main())
+
+    tags = sorted(tuple(call.kwargs["tags"]) for call in stats.calls)
+    assert tags == [(), ("scope:main", "task:a"), ("scope:main", "task:b")]
+
+
+def test_batch_records_same_calls_as_single_metrics():
+    stats = configure_recording_stats(
+        {"DATADOG_STATS_PREFIX": "jobs", "DATADOG_DEFAULT_TAGS": {"env": "prod"}}
+    )
+
+    DataDog.increment("finished", tags={"queue": "default"})
+    DataDog.histogram("duration", 2.5, tags={"queue": "default", "step": "fetch"})
+    DataDog.gauge("queue_size", 4, tags={"queue": "default"})
+    single_calls = list(stats.calls)
+    stats.reset()
+
+    with DataDog.batch(tags={"queue": "default"}) as batch:
+        batch.increment("finished")
+        batch.histogram("duration", 2.5, tags={"step": "fetch"})
+        batch.gauge("queue_size", 4)
+
+        assert not stats.calls
+
+    assert list(stats.calls) == single_calls
+
+
+def test_submit_many_falls_back_to_single_calls():
+    configure_recording_stats({"DATADOG_STATS_PREFIX": "jobs"})
+    client = mock.Mock(spec=["increment", "histogram"], supports_sample_rate=True)
+
+    with mock.patch.object(DataDog, "stats", return_value=client):
+        with mock.patch("panopticon.datadog.random.random", return_value=0.1):
+            DataDog.submit_many(
+                [
+                    ("increment", "finished", 1, None, 0.5),
+                    ("histogram", "duration", 2.5, ["step:fetch"], 0.5),
+                ]
+            )
+
+    assert client.increment.call_args == mock.call("jobs.finished", value=2.0, tags=[])
+    assert client.histogram.call_args == mock.call(
+        "jobs.duration", value=2.5, tags=["step:fetch"], sample_rate=0.5
+    )
+
+
+def test_histograms_are_not_sampled_for_clients_ignoring_the_rate():
+    configure_recording_stats({"DATADOG_STATS_PREFIX": "sampled"})
+    client = mock.Mock(spec=["histogram", "increment"])
+
+    with mock.patch.object(DataDog, "stats", return_value=client):
+        with mock.patch("panopticon.datadog.random.random", return_value=0.9):
+            DataDog.histogram("latency", 2.5, sample_rate=0.1)
+            DataDog.histogram_handle("latency").record(2.5, sample_rate=0.1)
+            DataDog.increment("requests", sample_rate=0.1)
+
+    assert client.histogram.call_count == 2
+    assert client.histogram.call_args == mock.call("sampled.latency", 2.5, tags=[])
+    assert not client.increment.called
+
+
+def test_submit_many_rejects_unknown_methods():
+    configure_recording_stats()
+
+    with pytest.raises(ValueError):
+        DataDog.submit_many([("timing", "duration", 2.5)])
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import asyncio
+
+import pytest
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from django.http import HttpResponse  # noqa: E402
+from django.test import RequestFactory, override_settings  # noqa: E402
+from django.urls import ResolverMatch, path, resolve  # noqa: E402
+
+from panopticon.datadog import DataDog  # noqa: E402
+from panopticon.django.middleware import RequestMetricsMiddleware  # noqa: E402
+
+
+@pytest.fixture
+def stats():
+    DataDog.stop()
+    DataDog.configure_settings(
+        {
+            "DATADOG_STATS_ENABLED": True,
+            "DATADOG_STATS_BACKEND": "recording",
+            "DATADOG_STATS_PREFIX": "web",
+        }
+    )
+
+    yield DataDog.stats()
+
+    DataDog.stop()
+    DataDog.configure_settings({})
+
+
+def view(request):
+    return HttpResponse()
+
+
+def get_request(path, url_name=None, route=None):
+    request = RequestFactory().get(path)
+    request.resolver_match = ResolverMatch(view, (), {}, url_name=url_name, route=route)
+    return request
+
+
+def test_requests_are_tagged_with_route_and_status_class(stats):
+    middleware = RequestMetricsMiddleware(lambda request: HttpResponse(status=404))
+
+    middleware(get_request("/orders/123/", url_name="order-detail"))
+    middleware(get_request("/orders/456/", url_name="order-detail"))
+
+    tags = ["route:order-detail", "status_class:4xx"]
+    assert [call.kwargs["tags"] for call in stats.calls] == [tags] * 4
+    assert len(middleware._handles) == 1
+
+
+def test_unnamed_routes_are_tagged_with_pattern(stats):
+    middleware = RequestMetricsMiddleware(lambda request: HttpResponse())
+
+    middleware(get_request("/orders/123/", route="orders/<int:pk>/"))
+    middleware(RequestFactory().get("/missing/"))
+
+    assert [call.kwargs["tags"][0] for call in stats.get_calls("increment")] == [
+        "route:orders/<int:pk>/",
+        "route:unresolved",
+    ]
+
+
+def test_async_requests_are_measured_without_thread(stats):
+    async def get_response(request):
+        return HttpResponse(status=201)
+
+    middleware = RequestMetricsMiddleware(get_response)
+    assert asyncio.iscoroutinefunction(middleware)
+
+    response = asyncio.run(middleware(get_request("/", url_name="home")))
+
+    assert response.status_code == 201
+    assert stats.get_calls("increment")[0].kwargs["tags"] == [
+        "route:home",
+        "status_class:2xx",
+    ]
+
+
+@override_settings(DATADOG_REQUESTS_TAG_SCOPE=True)
+def test_requests_are_handled_in_a_route_tag_scope(stats):
+    def get_response(request):
+        DataDog.increment("orders.viewed")
+        request.resolver_match = resolve(request.path_info, request.urlconf)
+        return HttpResponse()
+
+    middleware = RequestMetricsMiddleware(get_response)
+    request = RequestFactory().get("/orders/123/")
+    request.urlconf = __name__
+
+    middleware(request)
+
+    assert [call.kwargs["tags"] for call in stats.get_calls("increment")] == [
+        ["route:order-detail"],
+        ["route:order-detail", "status_class:2xx"],
+    ]
+
+
+@override_settings(DATADOG_REQUESTS_TAG_SCOPE=True)
+def test_route_tag_scope_ends_with_the_request(stats):
+    def get_response(request):
+        raise KeyError("missing")
+
+    middleware = RequestMetricsMiddleware(get_response)
+
+    request = RequestFactory().get("/missing/")
+    request.urlconf = __name__
+
+    with pytest.raises(KeyError):
+        middleware(request)
+    DataDog.increment("orders.viewed")
+
+    assert stats.get_calls("increment")[0].kwargs["tags"] == []
+
+
+@override_settings(DATADOG_REQUESTS_TAG_SCOPE=True)
+def test_async_requests_are_handled_in_a_route_tag_scope(stats):
+    async def get_response(request):
+        DataDog.increment("orders.viewed")
+        return HttpResponse()
+
+    middleware = RequestMetricsMiddleware(get_response)
+
+    asyncio.run(middleware(get_request("/orders/123/", url_name="order-detail")))
+
+    assert stats.get_calls("increment")[0].kwargs["tags"] == ["route:order-detail"]
+
+
+urlpatterns = [path("orders/<int:pk>/", view, name="order-detail")]
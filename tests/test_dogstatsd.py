@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import os
+import socket
+import tempfile
+
+import pytest
+
+from panopticon.clients import MetricPoint
+from panopticon.datadog import DataDog
+from panopticon.dogstatsd import DogStatsD
+
+
+@pytest.fixture
+def agent():
+    """
+    A local UDP socket standing in for the DataDog agent.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(1)
+
+    yield sock
+
+    sock.close()
+
+
+def receive_lines(agent):
+    return agent.recv(65535).decode("utf-8").split("\n")
+
+
+def get_client(agent, **kwargs):
+    host, port = agent.getsockname()
+    return DogStatsD(host=host, port=port, **kwargs)
+
+
+def test_metrics_are_encoded_as_dogstatsd_lines(agent):
+    client = get_client(agent)
+
+    client.increment("requests", tags=["app:web", "env:prod"])
+    client.decrement("workers", value=2)
+    client.gauge("queue", 5, sample_rate=0.5)
+    client.histogram("latency", 0.25, tags=["app:web"], sample_rate=0.1)
+    client.timing("render", 12)
+    client.flush()
+
+    assert receive_lines(agent) == [
+        "requests:1|c|#app:web,env:prod",
+        "workers:-2|c",
+        "queue:5|g|@0.5",
+        "latency:0.25|h|@0.1|#app:web",
+        "render:12|ms",
+    ]
+
+
+def test_event_is_encoded_as_dogstatsd_event(agent):
+    client = get_client(agent)
+
+    client.event(
+        "Healthcheck failed", "database\ndown", tags=["app:web"], alert_type="error"
+    )
+    client.flush()
+
+    assert receive_lines(agent) == [
+        "_e{18,14}:Healthcheck failed|database\\ndown|t:error|#app:web"
+    ]
+
+
+def test_event_lengths_are_counted_in_bytes(agent):
+    client = get_client(agent)
+
+    client.event("Café down", "Health check didn't provide a status 😭.")
+    client.flush()
+
+    assert receive_lines(agent) == [
+        "_e{10,42}:Café down|Health check didn't provide a status 😭."
+    ]
+
+
+def test_lines_are_packed_into_packets_up_to_max_size(agent):
+    client = get_client(agent, max_packet_size=70)
+
+    for _ in range(10):
+        client.increment("requests.successful", tags=["app:web"])
+    client.flush()
+
+    packets = []
+    while True:
+        try:
+            packets.append(agent.recv(65535))
+        except socket.timeout:
+            break
+        agent.settimeout(0.1)
+
+    lines = [line for packet in packets for line in packet.split(b"\n")]
+
+    assert all(len(packet) <= 70 for packet in packets)
+    assert len(packets) == 5
+    assert lines == [b"requests.successful:1|c|#app:web"] * 10
+
+
+def test_metrics_can_be_sent_over_unix_socket():
+    path = os.path.join(tempfile.mkdtemp(), "dsd.socket")
+    agent = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    agent.bind(path)
+    agent.settimeout(1)
+
+    try:
+        client = DogStatsD(socket_path=path)
+        client.increment("requests")
+        client.flush()
+
+        assert receive_lines(agent) == ["requests:1|c"]
+    finally:
+        agent.close()
+        os.remove(path)
+
+
+def test_dogstatsd_backend_does_not_need_an_api_key(agent):
+    host, port = agent.getsockname()
+
+    DataDog.stop()
+    DataDog.configure_settings(
+        {
+            "DATADOG_STATS_ENABLED": True,
+            "DATADOG_STATS_PREFIX": "dsd",
+            "DATADOG_STATS_BACKEND": "dogstatsd",
+            "DATADOG_STATSD_HOST": host,
+            "DATADOG_STATSD_PORT": port,
+        }
+    )
+
+    try:
+        assert isinstance(DataDog.stats(), DogStatsD)
+
+        DataDog.increment("requests", tags={"app": "web"})
+        DataDog.stop()
+
+        assert receive_lines(agent) == ["dsd.requests:1|c|#app:web"]
+    finally:
+        DataDog.stop()
+        DataDog.configure_settings({})
+
+
+def test_stats_count_lines_and_packets(agent):
+    client = get_client(agent)
+
+    client.increment("requests")
+    client.gauge("queue", 5)
+    assert client.get_stats()["buffer_size"] > 0
+
+    client.flush()
+    receive_lines(agent)
+
+    stats = client.get_stats()
+    assert stats["lines"] == 2
+    assert stats["packets"] == 1
+    assert stats["bytes_sent"] == len("requests:1|c\nqueue:5|g")
+    assert stats["dropped_packets"] == 0
+    assert stats["buffer_size"] == 0
+
+
+def test_batches_are_encoded_as_dogstatsd_lines(agent):
+    client = get_client(agent)
+
+    client.submit_many(
+        [
+            MetricPoint("increment", "jobs", 1, ["queue:default"], 1),
+            MetricPoint("decrement", "workers", 2, None, 1),
+            MetricPoint("histogram", "duration", 0.5, ["queue:default"], 0.1),
+        ]
+    )
+    client.flush()
+
+    assert receive_lines(agent) == [
+        "jobs:1|c|#queue:default",
+        "workers:-2|c",
+        "duration:0.5|h|@0.1|#queue:default",
+    ]
+    assert client.get_stats()["lines"] == 3
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import pytest
+
+from panopticon.compat import mock
+from panopticon.datadog import DataDog
+from panopticon.events import EventPipeline
+from panopticon.health import HealthCheck
+
+
+@pytest.fixture
+def stats():
+    DataDog.stop()
+    DataDog.configure_settings(
+        {"DATADOG_STATS_ENABLED": True, "DATADOG_STATS_BACKEND": "recording"}
+    )
+
+    yield DataDog.stats()
+
+    EventPipeline.stop_pipeline()
+    DataDog.stop()
+    DataDog.configure_settings({})
+
+
+@pytest.fixture
+def monotonic():
+    with mock.patch("panopticon.events.time.monotonic") as monotonic:
+        monotonic.return_value = 1000
+        yield monotonic
+
+
+def test_events_are_sent_from_flush(stats, monotonic):
+    pipeline = EventPipeline(flush_interval=60)
+
+    assert pipeline.send("Title", "text", tags={"app": "web"}, alert_type="error")
+    assert stats.get_calls("event") == []
+
+    pipeline.stop()
+
+    (call,) = stats.get_calls("event")
+    assert call.args == ("Title", "text")
+    assert call.kwargs["tags"] == ["app:web"]
+    assert call.kwargs["aggregation_key"] == "Title"
+    assert call.kwargs["alert_type"] == "error"
+
+
+def test_duplicate_events_are_suppressed_within_window(stats, monotonic):
+    pipeline = EventPipeline(window=60, burst=10, flush_interval=60)
+
+    assert pipeline.send("Title", "first", aggregation_key="/orders/")
+    assert not pipeline.send("Title", "second", aggregation_key="/orders/")
+    assert not pipeline.send("Title", "third", aggregation_key="/orders/")
+    assert pipeline.send("Title", "other", aggregation_key="/users/")
+    pipeline.flush()
+
+    monotonic.return_value += 60
+    assert pipeline.send("Title", "fourth", aggregation_key="/orders/")
+    pipeline.stop()
+
+    assert [call.args[1] for call in stats.get_calls("event")] == [
+        "first",
+        "other",
+        "fourth\n\n2 similar events were suppressed.",
+    ]
+
+
+def test_summary_is_sent_when_window_closes_with_suppressed_events(stats, monotonic):
+    pipeline = EventPipeline(window=60, burst=10, flush_interval=60)
+
+    assert pipeline.send("Title", "first", aggregation_key="/orders/", tags=["a:b"])
+    assert not pipeline.send("Title", "second", aggregation_key="/orders/")
+    assert not pipeline.send("Title", "third", aggregation_key="/orders/")
+    pipeline.flush()
+
+    monotonic.return_value += 30
+    pipeline.flush()
+    assert len(stats.get_calls("event")) == 1
+
+    monotonic.return_value += 30
+    pipeline.flush()
+
+    first, summary = stats.get_calls("event")
+    assert summary.args == ("Title", "2 similar events were suppressed.")
+    assert summary.kwargs["tags"] == ["a:b"]
+    assert summary.kwargs["aggregation_key"] == "/orders/"
+
+    assert not pipeline.send("Title", "fourth", aggregation_key="/orders/")
+    pipeline.stop()
+
+    assert stats.get_calls("event")[-1].args == (
+        "Title",
+        "1 similar events were suppressed.",
+    )
+
+
+def test_events_are_rate_limited_per_key(stats, monotonic):
+    pipeline = EventPipeline(window=0, burst=2, rate=0.1, flush_interval=60)
+
+    assert pipeline.send("Title", "text")
+    assert pipeline.send("Title", "text")
+    assert not pipeline.send("Title", "text")
+
+    monotonic.return_value += 10
+    assert pipeline.send("Title", "text")
+    assert not pipeline.send("Title", "text")
+
+    pipeline.stop()
+
+
+def test_events_are_dropped_when_disabled(monotonic):
+    DataDog.stop()
+    DataDog.configure_settings({"DATADOG_STATS_ENABLED": False})
+
+    pipeline = EventPipeline()
+
+    assert not pipeline.send("Title", "text")
+    assert pipeline._flush_thread is None
+
+
+def test_failing_health_checks_queue_events(stats):
+    class EventHealthCheck(HealthCheck):
+        health_checks = {}
+
+    @EventHealthCheck.register_healthcheck
+    def broken(data):
+        data[HealthCheck.HEALTHY] = False
+        return data
+
+    EventHealthCheck().run()
+    EventPipeline.stop_pipeline()
+
+    (call,) = stats.get_calls("event")
+    assert call.args[0] == "Healthcheck broken failed"
+    assert call.kwargs["tags"] == ["application:healtcheck"]
@@ -1,11 +1,24 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
+import sys
+import time
+import asyncio
+import threading
 import pytest
+import subprocess
 
 from requests import Timeout, ConnectionError, HTTPError
 
 from panopticon.compat import mock
-from panopticon.health import check_url
+from panopticon.datadog import DataDog
+from panopticon.health import (
+    HealthCheck,
+    HealthCheckCache,
+    check_url,
+    check_url_async,
+    check_urls,
+    get_session,
+)
 
 
 @pytest.mark.parametrize("url", ["", None])
@@ -17,8 +30,8 @@ def test_check_url_for_empty_url(url):
 
 @pytest.mark.parametrize("exception", [Timeout, ConnectionError, HTTPError])
 def test_check_url_connection_errors(exception):
-    with mock.patch("panopticon.health.requests.get") as get_mock:
-        get_mock.side_effect = exception
+    with mock.patch("panopticon.health.get_session") as session_mock:
+        session_mock.return_value.request.side_effect = exception
 
         result = check_url("https://dominatethe.world/api/v1/plans/")
 
@@ -27,8 +40,8 @@ def test_check_url_connection_errors(exception):
 
 
 def test_check_url_with_unexpected_status_code():
-    with mock.patch("panopticon.health.requests.get") as get_mock:
-        get_mock.return_value = mock.Mock(status_code=300)
+    with mock.patch("panopticon.health.get_session") as session_mock:
+        session_mock.return_value.request.return_value = mock.Mock(status_code=300)
 
         result = check_url("https://dominatethe.world/api/v1/plans/")
 
@@ -39,10 +52,592 @@ def test_check_url_with_unexpected_status_code():
 
 
 def test_check_url_for_available_url():
-    with mock.patch("panopticon.health.requests.get") as get_mock:
-        get_mock.return_value = mock.Mock(status_code=200)
+    with mock.patch("panopticon.health.get_session") as session_mock:
+        session_mock.return_value.request.return_value = mock.Mock(status_code=200)
 
         result = check_url("https://dominatethe.world/api/v1/plans/")
 
         assert result["healthy"] is True
         assert result["status_message"] == "URL is available"
+
+
+def get_health_check_class():
+    class TestHealthCheck(HealthCheck):
+        health_checks = {}
+
+    return TestHealthCheck
+
+
+def test_run_health_checks_concurrently():
+    health_check_class = get_health_check_class()
+
+    @health_check_class.register_healthcheck
+    def first(data):
+        time.sleep(0.2)
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    @health_check_class.register_healthcheck
+    def second(data):
+        time.sleep(0.2)
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    start = time.monotonic()
+    result = health_check_class(concurrent=True).run()
+    elapsed = time.monotonic() - start
+
+    assert result.is_healthy is True
+    assert set(result.data[HealthCheck.COMPONENTS]) == {"first", "second"}
+    assert elapsed < 0.35
+
+
+def test_concurrent_health_check_timeout_is_unhealthy():
+    health_check_class = get_health_check_class()
+
+    @health_check_class.register_healthcheck(timeout=0.1)
+    def slow(data):
+        time.sleep(0.5)
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    @health_check_class.register_healthcheck
+    def fast(data):
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    with mock.patch("panopticon.health.DataDog"):
+        result = health_check_class(concurrent=True, timeout=5).run()
+
+    slow_data = result.data[HealthCheck.COMPONENTS]["slow"]
+
+    assert result.is_healthy is False
+    assert slow_data[HealthCheck.HEALTHY] is False
+    assert slow_data[HealthCheck.STATUS_MESSAGE].startswith("Health check timed out")
+    assert 0.1 <= slow_data[HealthCheck.RESPONSE_TIME] < 0.5
+    assert result.data[HealthCheck.COMPONENTS]["fast"][HealthCheck.HEALTHY] is True
+
+
+def test_concurrent_health_check_deadline_starts_when_it_runs():
+    health_check_class = get_health_check_class()
+
+    def register(name):
+        def check(data):
+            time.sleep(0.3)
+            data[HealthCheck.HEALTHY] = True
+            return data
+
+        check.__name__ = name
+        health_check_class.register_healthcheck(timeout=0.5)(check)
+
+    register("first")
+    register("second")
+
+    result = health_check_class(concurrent=True, max_workers=1).run()
+
+    assert result.is_healthy is True
+
+
+def test_concurrent_health_checks_share_a_bounded_pool():
+    health_check_class = get_health_check_class()
+    release = threading.Event()
+    calls = []
+
+    @health_check_class.register_healthcheck(timeout=0.05)
+    def hung(data):
+        calls.append("hung")
+        release.wait(5)
+        return data
+
+    @health_check_class.register_healthcheck(timeout=0.05)
+    def other(data):
+        calls.append("other")
+        release.wait(5)
+        return data
+
+    check = health_check_class(concurrent=True, max_workers=2)
+    try:
+        threads = threading.active_count()
+        for _ in range(3):
+            result = check.run()
+            assert result.is_healthy is False
+
+        assert threading.active_count() - threads <= 2
+        assert sorted(calls) == ["hung", "other"]
+
+        components = result.data[HealthCheck.COMPONENTS]
+        assert components["hung"][HealthCheck.STATUS_MESSAGE].startswith(
+            "Health check timed out"
+        )
+    finally:
+        release.set()
+
+
+def test_hung_check_doesnt_starve_other_checks():
+    health_check_class = get_health_check_class()
+    release = threading.Event()
+
+    @health_check_class.register_healthcheck(timeout=0.05)
+    def hung(data):
+        release.wait(5)
+        return data
+
+    @health_check_class.register_healthcheck(timeout=0.5)
+    def fast(data):
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    check = health_check_class(concurrent=True, max_workers=2)
+    try:
+        for _ in range(5):
+            components = check.run().data[HealthCheck.COMPONENTS]
+            assert components["fast"][HealthCheck.HEALTHY] is True
+            time.sleep(0.02)
+    finally:
+        release.set()
+
+
+def test_concurrent_timeout_of_a_single_health_check():
+    health_check_class = get_health_check_class()
+    release = threading.Event()
+
+    @health_check_class.register_healthcheck(timeout=0.05)
+    def hung(data):
+        release.wait(5)
+        return data
+
+    try:
+        start = time.monotonic()
+        result = health_check_class(concurrent=True).run()
+
+        assert time.monotonic() - start < 1
+        assert result.data[HealthCheck.COMPONENTS]["hung"][
+            HealthCheck.STATUS_MESSAGE
+        ].startswith("Health check timed out")
+    finally:
+        release.set()
+
+
+def test_run_only_checks_of_profile_cheapest_first():
+    health_check_class = get_health_check_class()
+    calls = []
+
+    def register(name, **options):
+        def check(data):
+            calls.append(name)
+            data[HealthCheck.HEALTHY] = True
+            return data
+
+        check.__name__ = name
+        health_check_class.register_healthcheck(**options)(check)
+
+    register("database", cost=10)
+    register("cache", cost=2)
+    register("process", profiles=[HealthCheck.LIVENESS, HealthCheck.READINESS])
+
+    live = health_check_class().run(HealthCheck.LIVENESS)
+    assert list(live.data[HealthCheck.COMPONENTS]) == ["process"]
+
+    calls[:] = []
+    health_check_class().run(HealthCheck.READINESS)
+    assert calls == ["process", "cache", "database"]
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_failing_critical_check_short_circuits(concurrent):
+    health_check_class = get_health_check_class()
+
+    @health_check_class.register_healthcheck(cost=1, critical=True)
+    def database(data):
+        data[HealthCheck.HEALTHY] = False
+        return data
+
+    @health_check_class.register_healthcheck(cost=5)
+    def search(data):
+        time.sleep(0.05)
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    check = health_check_class(concurrent=concurrent, max_workers=1)
+
+    components = check.run(short_circuit=True).data[HealthCheck.COMPONENTS]
+    assert components["search"][HealthCheck.SKIPPED] is True
+    assert "database" in components["search"][HealthCheck.STATUS_MESSAGE]
+
+    components = check.run().data[HealthCheck.COMPONENTS]
+    assert components["search"][HealthCheck.HEALTHY] is True
+
+
+def test_run_async_gathers_coroutine_and_plain_health_checks():
+    health_check_class = get_health_check_class()
+
+    @health_check_class.register_healthcheck
+    async def coroutine_check(data):
+        await asyncio.sleep(0.2)
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    @health_check_class.register_healthcheck
+    def plain_check(data):
+        time.sleep(0.2)
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    start = time.monotonic()
+    result = asyncio.run(health_check_class().run_async())
+    elapsed = time.monotonic() - start
+
+    assert result.is_healthy is True
+    assert set(result.data[HealthCheck.COMPONENTS]) == {
+        "coroutine_check",
+        "plain_check",
+    }
+    assert elapsed < 0.35
+
+
+def test_run_async_health_check_timeout_is_unhealthy():
+    health_check_class = get_health_check_class()
+
+    @health_check_class.register_healthcheck(timeout=0.1)
+    async def slow(data):
+        await asyncio.sleep(1)
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    result = asyncio.run(health_check_class().run_async())
+    slow_data = result.data[HealthCheck.COMPONENTS]["slow"]
+
+    assert result.is_healthy is False
+    assert slow_data[HealthCheck.STATUS_MESSAGE].startswith("Health check timed out")
+
+
+def test_run_calls_coroutine_health_checks():
+    health_check_class = get_health_check_class()
+
+    @health_check_class.register_healthcheck
+    async def coroutine_check(data):
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    result = health_check_class().run()
+
+    assert result.is_healthy is True
+
+
+@pytest.mark.parametrize("url", ["", None])
+def test_check_url_async_for_empty_url(url):
+    result = asyncio.run(check_url_async(url))
+    assert result["healthy"] is False
+    assert result["status_message"] == "No URL specified to check."
+
+
+def test_check_url_async_falls_back_to_executor_without_aiohttp():
+    with mock.patch("panopticon.health._import_aiohttp", return_value=None), mock.patch(
+        "panopticon.health.get_session"
+    ) as session_mock:
+        session_mock.return_value.request.return_value = mock.Mock(status_code=200)
+
+        result = asyncio.run(check_url_async("https://dominatethe.world/"))
+
+        assert result["healthy"] is True
+        assert result["status_message"] == "URL is available"
+
+
+def get_counting_health_check_class(**options):
+    health_check_class = get_health_check_class()
+    calls = []
+
+    @health_check_class.register_healthcheck(**options)
+    def counting(data):
+        calls.append(time.monotonic())
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    return health_check_class, calls
+
+
+def test_cache_returns_result_until_ttl_expires():
+    health_check_class, calls = get_counting_health_check_class()
+    cache = HealthCheckCache(health_check_class(), ttl=60)
+
+    first = cache.get()
+    second = cache.get()
+
+    assert first is second
+    assert first.is_healthy is True
+    assert len(calls) == 1
+
+
+def test_cache_returns_stale_result_while_refreshing():
+    health_check_class, calls = get_counting_health_check_class()
+    cache = HealthCheckCache(health_check_class(), ttl=0.05)
+
+    first = cache.get()
+    time.sleep(0.1)
+    stale = cache.get()
+
+    assert stale is first
+
+    time.sleep(0.1)
+
+    assert len(calls) == 2
+    assert cache.get() is not first
+
+
+def test_cache_uses_ttl_of_health_check():
+    health_check_class, calls = get_counting_health_check_class(ttl=60)
+    cache = HealthCheckCache(health_check_class(), ttl=0.01)
+
+    cache.get()
+    time.sleep(0.05)
+    cache.refresh()
+
+    assert len(calls) == 1
+
+
+def test_cache_keeps_skipped_checks_until_critical_check_expires():
+    health_check_class = get_health_check_class()
+    calls = []
+
+    @health_check_class.register_healthcheck(cost=1, critical=True, ttl=60)
+    def database(data):
+        calls.append("database")
+        return data
+
+    @health_check_class.register_healthcheck(cost=5)
+    def search(data):
+        calls.append("search")
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    cache = HealthCheckCache(health_check_class(short_circuit=True), ttl=0.01)
+
+    with mock.patch("panopticon.health.EventPipeline"):
+        result = cache.get()
+        time.sleep(0.05)
+        cache.refresh()
+
+    assert result.data[HealthCheck.COMPONENTS]["search"][HealthCheck.SKIPPED]
+    assert calls == ["database"]
+
+
+def test_cache_keeps_results_warm_in_background():
+    health_check_class, calls = get_counting_health_check_class()
+    cache = HealthCheckCache(health_check_class(), ttl=0.05)
+
+    cache.start()
+    try:
+        time.sleep(0.3)
+    finally:
+        cache.stop()
+
+    assert len(calls) >= 2
+    assert cache.get().is_healthy is True
+
+
+def test_stale_cache_starts_one_refresh_at_a_time():
+    health_check_class, calls = get_counting_health_check_class()
+    cache = HealthCheckCache(health_check_class(), ttl=0.01)
+    cache.get()
+    time.sleep(0.05)
+
+    with mock.patch("panopticon.health.threading.Thread") as thread_class:
+        for _ in range(20):
+            cache.get()
+
+    assert thread_class.call_count == 1
+
+
+def test_stale_cache_wakes_the_background_refresh():
+    health_check_class, calls = get_counting_health_check_class()
+    cache = HealthCheckCache(health_check_class(), ttl=60)
+    cache.start()
+    try:
+        cache.get()
+        for name, (result, _) in list(cache._components.items()):
+            cache._components[name] = (result, 0)
+        cache._expires_at = 0
+
+        with mock.patch("panopticon.health.threading.Thread") as thread_class:
+            for _ in range(20):
+                cache.get()
+        time.sleep(0.2)
+
+        assert thread_class.call_count == 0
+        assert len(calls) == 2
+    finally:
+        cache.stop()
+
+
+def test_check_url_uses_shared_session():
+    assert get_session() is get_session()
+
+
+@pytest.mark.parametrize("method,stream", [("HEAD", False), ("GET", True)])
+def test_check_url_without_reading_body(method, stream):
+    with mock.patch("panopticon.health.get_session") as session_mock:
+        response = mock.Mock(status_code=200)
+        session_mock.return_value.request.return_value = response
+
+        result = check_url("https://dominatethe.world/", method=method, stream=stream)
+
+        session_mock.return_value.request.assert_called_with(
+            method, "https://dominatethe.world/", timeout=5, stream=stream
+        )
+        assert response.close.called is stream
+        assert result["healthy"] is True
+
+
+def test_check_urls_returns_data_per_url():
+    urls = ["https://dominatethe.world/", "https://dominatethe.world/plans/"]
+
+    def request(method, url, **kwargs):
+        return mock.Mock(status_code=200 if url == urls[0] else 503)
+
+    with mock.patch("panopticon.health.get_session") as session_mock:
+        session_mock.return_value.request.side_effect = request
+
+        results = check_urls(urls)
+
+    assert list(results) == urls
+    assert results[urls[0]]["healthy"] is True
+    assert results[urls[1]]["healthy"] is False
+    assert "response_time" in results[urls[1]]
+
+
+def test_metrics_pipeline_health_check_can_be_enabled_from_settings():
+    health_check_class = get_health_check_class()
+    health_check_class.configure_settings({"HEALTHCHECK_METRICS_PIPELINE": True})
+
+    with mock.patch.object(DataDog, "get_pipeline_stats") as get_pipeline_stats:
+        get_pipeline_stats.return_value = {"client": {"last_flush_failed": True}}
+
+        assert health_check_class().run(HealthCheck.READINESS).is_healthy is True
+
+        result = health_check_class().run()
+
+    data = result.data[HealthCheck.COMPONENTS]["metrics_pipeline"]
+    assert data[HealthCheck.HEALTHY] is False
+    assert data["pipeline"] == {"client": {"last_flush_failed": True}}
+
+
+def test_importing_health_doesnt_load_heavy_dependencies():
+    code = (
+        "import sys, panopticon.health; "
+        "print(' '.join(sorted(m for m in ('requests', 'datadog', 'aiohttp', "
+        "'asyncio') if m in sys.modules)))"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code])
+
+    assert output.decode("ascii").strip() == ""
+
+
+def get_flaky_health_check_class(results, **options):
+    health_check_class = get_health_check_class()
+    calls = []
+
+    @health_check_class.register_healthcheck(**options)
+    def flaky(data):
+        calls.append(True)
+        data[HealthCheck.HEALTHY] = results.pop(0)
+        data[HealthCheck.STATUS_MESSAGE] = "call {}".format(len(calls))
+        return data
+
+    return health_check_class, calls
+
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    clock = [100.0]
+    health_check_class, calls = get_flaky_health_check_class(
+        [False, False, False, True], failure_threshold=2, reset_timeout=10
+    )
+
+    def run():
+        return health_check_class().run().data["components"]["flaky"]
+
+    with mock.patch("panopticon.health.time.monotonic", lambda: clock[0]):
+        assert run()["circuit_breaker"] == {"state": "closed", "failures": 1}
+        assert run()["circuit_breaker"]["state"] == "open"
+
+        clock[0] += 5
+        data = run()
+        assert len(calls) == 2
+        assert data["status_message"] == "call 2"
+        assert data["circuit_breaker"] == {
+            "state": "open",
+            "failures": 2,
+            "retry_in": 5,
+        }
+
+        # the trial run fails and the breaker opens for twice as long
+        clock[0] += 5
+        assert run()["circuit_breaker"]["retry_in"] == 20
+        assert len(calls) == 3
+
+        clock[0] += 20
+        assert run()["circuit_breaker"] == {"state": "closed", "failures": 0}
+        assert len(calls) == 4
+
+
+def test_circuit_breaker_is_disabled_by_default():
+    health_check_class, calls = get_flaky_health_check_class([False] * 5)
+
+    for _ in range(5):
+        data = health_check_class().run().data["components"]["flaky"]
+
+    assert len(calls) == 5
+    assert "circuit_breaker" not in data
+
+
+def test_circuit_breaker_counts_timeouts_as_failures():
+    health_check_class = get_health_check_class()
+    health_check_class.CIRCUIT_BREAKER_THRESHOLD = 1
+    calls = []
+
+    @health_check_class.register_healthcheck(timeout=0.05)
+    async def slow(data):
+        calls.append(True)
+        await asyncio.sleep(1)
+
+    asyncio.run(health_check_class().run_async())
+    result = asyncio.run(health_check_class().run_async())
+
+    assert len(calls) == 1
+    assert result.data["components"]["slow"]["circuit_breaker"]["state"] == "open"
+
+
+@pytest.mark.parametrize("healthy", [True, False])
+def test_circuit_breaker_ignores_results_of_timed_out_runs(healthy):
+    health_check_class = get_health_check_class()
+    finished = []
+
+    @health_check_class.register_healthcheck(timeout=0.05, failure_threshold=2)
+    def slow(data):
+        time.sleep(0.15)
+        data[HealthCheck.HEALTHY] = healthy
+        finished.append(True)
+        return data
+
+    @health_check_class.register_healthcheck
+    def fast(data):
+        data[HealthCheck.HEALTHY] = True
+        return data
+
+    def run():
+        with mock.patch("panopticon.health.EventPipeline"):
+            result = health_check_class(concurrent=True).run()
+
+        # Let the abandoned run finish before the next probe.
+        count = len(finished)
+        while len(finished) == count:
+            time.sleep(0.01)
+
+        return result.data[HealthCheck.COMPONENTS]["slow"]
+
+    data = run()
+    assert data[HealthCheck.STATUS_MESSAGE].startswith("Health check timed out")
+    assert slow.circuit_breaker.get_data() == {"state": "closed", "failures": 1}
+
+    data = run()
+    assert data[HealthCheck.CIRCUIT_BREAKER]["state"] == "open"
+    assert slow.circuit_breaker.failures == 2
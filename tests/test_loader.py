@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import sys
+import pytest
+
+from panopticon.loader import load_healthcheck_modules, module_exists
+
+
+@pytest.fixture
+def packages(tmp_path, monkeypatch):
+    for name, source in (
+        ("with_checks", "LOADED = True\n"),
+        ("broken_checks", "import does_not_exist\n"),
+    ):
+        package = tmp_path / name
+        package.mkdir()
+        (package / "__init__.py").write_text("")
+        (package / "healthchecks.py").write_text(source)
+
+    (tmp_path / "without_checks").mkdir()
+    (tmp_path / "without_checks" / "__init__.py").write_text("")
+
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield
+    for name in list(sys.modules):
+        if name.split(".")[0] in ("with_checks", "broken_checks", "without_checks"):
+            del sys.modules[name]
+
+
+def test_load_healthcheck_modules_skips_packages_without_module(packages):
+    load_healthcheck_modules(["with_checks", "without_checks", "not_installed"])
+
+    assert sys.modules["with_checks.healthchecks"].LOADED is True
+    assert "without_checks.healthchecks" not in sys.modules
+
+
+def test_load_healthcheck_modules_doesnt_hide_import_errors(packages):
+    with pytest.raises(ImportError):
+        load_healthcheck_modules(["broken_checks"])
+
+
+def test_module_exists(packages):
+    assert module_exists("with_checks.healthchecks") is True
+    assert module_exists("without_checks.healthchecks") is False
+    assert module_exists("not_installed.healthchecks") is False
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import pytest
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from django.http import Http404  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from django.urls import resolve  # noqa: E402
+
+from panopticon.datadog import DataDog  # noqa: E402
+from panopticon.django.views import MetricsView  # noqa: E402
+from panopticon.prometheus import (  # noqa: E402
+    PrometheusExporter,
+    get_prometheus_labels,
+    get_prometheus_name,
+)
+
+
+def test_metrics_are_rendered_in_text_format():
+    exporter = PrometheusExporter(buckets=(0.1, 1))
+
+    exporter.increment("web.requests", tags=["path:/", "status:200"])
+    exporter.increment("web.requests", value=2, tags=["path:/", "status:200"])
+    exporter.gauge("web.queue", 3.5)
+    for value in (0.05, 0.5, 0.5, 3):
+        exporter.histogram("web.latency", value, tags=["app:web"])
+
+    assert exporter.render().decode("utf-8") == (
+        "# TYPE web_latency histogram\n"
+        'web_latency_bucket{app="web",le="0.1"} 1\n'
+        'web_latency_bucket{app="web",le="1.0"} 3\n'
+        'web_latency_bucket{app="web",le="+Inf"} 4\n'
+        'web_latency_sum{app="web"} 4.05\n'
+        'web_latency_count{app="web"} 4\n'
+        "# TYPE web_queue gauge\n"
+        "web_queue 3.5\n"
+        "# TYPE web_requests_total counter\n"
+        'web_requests_total{path="/",status="200"} 3\n'
+    )
+
+
+def test_decremented_counters_are_exposed_as_gauges():
+    exporter = PrometheusExporter()
+
+    exporter.increment("workers", value=3, tags=["pool:web"])
+    exporter.increment("workers", tags=["pool:jobs"])
+    exporter.decrement("workers", tags=["pool:web"])
+    exporter.increment("workers", tags=["pool:web"])
+
+    lines = exporter.render().decode("utf-8").splitlines()
+    assert lines[0] == "# TYPE workers gauge"
+    assert sorted(lines[1:]) == ['workers{pool="jobs"} 1', 'workers{pool="web"} 3']
+
+
+def test_sampled_histogram_values_are_weighted():
+    exporter = PrometheusExporter(buckets=(1,))
+
+    exporter.histogram("latency", 0.5, sample_rate=0.25)
+
+    output = exporter.render().decode("utf-8")
+    assert 'latency_bucket{le="1.0"} 4.0\n' in output
+    assert "latency_count 4.0\n" in output
+
+
+def test_unchanged_series_are_reused_between_scrapes():
+    exporter = PrometheusExporter()
+    exporter.increment("requests", tags=["path:/"])
+    exporter.increment("requests", tags=["path:/orders/"])
+
+    exporter.render()
+    exporter.increment("requests", tags=["path:/"])
+    output = exporter.render()
+
+    assert b'requests_total{path="/"} 2\n' in output
+    assert exporter.get_stats()["reused_series"] == 1
+    assert exporter.get_stats()["scrapes"] == 2
+
+
+def test_series_are_bounded():
+    exporter = PrometheusExporter(max_series=1, stripes=1)
+
+    exporter.increment("requests", tags=["path:/"])
+    exporter.increment("requests", tags=["path:/orders/"])
+
+    assert exporter.get_stats()["series"] == 1
+    assert exporter.get_stats()["dropped_points"] == 1
+
+
+@pytest.mark.parametrize(
+    "metric_name, expected",
+    [("web.requests", "web_requests"), ("2xx-count", "_2xx_count")],
+)
+def test_prometheus_names(metric_name, expected):
+    assert get_prometheus_name(metric_name) == expected
+
+
+def test_prometheus_labels():
+    tags = ["env:prod", "canary", 'path:/a"b', "env:staging", "url:http://x"]
+
+    assert get_prometheus_labels(tags) == [
+        'canary="true"',
+        'env="staging"',
+        'path="/a\\"b"',
+        'url="http://x"',
+    ]
+
+
+def test_metrics_view_serves_prometheus_backend():
+    DataDog.stop()
+    DataDog.configure_settings(
+        {
+            "DATADOG_STATS_ENABLED": True,
+            "DATADOG_STATS_BACKEND": "prometheus",
+            "DATADOG_STATS_PREFIX": "web",
+        }
+    )
+
+    try:
+        DataDog.increment("requests", tags={"path": "/"})
+        response = MetricsView.as_view()(RequestFactory().get("/metrics/"))
+    finally:
+        DataDog.stop()
+        DataDog.configure_settings({})
+
+    assert response.status_code == 200
+    assert response["Content-Type"] == PrometheusExporter.CONTENT_TYPE
+    assert b'web_requests_total{path="/"} 1\n' in response.content
+
+
+def test_metrics_view_is_not_found_for_other_backends():
+    DataDog.stop()
+    DataDog.configure_settings({"DATADOG_STATS_ENABLED": False})
+
+    with pytest.raises(Http404):
+        MetricsView.as_view()(RequestFactory().get("/metrics/"))
+
+
+def test_metrics_url_resolves_to_metrics_view():
+    match = resolve("/metrics/", urlconf="panopticon.django.metrics_urls")
+
+    assert match.func.view_class is MetricsView
+    assert match.url_name == "metrics"
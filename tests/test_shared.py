@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import os
+import multiprocessing
+
+import pytest
+
+from panopticon.compat import mock
+from panopticon.shared import SharedMemoryAggregator, SharedRegion
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join("panopticon.metrics"))
+
+
+def get_metrics_by_name(reporter):
+    metrics = {}
+    for call in reporter.flush_metrics.call_args_list:
+        for metric in call[0][0]:
+            metrics[metric["metric"]] = metric
+    return metrics
+
+
+def emit_metrics(path, worker):
+    aggregator = SharedMemoryAggregator(path=path, slots=64, reporter=mock.Mock())
+
+    for value in range(1, 101):
+        aggregator.increment("requests", tags=["app:web"])
+        aggregator.histogram("latency", value, tags=["app:web"])
+    aggregator.gauge("workers", worker)
+
+    aggregator.flush()
+    os._exit(0 if not aggregator.is_flusher else 1)
+
+
+def test_region_combines_values_by_context(path):
+    region = SharedRegion(path, slots=16)
+    context = ("count", "requests", None, ("app:web",))
+
+    region.merge([((0, context), 2)])
+    region.merge([((0, context), 3)])
+
+    assert region.collect() == [(context, 5)]
+    assert region.collect() == []
+
+
+def test_region_drops_contexts_when_full(path):
+    region = SharedRegion(path, slots=2)
+
+    region.merge(
+        [((0, ("count", "metric{}".format(i), None, None)), 1) for i in range(3)]
+    )
+
+    assert region.dropped == 1
+    assert len(region.collect()) == 2
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_flusher_sends_metrics_of_all_processes(path):
+    reporter = mock.Mock()
+    flusher = SharedMemoryAggregator(path=path, slots=64, reporter=reporter)
+    assert flusher.is_flusher
+
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=emit_metrics, args=(path, worker)) for worker in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # none of the workers could become the flusher
+    assert [worker.exitcode for worker in workers] == [0] * 4
+
+    flusher._roll_up_interval = 10
+    flusher.flush()
+    flusher.stop()
+
+    metrics = get_metrics_by_name(reporter)
+
+    assert metrics["requests"]["points"][0][1] == 400 / 10.0
+    assert metrics["requests"]["tags"] == ["app:web"]
+    assert metrics["latency.count"]["points"][0][1] == 400 / 10.0
+    assert metrics["latency.max"]["points"][0][1] == 100
+    assert metrics["latency.avg"]["points"][0][1] == 50.5
+    assert metrics["latency.95percentile"]["points"][0][1] == pytest.approx(95, rel=0.1)
+    assert metrics["workers"]["points"][0][1] in range(4)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import sys
+import json
+import asyncio
+import subprocess
+
+import pytest
+
+from panopticon.health import HealthCheck
+from panopticon.web import HealthCheckApp, HealthCheckASGIApp, get_responder
+
+
+def get_health_check_class(healthy=True, cache_ttl=None):
+    class TestHealthCheck(HealthCheck):
+        health_checks = {}
+        CACHE_TTL = cache_ttl
+
+    @TestHealthCheck.register_healthcheck
+    def database(data):
+        data[HealthCheck.HEALTHY] = healthy
+        return data
+
+    return TestHealthCheck
+
+
+def call_wsgi_app(app, **environ):
+    response = {}
+
+    def start_response(status, headers):
+        response["status"] = status
+        response["headers"] = dict(headers)
+
+    response["body"] = b"".join(app(environ, start_response))
+    return response
+
+
+def test_wsgi_app_serves_health_check_result():
+    app = HealthCheckApp(health_check_class=get_health_check_class(healthy=False))
+
+    response = call_wsgi_app(app)
+
+    assert response["status"] == "500 Internal Server Error"
+    assert response["headers"]["Content-Type"] == "application/json"
+    data = json.loads(response["body"].decode("utf-8"))
+    assert data[HealthCheck.SERVICE_HEALTHY] is False
+    assert list(data[HealthCheck.COMPONENTS]) == ["database"]
+
+
+def test_cached_result_is_encoded_once_and_not_modified():
+    health_check_class = get_health_check_class(cache_ttl=60)
+    app = HealthCheckApp(health_check_class=health_check_class)
+
+    first = call_wsgi_app(app)
+    etag = first["headers"]["ETag"]
+
+    second = call_wsgi_app(app, HTTP_IF_NONE_MATCH='W/"other", ' + etag)
+    assert second["status"] == "304 Not Modified"
+    assert second["body"] == b""
+
+    responder = get_responder(health_check_class=health_check_class)
+    assert responder._last[1] is first["body"]
+
+    health_check_class.get_cache().stop()
+
+
+def test_unhealthy_result_is_never_not_modified():
+    health_check_class = get_health_check_class(healthy=False, cache_ttl=60)
+    app = HealthCheckApp(health_check_class=health_check_class)
+
+    first = call_wsgi_app(app)
+    second = call_wsgi_app(app, HTTP_IF_NONE_MATCH=first["headers"]["ETag"])
+
+    assert second["status"] == "500 Internal Server Error"
+    assert second["body"] == first["body"]
+
+    health_check_class.get_cache().stop()
+
+
+def test_asgi_app_runs_checks_on_event_loop():
+    app = HealthCheckASGIApp(health_check_class=get_health_check_class())
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app({"type": "http", "headers": []}, None, send))
+
+    start, body = messages
+    assert start["status"] == 200
+    assert (b"content-type", b"application/json") in start["headers"]
+    assert json.loads(body["body"].decode("utf-8"))[HealthCheck.SERVICE_HEALTHY]
+
+
+def test_django_health_views_do_not_import_drf():
+    code = (
+        "import sys\n"
+        "from django.conf import settings\n"
+        "settings.configure()\n"
+        "import panopticon.django.views as views\n"
+        "print('rest_framework' in sys.modules)\n"
+        "print(views.HealthCheckView.__module__)\n"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code])
+
+    assert output.decode("ascii").split() == [
+        "False",
+        "panopticon.django.drf_views",
+    ]
+
+
+@pytest.mark.parametrize(
+    "path, profile",
+    [
+        ("/healthcheck/", None),
+        ("/healthcheck/live/", HealthCheck.LIVENESS),
+        ("/healthcheck/ready/", HealthCheck.READINESS),
+    ],
+)
+def test_django_health_urls_resolve_to_profiles(path, profile):
+    from django.conf import settings
+
+    if not settings.configured:
+        settings.configure()
+
+    from django.urls import resolve
+    from panopticon.django.views import HealthView
+
+    match = resolve(path, urlconf="panopticon.django.urls")
+
+    assert match.func.view_class is HealthView
+    assert match.func.view_initkwargs.get("profile") == profile